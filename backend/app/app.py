@@ -1,30 +1,161 @@
 import os
 import uuid
+import base64
+import json
+import gzip
+import sys
+import re
+import hashlib
+import mimetypes
+import threading
+import tarfile
+import zipfile
+import zlib
+import hmac
+import urllib.request
+from collections import Counter, namedtuple
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, redirect, send_file
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api, Resource, reqparse
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import DDL, event, func, or_, and_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import validates
 from datetime import datetime, timedelta
+import click
 import jwt
 from functools import wraps
 from flask import url_for
 
+from werkzeug.exceptions import ClientDisconnected
+
+import images
+from blobstore import BlobStore, is_blob_name
+from bulk import EXPORT_FORMAT, batches, blob_source, fetch_blob, is_url, read_records
+from cache import LRUCache
+from database import configure_sqlite, database_url, engine_options, retry_on_lock
+from jobs import JobQueue
+from metrics import ROUTE_KEY, MetricsMiddleware, MetricsRegistry, SamplingProfiler, TimedJSONProvider, track_sql
+from migrations import Migrations
+from passwords import PasswordHasher
+from ratelimit import MemoryBucketStore, SQLiteBucketStore, TokenBucketLimiter
+from revprox import ReverseProxied
+from serializers import FastJSONProvider, Schema
+from snapshot import Snapshot, SnapshotCache, assemble_listing, compress_listing
+from uploads import INCOMING_DIR, PARTIAL_DIR, StreamingUploadRequest, copy_stream, hash_file, store_upload
+from versioning import VERSION_RE, parse_compat_range, prerelease_key, version_key
+
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest
+# Behind nginx, take the client IP, path prefix and scheme from its headers,
+# see revprox.py. Only enable it when clients cannot reach the app directly.
+# Request metrics served at /metrics, summed over the processes sharing
+# METRICS_DIR, and stacks of requests slower than PROFILE_SLOW_REQUESTS
+# seconds sampled into PROFILE_DIR
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', '')
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS', 0))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+metrics_registry = MetricsRegistry(app.config['METRICS_DIR'] or None)
+profiler = None
+if app.config['PROFILE_SLOW_REQUESTS'] > 0:
+    profiler = SamplingProfiler(app.config['PROFILE_DIR'], app.config['PROFILE_SLOW_REQUESTS'])
+
+
+class JSONProvider(TimedJSONProvider, FastJSONProvider):
+    pass
+
+app.json = JSONProvider(app)
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics_registry, profiler)
+if os.environ.get('REVERSE_PROXY', '').lower() in ('1', 'true', 'yes'):
+    app.wsgi_app = ReverseProxied(app.wsgi_app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 api = Api(app)
 app.config['STATIC_FOLDER'] = 'static'
-app.config['UPLOAD_FOLDER'] = '/app/static/uploads'
-# Configure SQLite database
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', '/app/static/uploads')
+# Size limits of a request body and of a single uploaded file, in bytes
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_SIZE', 1024 * 1024 * 1024))
+app.config['MAX_FILE_SIZE'] = int(os.environ.get('MAX_FILE_SIZE', 1024 * 1024 * 1024))
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+# Seconds after which a resumable upload held by a request that never
+# finished can be taken over by another PATCH
+app.config['UPLOAD_RECEIVE_TIMEOUT'] = int(os.environ.get('UPLOAD_RECEIVE_TIMEOUT', 3600))
+# Seconds after their last chunk that uploads not used by a product are
+# removed by uploads-expire
+app.config['UPLOAD_EXPIRY'] = int(os.environ.get('UPLOAD_EXPIRY', 24 * 3600))
+# Let the front-end server send files: X-Sendfile (Apache, lighttpd) with
+# USE_X_SENDFILE, or X-Accel-Redirect to an internal nginx location mapped
+# onto the upload folder with X_ACCEL_REDIRECT_PREFIX
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '')
+# Background jobs, run by worker.py, or inline after the request commits when eager
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '').lower() in ('1', 'true', 'yes')
+app.config['JOB_RETRY_DELAY'] = int(os.environ.get('JOB_RETRY_DELAY', 10))
+app.config['JOB_TIMEOUT'] = int(os.environ.get('JOB_TIMEOUT', 3600))
+# Blobs never change, so clients and proxies may keep them for a year
+BLOB_MAX_AGE = 365 * 24 * 3600
+# Configure the database, an SQLite file unless DATABASE_URL points to
+# another one, such as PostgreSQL to share it between several backends
 DB_PATH = '/app/db/appstore.db'
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_PATH}'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url(os.environ.get('DATABASE_URL') or f'sqlite:///{DB_PATH}')
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    pool_pre_ping=os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 30))
+)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pragmas set on every SQLite connection: WAL lets readers proceed while a
+# write is in progress, and writers wait up to SQLITE_BUSY_TIMEOUT
+# milliseconds for the lock instead of failing at once
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # Negative values are in KiB, per connection
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -16 * 1024)),
+}
+# Attempts left to write transactions still failing on a locked database
+app.config['DB_WRITE_RETRIES'] = int(os.environ.get('DB_WRITE_RETRIES', 5))
+app.config['DB_WRITE_RETRY_DELAY'] = float(os.environ.get('DB_WRITE_RETRY_DELAY', 0.05))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+if not os.environ.get('DATABASE_URL'):
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 HOST = os.environ.get('API_HOST', 'https://localhost:5000')
+# How long clients may reuse catalog responses before revalidating them
+app.config['CATALOG_CACHE_MAX_AGE'] = int(os.environ.get('CATALOG_CACHE_MAX_AGE', 0))
+# Werkzeug password hash method and cost, existing hashes are upgraded on login
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+# Password hashes run at once per worker, and hashes allowed to wait for them
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+# Requests per minute to /api/auth/* per client IP and per email, 0 to disable.
+# Buckets are per worker, or shared by the workers of a host in AUTH_RATE_LIMIT_DB.
+app.config['AUTH_RATE_LIMIT_IP'] = int(os.environ.get('AUTH_RATE_LIMIT_IP', 30))
+app.config['AUTH_RATE_LIMIT_EMAIL'] = int(os.environ.get('AUTH_RATE_LIMIT_EMAIL', 10))
+app.config['AUTH_RATE_LIMIT_DB'] = os.environ.get('AUTH_RATE_LIMIT_DB', '')
+# Users resolved from tokens, cached per worker for AUTH_CACHE_TTL seconds
+app.config['AUTH_CACHE_SIZE'] = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+app.config['AUTH_CACHE_TTL'] = int(os.environ.get('AUTH_CACHE_TTL', 60))
+# In-process cache of serialized read responses, per worker
+app.config['RESPONSE_CACHE_BYTES'] = int(os.environ.get('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+# JSON responses of at least COMPRESS_MIN_SIZE bytes are gzipped for clients accepting it
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+# gzip level of the catalog snapshot, compressed by each worker once per catalog generation
+app.config['CATALOG_SNAPSHOT_LEVEL'] = int(os.environ.get('CATALOG_SNAPSHOT_LEVEL', 6))
+# Bearer token of the bulk export and import API, which is disabled without it
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN', '')
+# Records inserted per transaction by catalog imports
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+# Number of catalog generations kept in the change log replayed by workers
+CATALOG_CHANGE_LOG_SIZE = 1000
 
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
@@ -32,6 +163,11 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 # Initialize database
 db = SQLAlchemy(app)
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        configure_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
+    track_sql(db.engine)
+write_transaction = retry_on_lock(db.session, app.config['DB_WRITE_RETRIES'], app.config['DB_WRITE_RETRY_DELAY'])
 
 file_upload_parser = reqparse.RequestParser()
 file_upload_parser.add_argument('files', type=reqparse.FileStorage, location='files', required=True)
@@ -43,91 +179,1369 @@ class User(db.Model):
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
+    # Carried by tokens as `ver`, incremented to revoke every token issued before
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     products = db.relationship('Product', backref='seller', lazy=True)
 
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     user = db.relationship('User', backref=db.backref('reviews', lazy=True))
 
+    __table_args__ = (db.Index('ix_review_product_created_at', 'product_id', 'created_at', 'id'),)
+
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     files = db.Column(db.String(255), nullable=True)  # Make this nullable
+    file_size = db.Column(db.BigInteger, nullable=True)
+    file_sha256 = db.Column(db.String(64), nullable=True)
+    # Outcome of the validate_archive job for archives: pending, valid or invalid
+    file_status = db.Column(db.String(20), nullable=True)
     file_url = db.Column(db.String(255), nullable=True)  # Make this nullable
     external_url = db.Column(db.String(255), nullable=True)  # Add this new field
     image_name = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=False)
     price = db.Column(db.Float, nullable=False)
     image_url = db.Column(db.String(255))
+    # Resized copies of the image, JSON list filled in by process_product_image()
+    image_variants = db.Column(db.Text, nullable=True)
+    thumbnail_url = db.Column(db.String(255), nullable=True)
     category = db.Column(db.String(50))
-    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     version = db.Column(db.String(50), nullable=False)
+    # Sortable form of `version`, filled in by validate_version(): the key
+    # then, among equal keys, the prerelease_key()
+    version_key = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    version_prerelease = db.Column(db.String(50), nullable=False, default='', server_default='')
+    # Whether this row is the newest version of its title, see refresh_latest_versions()
+    is_latest = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
     license = db.Column(db.String(100), nullable=False)
     oncodash_version = db.Column(db.String(20), nullable=True)
+    # Keys of the Oncodash versions matching `oncodash_version`, from
+    # compat_min_key included to compat_max_key excluded, filled in by
+    # validate_oncodash_version(). NULL when the range cannot be parsed.
+    compat_min_key = db.Column(db.BigInteger, nullable=True)
+    compat_max_key = db.Column(db.BigInteger, nullable=True)
+    # Rating aggregates, maintained by add_review so the listing never loads reviews
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_avg = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
     reviews = db.relationship('Review', backref='product', lazy=True)
 
-    __table_args__ = (db.UniqueConstraint('title', 'version', name='uq_title_version'),)
+    __table_args__ = (
+        db.UniqueConstraint('title', 'version', name='uq_title_version'),
+        db.Index('ix_product_title_version_key', 'title', 'version_key', 'version_prerelease'),
+        db.Index('ix_product_latest_title', 'is_latest', 'title', 'id'),
+        db.Index('ix_product_latest_created_at', 'is_latest', 'created_at', 'id'),
+        db.Index('ix_product_latest_rating_avg', 'is_latest', 'rating_avg', 'id'),
+        db.Index('ix_product_latest_category', 'is_latest', 'category', 'created_at', 'id'),
+        db.Index('ix_product_latest_seller', 'is_latest', 'seller_id', 'created_at', 'id'),
+        db.Index('ix_product_latest_oncodash_version', 'is_latest', 'oncodash_version', 'created_at', 'id'),
+        db.Index('ix_product_latest_license', 'is_latest', 'license', 'created_at', 'id'),
+        db.Index('ix_product_compat', 'compat_min_key', 'compat_max_key'),
+    )
+
+    @validates('version')
+    def validate_version(self, key, version):
+        self.version_key = version_key(version)
+        self.version_prerelease = prerelease_key(version)
+        return version
+
+    @validates('oncodash_version')
+    def validate_oncodash_version(self, key, oncodash_version):
+        self.compat_min_key, self.compat_max_key = compat_keys(oncodash_version)
+        return oncodash_version
 
     @property
     def is_latest_version(self):
-        latest = Product.query.filter_by(title=self.title).order_by(Product.version.desc()).first()
-        return latest.id == self.id
+        return self.is_latest
+
+def compat_keys(oncodash_version):
+    """The (compat_min_key, compat_max_key) of a product, (None, None) without a valid range."""
+    if oncodash_version is None:
+        return None, None
+    try:
+        return parse_compat_range(oncodash_version)
+    except ValueError:
+        return None, None
+
+def image_variant_list(value):
+    return [{key: variant[key] for key in ('width', 'format', 'url')}
+            for variant in app.json.loads(value)] if value else []
+
+# Columns serialized by PRODUCT_SCHEMA, selected directly rather than
+# through Product instances, the seller name coming from a join
+PRODUCT_COLUMNS = (
+    Product.id, Product.title, Product.description, Product.files, Product.file_url, Product.file_size,
+    Product.file_sha256, Product.file_status, Product.external_url, Product.image_name, Product.image_url,
+    func.coalesce(func.nullif(Product.thumbnail_url, ''), Product.image_url).label('thumbnail'),
+    Product.image_variants, Product.category, Product.version, Product.license, Product.oncodash_version,
+    Product.seller_id, User.name.label('seller_name'), Product.created_at, Product.review_count,
+    Product.rating_avg,
+)
+PRODUCT_SCHEMA = Schema(
+    id='id', title='title', description='description', files='files', file_url='file_url',
+    file_size='file_size', file_sha256='file_sha256', file_status='file_status',
+    external_url='external_url', image_url='image_url', thumbnail_url='thumbnail',
+    image_variants=('image_variants', image_variant_list), category='category', version='version',
+    license='license', oncodash_version='oncodash_version',
+    seller=Schema(id='seller_id', name='seller_name'),
+    created_at='created_at', reviewCount='review_count', rating='rating_avg',
+)
+# What sellers see of their own products
+SELLER_PRODUCT_SCHEMA = Schema(**PRODUCT_SCHEMA.fields, image_name='image_name')
+# Compatible versions, telling whether a newer incompatible one exists
+COMPAT_PRODUCT_SCHEMA = Schema(**PRODUCT_SCHEMA.fields, is_latest='is_latest')
+
+REVIEW_COLUMNS = (Review.id, Review.product_id, Review.user_id, User.name.label('user_name'),
+                  Review.rating, Review.comment, Review.created_at)
+REVIEW_SCHEMA = Schema(id='id', productId='product_id', userId='user_id', userName='user_name',
+                       rating='rating', comment='comment', createdAt='created_at')
+
+VERSION_SCHEMA = Schema(id='id', version='version')
+
+USER_SCHEMA = Schema(id='id', name='name', email='email', created_at='created_at')
+
+def product_rows():
+    return db.session.query(*PRODUCT_COLUMNS).join(User, User.id == Product.seller_id)
+
+def review_rows():
+    return db.session.query(*REVIEW_COLUMNS).join(User, User.id == Review.user_id)
+
+class Blob(db.Model):
+    """A file of the blob store, counting the product columns that reference it."""
+    name = db.Column(db.String(255), primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Product columns holding blob names, see blob_names()
+BLOB_COLUMNS = ('files', 'image_name', 'image_variants')
+
+def blob_names(column, value):
+    """Names of the blobs referenced by the `value` of a Product column."""
+    if column == 'image_variants':
+        return [variant['name'] for variant in json.loads(value)] if value else []
+    return [value] if is_blob_name(value) else []
+
+def count_blob_references(connection, name):
+    """Number of product columns referencing blob `name`, as blobs-gc counts them."""
+    table = Product.__table__
+    count = 0
+    for column in BLOB_COLUMNS:
+        condition = table.c[column].contains(name) if column == 'image_variants' else table.c[column] == name
+        for value in connection.execute(db.select(table.c[column]).where(condition)).scalars():
+            count += blob_names(column, value).count(name)
+    return count
+
+def register_blob(name, sha256, size):
+    """Create the row of a blob stored outside product writes, with the count of its references.
+
+    Imported products may reference blobs that only arrive later, which
+    blobs-gc would otherwise remove as orphan files.
+    """
+    connection = db.session.connection()
+    blobs = Blob.__table__
+    connection.execute(insert_ignore(blobs).values(name=name, sha256=sha256, size=size, refcount=0,
+                                                   created_at=datetime.utcnow()))
+    connection.execute(db.update(blobs).where(blobs.c.name == name)
+                       .values(refcount=count_blob_references(connection, name)))
+
+def get_blob_store():
+    return BlobStore(app.config['UPLOAD_FOLDER'])
+
+def insert_ignore(table):
+    """INSERT statement skipping rows whose primary key already exists."""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    return db.insert(table)
+
+def stage_blob(source, sha256, size, extension, staged):
+    """Register the blob of the file at `source` and return its name.
+
+    The file is only moved into the blob store by add_staged_blobs(), once
+    the referencing rows are flushed, so that a concurrent garbage
+    collection cannot remove it in between.
+    """
+    name = BlobStore.blob_name(sha256, extension)
+    db.session.execute(insert_ignore(Blob.__table__).values(
+        name=name, sha256=sha256, size=size, refcount=0, created_at=datetime.utcnow()))
+    staged.append((source, name))
+    return name
+
+def add_staged_blobs(staged):
+    db.session.flush()
+    store = get_blob_store()
+    for source, name in staged:
+        store.add(source, name)
+
+def blob_reference_deltas(session):
+    deltas = Counter()
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, Product):
+            continue
+        for column in BLOB_COLUMNS:
+            if obj in session.new:
+                added, removed = [getattr(obj, column)], []
+            elif obj in session.deleted:
+                added, removed = [], [getattr(obj, column)]
+            else:
+                history = db.inspect(obj).attrs[column].history
+                added, removed = history.added, history.deleted
+            for value in added:
+                deltas.update(blob_names(column, value))
+            for value in removed:
+                deltas.subtract(blob_names(column, value))
+    return deltas
+
+@event.listens_for(db.session, 'after_flush')
+def update_blob_references(session, flush_context):
+    deltas = blob_reference_deltas(session)
+    if not deltas:
+        return
+    released = [name for name, delta in deltas.items() if delta < 0]
+    connection = session.connection()
+    table = Blob.__table__
+    for name, delta in deltas.items():
+        if delta:
+            connection.execute(db.update(table).where(table.c.name == name)
+                               .values(refcount=table.c.refcount + delta))
+    if not released:
+        return
+
+    # Drop the blobs no product references anymore. Their files are moved
+    # aside while this transaction holds its locks, and only removed once it
+    # commits, so a rollback can put them back.
+    unreferenced = connection.execute(
+        db.select(table.c.name).where(table.c.name.in_(released), table.c.refcount <= 0)
+    ).scalars().all()
+    if unreferenced:
+        connection.execute(db.delete(table).where(table.c.name.in_(unreferenced)))
+        store = get_blob_store()
+        trashed = session.info.setdefault('trashed_blobs', [])
+        for name in unreferenced:
+            path = store.trash(name)
+            if path is not None:
+                trashed.append((name, path))
+
+@event.listens_for(db.session, 'after_commit')
+def purge_trashed_blobs(session):
+    store = get_blob_store()
+    for name, path in session.info.pop('trashed_blobs', ()):
+        store.purge(path)
+
+@event.listens_for(db.session, 'after_rollback')
+def restore_trashed_blobs(session):
+    store = get_blob_store()
+    for name, path in session.info.pop('trashed_blobs', ()):
+        store.restore(name, path)
+
+@app.cli.command('blobs-gc')
+def blobs_gc():
+    """Recount blob references and remove the blobs no product references."""
+    counts = Counter()
+    for column in BLOB_COLUMNS:
+        attribute = getattr(Product, column)
+        for value, count in db.session.query(attribute, func.count()).group_by(attribute):
+            for name in blob_names(column, value):
+                counts[name] += count
+    for blob in Blob.query.all():
+        blob.refcount = counts[blob.name]
+    db.session.flush()
+
+    store = get_blob_store()
+    unreferenced = [name for name, in db.session.query(Blob.name).filter(Blob.refcount <= 0)]
+    Blob.query.filter(Blob.name.in_(unreferenced)).delete(synchronize_session=False)
+    trashed = [(name, store.trash(name)) for name in unreferenced]
+    db.session.info.setdefault('trashed_blobs', []).extend((n, p) for n, p in trashed if p is not None)
+
+    # Files without a row are left over by failed requests. Recent ones may
+    # belong to a product being created, whose row is not committed yet.
+    known = {name for name, in db.session.query(Blob.name)}
+    grace = datetime.now().timestamp() - 3600
+    orphans = [name for name in store.names()
+               if name not in known and os.path.getmtime(store.path(name)) < grace]
+    for name in orphans:
+        path = store.trash(name)
+        if path is not None:
+            db.session.info['trashed_blobs'].append((name, path))
+    db.session.commit()
+    print(f'Removed {len(unreferenced)} unreferenced blobs and {len(orphans)} orphan files')
+
+@app.cli.command('uploads-expire')
+def uploads_expire():
+    """Remove the uploads not used by a product UPLOAD_EXPIRY seconds after their last chunk."""
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['UPLOAD_EXPIRY'])
+    # Idle, and not waiting for their hash_upload job
+    expired = (func.coalesce(Upload.updated_at, Upload.created_at) < cutoff, Upload.receiving_since.is_(None),
+               or_(Upload.stored_name.isnot(None), Upload.offset < Upload.size, Upload.size == 0))
+    removed = 0
+    for upload in Upload.query.filter(*expired).all():
+        path = (upload.partial_path if upload.stored_name is None
+                else os.path.join(app.config['UPLOAD_FOLDER'], upload.stored_name))
+        # Unless a PATCH took it since it was read
+        if db.session.execute(db.delete(Upload).where(Upload.id == upload.id, *expired)
+                              .execution_options(synchronize_session=False)).rowcount == 0:
+            continue
+        db.session.commit()
+        if os.path.exists(path):
+            os.remove(path)
+        removed += 1
+    db.session.commit()
+    print(f'Removed {removed} expired uploads')
+
+@app.cli.command('blobs-migrate')
+def blobs_migrate():
+    """Move product files stored under random names into the blob store."""
+    url_columns = {'files': 'file_url', 'image_name': 'image_url'}
+    folder = app.config['UPLOAD_FOLDER']
+    staged = []
+    with app.test_request_context():
+        for product in Product.query.all():
+            for column in url_columns:
+                name = getattr(product, column)
+                path = os.path.join(folder, name or '')
+                if not name or is_blob_name(name) or not os.path.isfile(path):
+                    continue
+                blob_name = stage_blob(path, hash_file(path), os.path.getsize(path),
+                                       os.path.splitext(name)[1], staged)
+                setattr(product, column, blob_name)
+                setattr(product, url_columns[column], get_external_url('get_blob', name=blob_name))
+        add_staged_blobs(staged)
+        db.session.commit()
+    print(f'Moved {len(staged)} files into the blob store')
+
+class Upload(db.Model):
+    """A resumable upload, received in chunks through PATCH /api/uploads/<id>."""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    offset = db.Column(db.BigInteger, nullable=False, default=0)
+    # Set once every byte is received and the file moved to the upload folder
+    stored_name = db.Column(db.String(255), nullable=True)
+    sha256 = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Time of the last chunk, see uploads-expire
+    updated_at = db.Column(db.DateTime, nullable=True)
+    # Set while a PATCH request appends to the partial file, so that a
+    # single request writes at a time
+    receiving_since = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def partial_path(self):
+        return os.path.join(app.config['UPLOAD_FOLDER'], PARTIAL_DIR, self.id)
+
+    @property
+    def processing(self):
+        """Whether every byte is received but the hash_upload job did not finish yet."""
+        return self.stored_name is None and 0 < self.size == self.offset
 
     def to_dict(self):
-        reviews = [
-            {
-                'id': review.id,
-                'userId': review.user_id,
-                'userName': review.user.name,
-                'rating': review.rating,
-                'comment': review.comment,
-                'createdAt': review.created_at.isoformat()
-            } for review in self.reviews
-        ]
-        review_count = len(reviews)
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'size': self.size,
+            'offset': self.offset,
+            'complete': self.stored_name is not None,
+            'processing': self.processing,
+            'sha256': self.sha256
+        }
+
+class Job(db.Model):
+    """A background job of job_queue, see jobs.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    # JSON keyword arguments of the task
+    payload = db.Column(db.Text, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    worker = db.Column(db.String(100), nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_job_status_run_after', 'status', 'run_after', 'id'),
+    )
 
+    def to_dict(self):
         return {
             'id': self.id,
-            'title': self.title,
-            'description': self.description,
-            'files': self.files,
-            'file_url': self.file_url,
-            'external_url': self.external_url,
-            'image_url': self.image_url,
-            'category': self.category,
-            'version': self.version,
-            'license': self.license,
-            'oncodash_version': self.oncodash_version,
-            'seller': {
-                'id': self.seller.id,
-                'name': self.seller.name
-            },
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'result': json.loads(self.result) if self.result else None,
+            # Only the exception line, the traceback stays in the database
+            'error': self.error.strip().splitlines()[-1] if self.error else None,
             'created_at': self.created_at.isoformat(),
-            'reviews': reviews,
-            'reviewCount': review_count
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
         }
 
-# Create database tables
-with app.app_context():
-    db.create_all()
+job_queue = JobQueue(db, Job, retry_delay=app.config['JOB_RETRY_DELAY'],
+                     timeout=app.config['JOB_TIMEOUT'], eager=app.config['JOBS_EAGER'])
+
+class CatalogState(db.Model):
+    """Single row holding the catalog generation, bumped by every catalog write."""
+    id = db.Column(db.Integer, primary_key=True)
+    # Random per-database value so ETags never collide after a database reset
+    epoch = db.Column(db.String(32), nullable=False)
+    generation = db.Column(db.BigInteger, nullable=False, default=0)
+
+@event.listens_for(CatalogState.__table__, 'after_create')
+def init_catalog_state(target, connection, **kw):
+    connection.execute(target.insert().values(id=1, epoch=uuid.uuid4().hex[:12], generation=0))
+
+class CatalogChange(db.Model):
+    """Cache tags touched by each catalog generation, see sync_response_cache()."""
+    generation = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    tags = db.Column(db.Text, nullable=False)
+
+def bump_catalog_generation(connection):
+    table = CatalogState.__table__
+    connection.execute(db.update(table).values(generation=table.c.generation + 1))
+    return connection.execute(db.select(table.c.generation)).scalar()
+
+def record_catalog_change(connection, tags):
+    """Bump the catalog generation and log the cache tags it invalidates."""
+    generation = bump_catalog_generation(connection)
+    table = CatalogChange.__table__
+    connection.execute(table.insert().values(generation=generation, tags=json.dumps(sorted(tags))))
+    connection.execute(table.delete().where(table.c.generation <= generation - CATALOG_CHANGE_LOG_SIZE))
+    return generation
+
+class CatalogSnapshot(db.Model):
+    """Single row recording the catalog generation the snapshot entries are up to date with.
+
+    Every catalog write re-renders the CatalogSnapshotEntry rows of the
+    titles it touches in its transaction, see update_catalog_snapshot(), and
+    moves the row to its generation. Workers assemble and compress the
+    listing from the entries, see load_catalog_snapshot(). The row is
+    missing until the first write or rebuild.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    epoch = db.Column(db.String(32), nullable=False)
+    generation = db.Column(db.BigInteger, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CatalogSnapshotEntry(db.Model):
+    """The latest version of a title, rendered as it appears in the product listing."""
+    title = db.Column(db.String(100), primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+
+def catalog_state():
+    """Return the (epoch, generation) of the catalog, shared by all workers."""
+    table = CatalogState.__table__
+    with db.engine.connect() as connection:
+        return connection.execute(db.select(table.c.epoch, table.c.generation)).first()
+
+def catalog_change_tags(session):
+    """Cache tags of the products, titles and sellers touched by the pending flush."""
+    tags = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if obj in session.dirty and not session.is_modified(obj):
+            continue
+        if isinstance(obj, Product):
+            state = db.inspect(obj)
+            titles = [obj.title, *state.attrs.title.history.deleted]
+            sellers = [obj.seller_id, *state.attrs.seller_id.history.deleted]
+            tags.add(f'product:{obj.id}')
+            tags.update(f'title:{title}' for title in titles)
+            tags.update(f'seller:{seller}' for seller in sellers)
+        elif isinstance(obj, Review):
+            tags.add(f'product:{obj.product_id}')
+    return tags
+
+@event.listens_for(db.session, 'after_flush')
+def track_catalog_writes(session, flush_context):
+    tags = catalog_change_tags(session)
+    if tags:
+        generation = record_catalog_change(session.connection(), tags | {'catalog'})
+        # The generation of the snapshot when it is up to date with the
+        # writes committed before this transaction
+        session.info.setdefault('snapshot_base', generation - 1)
+        session.info.setdefault('snapshot_tags', set()).update(tags)
+
+def render_catalog_entries(connection, titles=None):
+    """Render the listing entries of the given titles (all when None) from the live tables."""
+    query = (db.select(*PRODUCT_COLUMNS)
+             .join_from(Product, User, User.id == Product.seller_id)
+             .where(Product.is_latest))
+    if titles is not None:
+        query = query.where(Product.title.in_(titles))
+    rows = connection.execute(query).all()
+    return [{'title': row.title, 'product_id': row.id, 'body': app.json.dumps(product)}
+            for row, product in zip(rows, PRODUCT_SCHEMA.dump_many(rows))]
+
+def write_catalog_snapshot(connection):
+    """Record that the snapshot entries are at the current catalog generation."""
+    table = CatalogSnapshot.__table__
+    state = connection.execute(db.select(CatalogState.__table__.c.epoch, CatalogState.__table__.c.generation)).first()
+    values = dict(epoch=state.epoch, generation=state.generation, updated_at=datetime.utcnow())
+    if connection.execute(db.update(table).where(table.c.id == 1).values(**values)).rowcount == 0:
+        connection.execute(table.insert().values(id=1, **values))
+
+def refresh_catalog_snapshot(connection, titles=None):
+    """Re-render the entries of the given titles (all when None), at the current generation."""
+    entries = CatalogSnapshotEntry.__table__
+    delete = entries.delete()
+    if titles is not None:
+        delete = delete.where(entries.c.title.in_(titles))
+    connection.execute(delete)
+    rendered = render_catalog_entries(connection, titles)
+    if rendered:
+        connection.execute(entries.insert(), rendered)
+    write_catalog_snapshot(connection)
+
+def sync_catalog_snapshot(connection, tags, base):
+    """Refresh the snapshot entries of the products and titles in cache `tags`.
+
+    `base` is the catalog generation before the changes. When the snapshot
+    is at another one, writes that did not record their changes left it
+    behind, and it is rebuilt entirely.
+    """
+    titles = {tag.split(':', 1)[1] for tag in tags if tag.startswith('title:')}
+    product_ids = [int(tag.split(':', 1)[1]) for tag in tags if tag.startswith('product:')]
+    if product_ids:
+        titles.update(connection.execute(
+            db.select(Product.__table__.c.title).where(Product.__table__.c.id.in_(product_ids))).scalars())
+    table = CatalogSnapshot.__table__
+    if connection.execute(db.select(table.c.generation)).scalar() == base:
+        refresh_catalog_snapshot(connection, titles)
+    else:
+        refresh_catalog_snapshot(connection)
+
+@event.listens_for(db.session, 'before_commit')
+def update_catalog_snapshot(session):
+    session.flush()
+    tags = session.info.pop('snapshot_tags', None)
+    base = session.info.pop('snapshot_base', None)
+    if tags:
+        sync_catalog_snapshot(session.connection(), tags, base)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_catalog_snapshot_changes(session, previous_transaction):
+    session.info.pop('snapshot_tags', None)
+    session.info.pop('snapshot_base', None)
+
+@app.cli.command('catalog-rebuild')
+def catalog_rebuild():
+    """Rebuild the catalog snapshot from the live tables."""
+    refresh_catalog_snapshot(db.session.connection())
+    db.session.commit()
+    print(f'Catalog snapshot rebuilt with {CatalogSnapshotEntry.query.count()} titles')
+
+@app.cli.command('catalog-check')
+def catalog_check():
+    """Compare the catalog snapshot with the live tables, exit with status 1 when they differ."""
+    problems = catalog_snapshot_problems(db.session.connection())
+    for problem in problems:
+        print(problem)
+    if problems:
+        print(f'{len(problems)} problems, run catalog-rebuild to fix them')
+        sys.exit(1)
+    print('Catalog snapshot is consistent')
+
+def catalog_snapshot_problems(connection):
+    """Differences between the snapshot and the live tables, as messages."""
+    entries = CatalogSnapshotEntry.__table__
+    stored = {row.title: row for row in connection.execute(db.select(entries))}
+    live = {entry['title']: entry for entry in render_catalog_entries(connection)}
+    problems = []
+    for title in sorted(stored.keys() | live.keys()):
+        if title not in live:
+            problems.append(f'{title}: in the snapshot but not in the catalog')
+        elif title not in stored:
+            problems.append(f'{title}: missing from the snapshot')
+        elif (stored[title].product_id, stored[title].body) != (live[title]['product_id'], live[title]['body']):
+            problems.append(f'{title}: stale, product {stored[title].product_id} in the snapshot, '
+                            f'{live[title]["product_id"]} in the catalog')
+    snapshot = connection.execute(db.select(CatalogSnapshot.__table__)).first()
+    state = connection.execute(db.select(CatalogState.__table__.c.epoch, CatalogState.__table__.c.generation)).first()
+    if snapshot is None:
+        problems.append('The snapshot was never built')
+    elif (snapshot.epoch, snapshot.generation) != (state.epoch, state.generation):
+        problems.append(f'The snapshot is at generation {snapshot.generation}, '
+                        f'the catalog at {state.generation}')
+    return problems
+
+# Product columns of an export, the others being derived from them
+EXPORT_PRODUCT_COLUMNS = (
+    'id', 'title', 'version', 'description', 'category', 'license', 'oncodash_version', 'price',
+    'seller_id', 'created_at', 'files', 'file_url', 'file_size', 'file_sha256', 'file_status',
+    'external_url', 'image_name', 'image_url', 'image_variants', 'thumbnail_url',
+)
+# Password of imported users, which no password matches until they reset it
+IMPORTED_PASSWORD = '!'
+
+def export_catalog(connection):
+    """Yield the records of an export of the catalog, in the order of bulk.RECORD_TYPES."""
+    yield {'type': 'header', 'format': EXPORT_FORMAT, 'exported_at': datetime.utcnow()}
+    products = Product.__table__
+    queries = (
+        ('blob', db.select(Blob.name, Blob.sha256, Blob.size).order_by(Blob.name)),
+        ('user', db.select(User.id, User.name, User.email, User.created_at).order_by(User.id)),
+        ('product', db.select(*[products.c[name] for name in EXPORT_PRODUCT_COLUMNS]).order_by(products.c.id)),
+        ('review', db.select(Review.id, Review.product_id, Review.user_id, Review.rating,
+                             Review.comment, Review.created_at).order_by(Review.id)),
+    )
+    for kind, query in queries:
+        for row in connection.execution_options(yield_per=1000).execute(query):
+            record = {'type': kind, **row._mapping}
+            if kind == 'product':
+                record['image_variants'] = json.loads(row.image_variants) if row.image_variants else []
+            yield record
+
+def imported_datetime(value):
+    return datetime.fromisoformat(value) if value else datetime.utcnow()
+
+def imported_product(record, seller_id):
+    """Column values of a product record, with the URLs of its blobs pointing to this instance."""
+    values = {name: record.get(name) for name in EXPORT_PRODUCT_COLUMNS if name != 'id'}
+    values['title'], values['version'] = record['title'], record['version']
+    values.update(seller_id=seller_id, created_at=imported_datetime(record.get('created_at')),
+                  price=values['price'] or 0.0, image_name=values['image_name'] or '',
+                  version_key=version_key(record['version']),
+                  version_prerelease=prerelease_key(record['version']))
+    values['compat_min_key'], values['compat_max_key'] = compat_keys(values['oncodash_version'])
+    # Source URL -> URL on this instance
+    urls = {}
+    for column, url_column in (('files', 'file_url'), ('image_name', 'image_url')):
+        if is_blob_name(values[column]):
+            url = get_external_url('get_blob', name=values[column])
+            urls[values[url_column]] = url
+            values[url_column] = url
+    variants = record.get('image_variants') or []
+    for variant in variants:
+        url = get_external_url('get_blob', name=variant['name'])
+        urls[variant['url']] = url
+        variant['url'] = url
+    values['image_variants'] = json.dumps(variants) if variants else None
+    values['thumbnail_url'] = urls.get(values['thumbnail_url'], values['thumbnail_url'])
+    return values
+
+def import_catalog(records, batch_size=1000):
+    """Insert the users, products and reviews of an export that this catalog lacks.
+
+    Users are matched by email, products by title and version, and reviews
+    by product, author and creation time. Existing ones are left as they
+    are, so importing an export again adds nothing, while the reviews added
+    to existing products since a previous import are. Imported users have no
+    usable password until they reset it. Records are inserted in batches of
+    `batch_size`, each committed with its catalog changes, so an interrupted
+    import can simply be run again.
+
+    Returns the counts of imported and skipped records, and the manifest
+    records of the blobs referenced by imported products but missing from
+    the blob store.
+    """
+    counts = Counter()
+    user_ids = {}
+    product_ids = {}
+    manifest = {}
+    referenced = set()
+    for kind, batch in batches(records, batch_size):
+        try:
+            if kind == 'blob':
+                manifest.update((record['name'], record) for record in batch)
+            elif kind == 'user':
+                import_users(batch, user_ids, counts)
+            elif kind == 'product':
+                referenced.update(import_products(batch, user_ids, product_ids, manifest, counts))
+            elif kind == 'review':
+                import_reviews(batch, user_ids, product_ids, counts)
+        except (KeyError, TypeError, ValueError) as e:
+            db.session.rollback()
+            raise ValueError(f'Invalid {kind} record: {e!r}')
+        db.session.commit()
+    store = get_blob_store()
+    missing = [manifest.get(name, {'type': 'blob', 'name': name}) for name in sorted(referenced)
+               if not store.exists(name)]
+    return counts, missing
+
+def import_users(batch, user_ids, counts):
+    connection = db.session.connection()
+    table = User.__table__
+    emails = {record['email'] for record in batch}
+
+    def existing():
+        return dict(connection.execute(db.select(table.c.email, table.c.id).where(table.c.email.in_(emails))).all())
+
+    known = existing()
+    rows = {}
+    for record in batch:
+        if record['email'] in known or record['email'] in rows:
+            counts['users_skipped'] += 1
+            continue
+        rows[record['email']] = {'name': record['name'], 'email': record['email'], 'password': IMPORTED_PASSWORD,
+                                 'token_version': 0, 'created_at': imported_datetime(record.get('created_at'))}
+    if rows:
+        connection.execute(table.insert(), list(rows.values()))
+        counts['users'] += len(rows)
+        known = existing()
+    for record in batch:
+        user_ids[record['id']] = known[record['email']]
+
+def import_products(batch, user_ids, product_ids, manifest, counts):
+    """Insert the new products of `batch` and return the names of the blobs they reference."""
+    connection = db.session.connection()
+    table = Product.__table__
+    titles = {record['title'] for record in batch}
+
+    def existing():
+        return {(title, version): id for id, title, version in connection.execute(
+            db.select(table.c.id, table.c.title, table.c.version).where(table.c.title.in_(titles)))}
+
+    known = existing()
+    rows = {}
+    for record in batch:
+        key = (record['title'], record['version'])
+        if key in known or key in rows or record['seller_id'] not in user_ids:
+            counts['products_skipped'] += 1
+            continue
+        rows[key] = imported_product(record, user_ids[record['seller_id']])
+    if rows:
+        connection.execute(table.insert(), list(rows.values()))
+        counts['products'] += len(rows)
+        known = existing()
+    # Existing products too, so that their reviews are imported
+    for record in batch:
+        key = (record['title'], record['version'])
+        if key in known:
+            product_ids[record['id']] = known[key]
+    if not rows:
+        return set()
+    refresh_latest_versions(connection, {title for title, _ in rows})
+
+    # Reference the blobs as update_blob_references() would
+    references = Counter()
+    for values in rows.values():
+        for column in BLOB_COLUMNS:
+            references.update(blob_names(column, values[column]))
+    blobs = Blob.__table__
+    for name, count in references.items():
+        entry = manifest.get(name)
+        if entry is not None:
+            connection.execute(insert_ignore(blobs).values(name=name, sha256=entry['sha256'], size=entry['size'],
+                                                           refcount=0, created_at=datetime.utcnow()))
+        connection.execute(db.update(blobs).where(blobs.c.name == name).values(refcount=blobs.c.refcount + count))
+
+    tags = {f'title:{title}' for title, _ in rows} | {f'seller:{values["seller_id"]}' for values in rows.values()}
+    generation = record_catalog_change(connection, tags | {'catalog'})
+    sync_catalog_snapshot(connection, tags, generation - 1)
+    return set(references)
+
+def import_reviews(batch, user_ids, product_ids, counts):
+    connection = db.session.connection()
+    table = Review.__table__
+    targets = {product_ids[record['product_id']] for record in batch if record['product_id'] in product_ids}
+    # (product, author, creation time) of the reviews already there
+    known = set(connection.execute(db.select(table.c.product_id, table.c.user_id, table.c.created_at)
+                                   .where(table.c.product_id.in_(targets))).all()) if targets else set()
+    rows = []
+    for record in batch:
+        if record['product_id'] not in product_ids or record['user_id'] not in user_ids:
+            counts['reviews_skipped'] += 1
+            continue
+        row = {'product_id': product_ids[record['product_id']], 'user_id': user_ids[record['user_id']],
+               'rating': int(record['rating']), 'comment': record['comment'],
+               'created_at': imported_datetime(record.get('created_at'))}
+        key = (row['product_id'], row['user_id'], row['created_at'])
+        if key in known:
+            counts['reviews_skipped'] += 1
+            continue
+        known.add(key)
+        rows.append(row)
+    if not rows:
+        return
+    connection.execute(table.insert(), rows)
+    counts['reviews'] += len(rows)
+    touched = {row['product_id'] for row in rows}
+    update_rating_aggregates(touched)
+    tags = {f'product:{id}' for id in touched}
+    generation = record_catalog_change(connection, tags | {'catalog'})
+    sync_catalog_snapshot(connection, tags, generation - 1)
+
+@app.cli.command('catalog-export')
+@click.argument('path', default='-')
+def catalog_export(path):
+    """Write an NDJSON export of the catalog to PATH, - for the standard output."""
+    with db.engine.connect() as connection:
+        with click.open_file(path, 'w') as f:
+            for record in export_catalog(connection):
+                f.write(app.json.dumps(record) + '\n')
+
+@app.cli.command('catalog-import')
+@click.argument('source')
+@click.option('--blobs', help='Blob store folder or instance URL to copy missing blobs from, '
+                              'by default the instance SOURCE is the URL of')
+@click.option('--token', envvar='SOURCE_ADMIN_TOKEN', help='Admin token of the SOURCE instance')
+@click.option('--batch-size', type=int, default=lambda: app.config['IMPORT_BATCH_SIZE'])
+def catalog_import(source, blobs, token, batch_size):
+    """Import an NDJSON export from SOURCE: a file, - for the standard input, or the URL of an instance to mirror."""
+    if is_url(source):
+        blobs = blobs or source
+        export = urllib.request.Request(f'{source.rstrip("/")}/api/export',
+                                        headers={'Authorization': f'Bearer {token or ""}'})
+        lines = urllib.request.urlopen(export, timeout=60)
+    else:
+        lines = click.open_file(source, 'rb')
+    with lines, app.test_request_context():
+        counts, missing = import_catalog(read_records(lines, app.json.loads), batch_size)
+    print(', '.join(f'{count} {name.replace("_", " ")}' for name, count in sorted(counts.items()))
+          or 'Nothing to import')
+
+    fetched = 0
+    if blobs and missing:
+        source = blob_source(blobs)
+        store = get_blob_store()
+        incoming = os.path.join(app.config['UPLOAD_FOLDER'], INCOMING_DIR)
+        for entry in missing:
+            try:
+                fetch_blob(source, entry['name'], entry['sha256'], entry['size'], store, incoming)
+                register_blob(entry['name'], entry['sha256'], entry['size'])
+                db.session.commit()
+                fetched += 1
+            except (KeyError, OSError, ValueError) as e:
+                print(f'Cannot copy blob {entry["name"]}: {e}')
+    print(f'{fetched} blobs copied, {len(missing) - fetched} missing')
+
+def version_order():
+    """ORDER BY clauses putting the newest version of a title first."""
+    return Product.version_key.desc(), Product.version_prerelease.desc(), Product.id.desc()
+
+def refresh_latest_versions(connection, titles):
+    """Recompute the is_latest flag of every version of the given titles."""
+    table = Product.__table__
+    for title in titles:
+        latest = (db.select(table.c.id)
+                  .where(table.c.title == title)
+                  .order_by(table.c.version_key.desc(), table.c.version_prerelease.desc(), table.c.id.desc())
+                  .limit(1)
+                  .scalar_subquery())
+        connection.execute(
+            db.update(table).where(table.c.title == title).values(is_latest=(table.c.id == latest))
+        )
+
+@event.listens_for(db.session, 'after_flush')
+def update_latest_versions(session, flush_context):
+    titles = set()
+    for product in session.new | session.deleted:
+        if isinstance(product, Product):
+            titles.add(product.title)
+    for product in session.dirty:
+        if isinstance(product, Product):
+            for attr in ('title', 'version'):
+                history = db.inspect(product).attrs[attr].history
+                if history.has_changes():
+                    titles.update([product.title, *history.deleted])
+    if titles:
+        refresh_latest_versions(session.connection(), titles)
+        session.info.setdefault('refreshed_titles', set()).update(titles)
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def expire_latest_versions(session, flush_context):
+    titles = session.info.pop('refreshed_titles', None)
+    if titles:
+        for product in session.identity_map.values():
+            if isinstance(product, Product) and product.title in titles:
+                session.expire(product, ['is_latest'])
+
+@app.cli.command('backfill-versions')
+def backfill_versions():
+    """Fill the version sort keys and is_latest flags of existing products."""
+    for product in Product.query.all():
+        product.validate_version('version', product.version)
+    db.session.flush()
+    titles = [title for title, in db.session.query(Product.title).distinct()]
+    refresh_latest_versions(db.session.connection(), titles)
+    bump_catalog_generation(db.session.connection())
+    refresh_catalog_snapshot(db.session.connection())
+    db.session.commit()
+    print(f'Version keys updated for {len(titles)} titles')
+
+def update_rating_aggregates(product_ids=None, connection=None):
+    """Recompute the rating aggregates of the given products (all when None) from their reviews.
+
+    Runs in the session transaction, or on `connection` when given.
+    """
+    product, review = Product.__table__, Review.__table__
+    count = db.select(func.count(review.c.id)).where(review.c.product_id == product.c.id).scalar_subquery()
+    total = (db.select(func.coalesce(func.sum(review.c.rating), 0))
+             .where(review.c.product_id == product.c.id).scalar_subquery())
+    counts = db.update(product).values(review_count=count, rating_sum=total)
+    averages = db.update(product).values(rating_avg=db.case(
+        (product.c.review_count > 0, product.c.rating_sum * 1.0 / product.c.review_count),
+        else_=0.0
+    ))
+    if product_ids is not None:
+        counts = counts.where(product.c.id.in_(product_ids))
+        averages = averages.where(product.c.id.in_(product_ids))
+    executor = connection if connection is not None else db.session
+    executor.execute(counts)
+    executor.execute(averages)
+
+@app.cli.command('backfill-ratings')
+def backfill_ratings():
+    """Fill review_count, rating_sum and rating_avg from the existing reviews."""
+    update_rating_aggregates()
+    bump_catalog_generation(db.session.connection())
+    refresh_catalog_snapshot(db.session.connection())
+    db.session.commit()
+    print('Rating aggregates updated')
+
+# Full-text index over the searchable product fields. It is an external
+# content FTS5 table kept in sync by triggers, so every write path updates
+# it incrementally inside its own transaction.
+PRODUCT_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(
+        title, description, category,
+        content='product', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, title, description, category)
+        VALUES (new.id, new.title, new.description, new.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, title, description, category)
+        VALUES ('delete', old.id, old.title, old.description, old.category);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF title, description, category ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, title, description, category)
+        VALUES ('delete', old.id, old.title, old.description, old.category);
+        INSERT INTO product_fts(rowid, title, description, category)
+        VALUES (new.id, new.title, new.description, new.category);
+    END""",
+]
+# Column weights for bm25(), in the column order of product_fts
+PRODUCT_FTS_WEIGHTS = (10.0, 1.0, 2.0)
+
+for ddl in PRODUCT_FTS_DDL:
+    event.listen(Product.__table__, 'after_create', DDL(ddl).execute_if(dialect='sqlite'))
+event.listen(Product.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS product_fts').execute_if(dialect='sqlite'))
+
+# On PostgreSQL, the same fields are searched through a weighted tsvector,
+# A to C in decreasing weight, with a GIN index over that expression. The
+# 'simple' configuration neither stems nor drops stop words, like FTS5.
+PRODUCT_TSVECTOR = ("setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+                    "setweight(to_tsvector('simple', coalesce(category, '')), 'B') || "
+                    "setweight(to_tsvector('simple', coalesce(description, '')), 'C')")
+PRODUCT_TSVECTOR_INDEX_DDL = f'CREATE INDEX IF NOT EXISTS ix_product_search ON product USING gin (({PRODUCT_TSVECTOR}))'
+
+event.listen(Product.__table__, 'after_create', DDL(PRODUCT_TSVECTOR_INDEX_DDL).execute_if(dialect='postgresql'))
+
+@app.cli.command('search-reindex')
+def search_reindex():
+    """Create the product search index if needed and rebuild it from the product table."""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text(PRODUCT_TSVECTOR_INDEX_DDL))
+        db.session.execute(db.text('REINDEX INDEX ix_product_search'))
+    else:
+        for ddl in PRODUCT_FTS_DDL:
+            db.session.execute(db.text(ddl))
+        db.session.execute(db.text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    print('Search index rebuilt')
+
+def fts_match_expression(query):
+    """Turn free text into an FTS5 query where every term is a quoted prefix."""
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+class SchemaMigration(db.Model):
+    """A migration of `migrations` applied to this database, see migrations.py."""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+# The schema is only changed by `flask --app app db-upgrade`, run once per
+# deployment, so workers start without inspecting or creating tables.
+migrations = Migrations(db, SchemaMigration)
+
+def add_columns(connection, table, *names):
+    """Add the named columns of a model table unless they already exist."""
+    existing = {column['name'] for column in db.inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = (f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+               f'{column.type.compile(connection.dialect)}')
+        if column.server_default is not None:
+            ddl += f" DEFAULT '{column.server_default.arg}'"
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        connection.execute(db.text(ddl))
+
+def create_indexes(connection, table, *names):
+    """Create the named indexes of a model table unless they already exist."""
+    indexes = {index.name: index for index in table.indexes}
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+@migrations.migration(1, 'Create the tables missing from the database')
+def create_tables(connection):
+    db.metadata.create_all(connection)
+
+@migrations.migration(2, 'Index the product seller and the review author')
+def add_lookup_indexes(connection):
+    # Title, category, oncodash_version and review product lookups are
+    # served by the composite indexes of migration 5
+    create_indexes(connection, Product.__table__, 'ix_product_seller_id')
+    create_indexes(connection, Review.__table__, 'ix_review_user_id')
+
+def update_version_keys(connection):
+    """Recompute the version sort keys, once per version string, and the is_latest flags of every title."""
+    table = Product.__table__
+    versions = connection.execute(db.select(table.c.version).distinct()).scalars().all()
+    for version in versions:
+        connection.execute(db.update(table).where(table.c.version == version).values(
+            version_key=version_key(version), version_prerelease=prerelease_key(version)))
+    refresh_latest_versions(connection, connection.execute(db.select(table.c.title).distinct()).scalars().all())
+
+@migrations.migration(3, 'Add the token version of users')
+def add_token_version(connection):
+    add_columns(connection, User.__table__, 'token_version')
+
+@migrations.migration(4, 'Add the rating, version, file and image columns of products')
+def add_product_columns(connection):
+    table = Product.__table__
+    add_columns(connection, table, 'review_count', 'rating_sum', 'rating_avg', 'version_key',
+                'version_prerelease', 'is_latest', 'file_size', 'file_sha256', 'file_status',
+                'image_variants', 'thumbnail_url')
+    # Same as backfill-versions and backfill-ratings
+    update_version_keys(connection)
+    update_rating_aggregates(connection=connection)
+    bump_catalog_generation(connection)
+
+@migrations.migration(5, 'Index the product listing, version and review lookups')
+def add_listing_indexes(connection):
+    create_indexes(connection, Product.__table__, 'ix_product_title_version_key', 'ix_product_latest_title',
+                   'ix_product_latest_created_at', 'ix_product_latest_rating_avg', 'ix_product_latest_category',
+                   'ix_product_latest_seller', 'ix_product_latest_oncodash_version', 'ix_product_latest_license')
+    create_indexes(connection, Review.__table__, 'ix_review_product_created_at')
+
+@migrations.migration(6, 'Create the product search index')
+def add_search_index(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text(PRODUCT_TSVECTOR_INDEX_DDL))
+    elif connection.dialect.name == 'sqlite':
+        for ddl in PRODUCT_FTS_DDL:
+            connection.execute(db.text(ddl))
+        connection.execute(db.text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')"))
+
+@migrations.migration(7, 'Add the catalog snapshot')
+def add_catalog_snapshot(connection):
+    CatalogSnapshotEntry.__table__.create(connection, checkfirst=True)
+    CatalogSnapshot.__table__.create(connection, checkfirst=True)
+    refresh_catalog_snapshot(connection)
+
+@migrations.migration(8, 'Index the Oncodash versions compatible with products')
+def add_compat_keys(connection):
+    table = Product.__table__
+    add_columns(connection, table, 'compat_min_key', 'compat_max_key')
+    create_indexes(connection, table, 'ix_product_compat')
+    specs = connection.execute(db.select(table.c.oncodash_version).distinct()).scalars().all()
+    for spec in specs:
+        min_key, max_key = compat_keys(spec)
+        connection.execute(db.update(table).where(table.c.oncodash_version.is_(None) if spec is None
+                                                  else table.c.oncodash_version == spec)
+                           .values(compat_min_key=min_key, compat_max_key=max_key))
+
+@migrations.migration(9, 'Order prereleases and four-part versions by semantic version precedence')
+def reorder_versions(connection):
+    update_version_keys(connection)
+    bump_catalog_generation(connection)
+    refresh_catalog_snapshot(connection)
+
+@migrations.migration(10, 'Add the activity and claim times of uploads')
+def add_upload_times(connection):
+    add_columns(connection, Upload.__table__, 'updated_at', 'receiving_since')
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+    """Apply the pending schema migrations."""
+    applied = migrations.upgrade()
+    print(f'Applied {len(applied)} migrations, the database is at version {migrations.head}')
+
+@app.cli.command('db-status')
+def db_status():
+    """List the schema migrations not applied yet."""
+    pending = migrations.pending()
+    for version in pending:
+        print(f'{version}: {migrations.steps[version][0]}')
+    print(f'{len(pending)} pending migrations')
+
+def latest_products_query():
+    # The latest version of every title is flagged on write, and rows are
+    # selected with the seller name joined in, so the listing runs in a
+    # single indexed query whatever the size of the catalog.
+    return product_rows().filter(Product.is_latest).order_by(Product.title)
+
+def compatible_products_query(key, titles=None):
+    """Rows of the newest version of every title compatible with the Oncodash version `key`.
+
+    The range scan of ix_product_compat finds the compatible versions, and
+    a window function keeps the newest one per title, in a single query.
+    Only the given `titles` are resolved unless it is None.
+    """
+    compatible = db.select(Product.id, func.row_number().over(partition_by=Product.title,
+                                                              order_by=version_order()).label('rank')) \
+        .where(Product.compat_min_key <= key, Product.compat_max_key > key)
+    if titles is not None:
+        compatible = compatible.where(Product.title.in_(titles))
+    ranked = compatible.subquery()
+    return (product_rows().add_columns(Product.is_latest)
+            .join(ranked, ranked.c.id == Product.id)
+            .filter(ranked.c.rank == 1)
+            .order_by(Product.title))
+
+def update_check_etag(state, installed, oncodash_version):
+    """ETag of an update check: the catalog generation and a digest of the checked set."""
+    checked = json.dumps([sorted(installed), oncodash_version], separators=(',', ':'))
+    return f'{state.epoch}-{state.generation}-{hashlib.sha256(checked.encode()).hexdigest()[:16]}'
+
+PRODUCT_FILTERS = ('category', 'oncodash_version', 'license', 'seller_id')
+PRODUCT_SORTS = ('title', 'newest', 'rating')
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Installed products checked by a single POST /api/updates/check
+MAX_UPDATE_CHECK_SIZE = 1000
+
+def search_products_query(query):
+    """Return the latest products matching every term of `query` as a prefix, best matches first."""
+    terms = re.findall(r'\w+', query)
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        weights = ', '.join(str(w) for w in PRODUCT_FTS_WEIGHTS)
+        matches = db.text(
+            f'SELECT rowid, bm25(product_fts, {weights}) AS score '
+            'FROM product_fts WHERE product_fts MATCH :match'
+        ).columns(rowid=db.Integer, score=db.Float).bindparams(match=fts_match_expression(query)).subquery()
+        return (latest_products_query()
+                .join(matches, matches.c.rowid == Product.id)
+                .order_by(None)
+                .order_by(matches.c.score, Product.id))
+    if dialect == 'postgresql':
+        tsquery = "to_tsquery('simple', :tsquery)"
+        return (latest_products_query()
+                .filter(db.text(f'({PRODUCT_TSVECTOR}) @@ {tsquery}'))
+                .order_by(None)
+                .order_by(db.text(f'ts_rank({PRODUCT_TSVECTOR}, {tsquery}) DESC'), Product.id)
+                .params(tsquery=' & '.join(f'{term}:*' for term in terms)))
+    # Unindexed fallback for other databases
+    products = latest_products_query()
+    for term in terms:
+        pattern = f'%{term}%'
+        products = products.filter(or_(Product.title.ilike(pattern), Product.description.ilike(pattern),
+                                       Product.category.ilike(pattern)))
+    return products
+
+def encode_cursor(value, id):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, id]).encode()).decode()
+
+def decode_cursor(cursor, sort):
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == 'newest':
+            value = datetime.fromisoformat(value)
+        return value, int(id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+def sort_products_query(query, sort):
+    """Return the query joined with what `sort` needs, its sort key and direction."""
+    if sort == 'newest':
+        return query, Product.created_at, True
+    if sort == 'rating':
+        return query, Product.rating_avg, True
+    return query, Product.title, False
+
+def paginate_products(query, sort='title', cursor=None, limit=None):
+    """Keyset pagination over `query`, ordered by `sort` then by id.
+
+    Returns the product rows of the page and the cursor of the next page,
+    which is None on the last page.
+    """
+    query, key, descending = sort_products_query(query.order_by(None), sort)
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        if descending:
+            query = query.filter(or_(key < value, and_(key == value, Product.id < last_id)))
+        else:
+            query = query.filter(or_(key > value, and_(key == value, Product.id > last_id)))
+    if descending:
+        query = query.order_by(key.desc(), Product.id.desc())
+    else:
+        query = query.order_by(key.asc(), Product.id.asc())
+    query = query.add_columns(key.label('sort_key'))
+
+    if limit is None:
+        return query.all(), None
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].sort_key, rows[-1].id)
+    return rows, next_cursor
 
 def get_external_url(endpoint, **values):
     return f"{HOST}{url_for(endpoint, **values)}"
 
+def send_stored_file(name, download_name=None, etag=True, max_age=None):
+    """Send a file of the upload folder, with Range and conditional request support.
+
+    With X_ACCEL_REDIRECT_PREFIX set, the body is left to nginx. Otherwise
+    Flask sends the file itself, through X-Sendfile when USE_X_SENDFILE is
+    set, or through the WSGI server's file wrapper (sendfile in gunicorn).
+    """
+    path = os.path.join(app.config['UPLOAD_FOLDER'], *name.split('/'))
+    if not os.path.isfile(path):
+        return jsonify({'message': 'File not found'}), 404
+
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        response = app.response_class(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{name}"
+        if download_name:
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        if isinstance(etag, str):
+            response.set_etag(etag)
+        if max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        return response
+
+    return send_file(path, as_attachment=download_name is not None, download_name=download_name,
+                     conditional=True, etag=etag, max_age=max_age)
+
+# Archives checked by the validate_archive job
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+@job_queue.task('process_image')
+def process_product_image(product_id):
+    """Store resized variants of the image of a product and record them on the product."""
+    product = db.session.get(Product, product_id)
+    if product is None or not is_blob_name(product.image_name) or not images.available():
+        return None
+    try:
+        variants = images.make_variants(get_blob_store().path(product.image_name))
+    except OSError:
+        # Not an image, retrying would not help
+        app.logger.warning('Cannot read the image of product %s', product_id)
+        return {'variants': 0}
+
+    incoming = os.path.join(app.config['UPLOAD_FOLDER'], INCOMING_DIR)
+    os.makedirs(incoming, exist_ok=True)
+    staged = []
+    recorded = []
+    for variant in variants:
+        path = os.path.join(incoming, uuid.uuid4().hex)
+        with open(path, 'wb') as f:
+            f.write(variant['data'])
+        name = stage_blob(path, hashlib.sha256(variant['data']).hexdigest(), len(variant['data']),
+                          variant['extension'], staged)
+        recorded.append({
+            'width': variant['width'],
+            'height': variant['height'],
+            'format': variant['format'],
+            'name': name,
+            'url': get_external_url('get_blob', name=name)
+        })
+    thumbnails = [variant for variant in recorded if variant['format'] == 'webp']
+    thumbnail = min(thumbnails, key=lambda variant: abs(variant['width'] - images.THUMBNAIL_WIDTH))
+    product.image_variants = json.dumps(recorded)
+    product.thumbnail_url = thumbnail['url']
+    add_staged_blobs(staged)
+    db.session.commit()
+    return {'variants': len(recorded)}
+
+def archive_problem(path):
+    """Return why the archive at `path` is unusable, or None when it can be extracted safely."""
+    def unsafe(name):
+        return os.path.isabs(name) or '..' in name.replace('\\', '/').split('/')
+
+    try:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                if any(unsafe(name) for name in archive.namelist()):
+                    return 'Archive members escape the extraction folder'
+                corrupted = archive.testzip()
+                return f'Corrupted archive member: {corrupted}' if corrupted else None
+        with tarfile.open(path) as archive:
+            for member in archive:
+                if unsafe(member.name) or (member.issym() or member.islnk()) and unsafe(member.linkname):
+                    return 'Archive members escape the extraction folder'
+                if member.isfile():
+                    # Read every member so that truncated data is detected
+                    data = archive.extractfile(member)
+                    while data.read(1024 * 1024):
+                        pass
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, zlib.error) as e:
+        return f'Unreadable archive: {e}'
+    return None
+
+@job_queue.task('validate_archive')
+def validate_archive(product_id):
+    """Check that the file of a product is a readable archive that extracts in place."""
+    product = db.session.get(Product, product_id)
+    if product is None or not is_blob_name(product.files):
+        return None
+    problem = archive_problem(get_blob_store().path(product.files))
+    product.file_status = 'invalid' if problem else 'valid'
+    db.session.commit()
+    return {'status': product.file_status, 'problem': problem}
+
+# SHA-256 state of the uploads received by this worker, by upload id and
+# offset, so that an upload resumed on the same worker is not read again.
+# hashlib objects cannot be serialized into the database, uploads resumed
+# on another worker are hashed by a hash_upload job once complete.
+upload_hashers = LRUCache(1000)
+
+@job_queue.task('hash_upload')
+def hash_upload(upload_id):
+    """Hash a resumed upload once received, and move it to the upload folder."""
+    upload = db.session.get(Upload, upload_id)
+    if upload is None or upload.stored_name is not None:
+        return None
+    upload.sha256 = hash_file(upload.partial_path)
+    stored_name = upload.id + os.path.splitext(upload.filename)[1]
+    os.replace(upload.partial_path, os.path.join(app.config['UPLOAD_FOLDER'], stored_name))
+    upload.stored_name = stored_name
+    db.session.commit()
+    return {'sha256': upload.sha256}
+
+
 # Helper functions
-def generate_token(user_id):
+def generate_token(user):
     payload = {
         'exp': datetime.utcnow() + timedelta(days=1),
         'iat': datetime.utcnow(),
-        'sub': user_id
+        'sub': user.id,
+        'ver': user.token_version
     }
     return jwt.encode(
         payload,
@@ -135,6 +1549,62 @@ def generate_token(user_id):
         algorithm='HS256'
     )
 
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                                 app.config['PASSWORD_HASH_QUEUE'])
+
+if app.config['AUTH_RATE_LIMIT_DB']:
+    auth_rate_store = SQLiteBucketStore(app.config['AUTH_RATE_LIMIT_DB'])
+else:
+    auth_rate_store = MemoryBucketStore()
+auth_ip_limiter = TokenBucketLimiter(auth_rate_store, app.config['AUTH_RATE_LIMIT_IP'], prefix='ip:')
+auth_email_limiter = TokenBucketLimiter(auth_rate_store, app.config['AUTH_RATE_LIMIT_EMAIL'], prefix='email:')
+
+def client_ip():
+    return request.environ.get('REAL_IP') or request.remote_addr or ''
+
+@app.before_request
+def limit_auth_requests():
+    """Throttle password guessing on /api/auth/*, per client IP and per targeted email."""
+    if request.method != 'POST' or not request.path.startswith('/api/auth/'):
+        return None
+    waits = []
+    if app.config['AUTH_RATE_LIMIT_IP'] > 0:
+        waits.append(auth_ip_limiter.hit(client_ip()))
+    data = request.get_json(silent=True)
+    email = data.get('email') if isinstance(data, dict) else None
+    if app.config['AUTH_RATE_LIMIT_EMAIL'] > 0 and isinstance(email, str):
+        waits.append(auth_email_limiter.hit(email.strip().lower()))
+    wait = max(waits, default=0)
+    if wait > 0:
+        return jsonify({'message': 'Too many attempts, please retry later'}), 429, \
+            {'Retry-After': str(int(wait) + 1)}
+    return None
+
+# The user a token authenticates, shared by requests and threads, so it
+# is immutable and detached from any session
+Principal = namedtuple('Principal', ['id', 'name', 'email', 'created_at', 'token_version'])
+
+principal_cache = LRUCache(app.config['AUTH_CACHE_SIZE'], ttl=app.config['AUTH_CACHE_TTL'])
+
+def load_principal(user_id, token_version):
+    """Return the principal of a user for a token of `token_version`, or None when revoked.
+
+    Principals are cached, so most requests skip the user query. A token
+    newer than the cached principal means the cache is stale, as when the
+    password was changed through another worker, and reloads it. Tokens
+    revoked through another worker stay accepted by this one until the
+    cached principal expires.
+    """
+    principal = principal_cache.get(user_id)
+    if principal is None or principal.token_version < token_version:
+        user = db.session.get(User, user_id)
+        if user is None:
+            principal_cache.invalidate(f'user:{user_id}')
+            return None
+        principal = Principal(user.id, user.name, user.email, user.created_at, user.token_version)
+        principal_cache.set(user_id, principal, tags=(f'user:{user_id}',))
+    return principal if principal.token_version == token_version else None
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -148,67 +1618,252 @@ def token_required(f):
 
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            current_user = User.query.filter_by(id=data['sub']).first()
         except jwt.ExpiredSignatureError:
             return jsonify({'message': 'Token has expired!'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'message': 'Invalid token!'}), 401
 
+        # Tokens issued before token versions existed are at version 0
+        current_user = load_principal(data['sub'], data.get('ver', 0))
+        if current_user is None:
+            return jsonify({'message': 'Token has been revoked!'}), 401
+
         return f(current_user, *args, **kwargs)
 
     return decorated
 
+def admin_required(f):
+    """Require the ADMIN_TOKEN as bearer token, rejecting every request when it is not set."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header.split(' ')[1] if len(auth_header.split(' ')) > 1 else ''
+        if not app.config['ADMIN_TOKEN'] or not hmac.compare_digest(token.encode(), app.config['ADMIN_TOKEN'].encode()):
+            return jsonify({'message': 'Invalid admin token!'}), 401
+        return f(*args, **kwargs)
+
+    return decorated
+
+# Entries are (body, headers), weighed by the size of the body
+response_cache = LRUCache(app.config['RESPONSE_CACHE_BYTES'], ttl=app.config['RESPONSE_CACHE_TTL'],
+                          weigh=lambda entry: len(entry[0]))
+# Catalog state the response cache of this worker is up to date with
+response_cache_state = {'epoch': None, 'generation': None}
+response_cache_lock = threading.Lock()
+
+def sync_response_cache(state):
+    """Replay the catalog changes committed since the last sync, by any worker."""
+    with response_cache_lock:
+        epoch, generation = state.epoch, state.generation
+        seen = response_cache_state['generation']
+        if response_cache_state['epoch'] != epoch:
+            response_cache.clear()
+        elif generation > seen:
+            changes = db.session.execute(
+                db.select(CatalogChange.generation, CatalogChange.tags)
+                .where(CatalogChange.generation > seen)
+                .order_by(CatalogChange.generation)
+            ).all()
+            if not changes or changes[0].generation != seen + 1:
+                # The log does not cover every generation since the last sync
+                response_cache.clear()
+            else:
+                for change in changes:
+                    response_cache.invalidate(*json.loads(change.tags))
+                generation = max(generation, changes[-1].generation)
+        else:
+            generation = seen
+        response_cache_state.update(epoch=epoch, generation=generation)
+        g.response_cache_generation = generation
+
+def cache_tags(*tags):
+    """Tag the response being built, so writes touching these tags invalidate it."""
+    g.cache_tags = getattr(g, 'cache_tags', ()) + tags
+
+def cached_response(per_user=False):
+    """Serve the decorated view from the in-process response cache.
+
+    Entries are keyed by endpoint, view arguments and query string, and by
+    the authenticated user when `per_user` is set, in which case the view
+    must come after token_required. The view declares its tags with
+    cache_tags(). Bodies are stored as sent, gzipped for clients accepting
+    it, so hits are not compressed again.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = (request.endpoint, tuple(sorted(kwargs.items())),
+                   tuple(sorted(request.args.items(multi=True))),
+                   args[0].id if per_user else None,
+                   request.accept_encodings['gzip'] > 0)
+            entry = response_cache.get(key)
+            if entry is not None:
+                body, headers = entry
+                return app.response_class(body, mimetype='application/json', headers=headers)
+
+            response = app.make_response(f(*args, **kwargs))
+            # Skip storing when a newer generation was synced while rendering
+            if response.status_code == 200 and \
+                    g.get('response_cache_generation') == response_cache_state['generation']:
+                compress_response(response)
+                headers = [(name, value) for name, value in response.headers if name in ('Content-Encoding', 'Vary')]
+                response_cache.set(key, (response.get_data(), headers), tags=g.get('cache_tags', ()))
+            return response
+        return decorated
+    return decorator
+
+def load_catalog_snapshot(key):
+    """Assemble and compress the listing from the snapshot entries, when they are at the (epoch, generation) `key`.
+
+    This runs once per generation in each worker, on the first listing
+    request, rather than in the transaction of every write.
+    """
+    table = CatalogSnapshot.__table__
+    entries = CatalogSnapshotEntry.__table__
+    with db.engine.connect() as connection:
+        # Entries read after the row are at its generation or newer, never older
+        row = connection.execute(db.select(table.c.epoch, table.c.generation)).first()
+        if row is None or tuple(row) != key:
+            return None
+        body = assemble_listing(connection.execute(db.select(entries.c.body).order_by(entries.c.title)).scalars())
+    return Snapshot(*key, *compress_listing(body, app.config['CATALOG_SNAPSHOT_LEVEL']))
+
+catalog_snapshots = SnapshotCache(load_catalog_snapshot)
+
+def serve_catalog_snapshot(f):
+    """Serve the full product listing, without arguments, from the catalog snapshot.
+
+    Each worker keeps the listing of the current generation, already
+    compressed, so the listing costs no query beyond the catalog state
+    check. Requests fall through to the view while the snapshot entries are
+    behind the catalog.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        state = g.get('catalog_state')
+        if not request.args and state is not None:
+            snapshot = catalog_snapshots.get((state.epoch, state.generation))
+            if snapshot is not None:
+                body, encoding = snapshot.encode(request.accept_encodings)
+                response = app.response_class(body, mimetype='application/json')
+                if encoding is not None:
+                    response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+        return f(*args, **kwargs)
+    return decorated
+
+# Public read endpoints whose responses only change with the catalog generation
+CATALOG_ENDPOINTS = {'get_products', 'search_products', 'get_product', 'get_product_reviews',
+                     'get_compatible_products'}
+# Endpoints served through cached_response()
+CACHED_ENDPOINTS = CATALOG_ENDPOINTS | {'get_user_products'}
+
+@app.before_request
+def check_catalog_state():
+    if request.method not in ('GET', 'HEAD') or request.endpoint not in CACHED_ENDPOINTS:
+        return None
+    state = catalog_state()
+    if state is None:
+        return None
+    sync_response_cache(state)
+    if request.endpoint not in CATALOG_ENDPOINTS:
+        return None
+    etag = f'{state.epoch}-{state.generation}'
+    g.catalog_state = state
+    g.catalog_etag = etag
+    # Weak, as the gzipped and identity encodings of a response share it
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        return set_catalog_cache_headers(response, etag)
+    return None
+
+@app.url_value_preprocessor
+def record_route(endpoint, values):
+    # Label metrics by URL rule, so that /api/products/1 and /2 add up
+    if request.url_rule is not None:
+        request.environ[ROUTE_KEY] = request.url_rule.rule
+
+@app.route('/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    return app.response_class(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/cache/stats', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+@app.after_request
+def add_catalog_cache_headers(response):
+    etag = g.pop('catalog_etag', None)
+    if etag is not None and response.status_code == 200:
+        set_catalog_cache_headers(response, etag)
+    return response
+
+def set_catalog_cache_headers(response, etag):
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['CATALOG_CACHE_MAX_AGE']
+    response.cache_control.must_revalidate = True
+    return response
+
+@app.after_request
+def compress_response(response):
+    if response.status_code != 200 or response.direct_passthrough or response.mimetype != 'application/json' \
+            or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] > 0:
+        response.set_data(gzip.compress(data, app.config['COMPRESS_LEVEL'], mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 class FileStorage(Resource):
     @app.route('/api/user', methods=['GET'])
     @token_required
     def get_user_info(current_user):
-        return jsonify({
-            'id': current_user.id,
-            'name': current_user.name,
-            'email': current_user.email,
-            'created_at': current_user.created_at.isoformat()
-        }), 200
+        return jsonify(USER_SCHEMA.dump(current_user)), 200
 
     @app.route('/api/user/change-password', methods=['POST'])
     @token_required
+    @write_transaction
     def change_password(current_user):
         data = request.get_json()
-        if not check_password_hash(current_user.password, data['current_password']):
+        user = db.session.get(User, current_user.id)
+        if not password_hasher.check(user.password, data['current_password']):
             return jsonify({'message': 'Current password is incorrect'}), 400
 
-        current_user.password = generate_password_hash(data['new_password'])
+        user.password = password_hasher.hash(data['new_password'])
+        # Revoke the tokens issued with the old password
+        user.token_version += 1
         db.session.commit()
-        return jsonify({'message': 'Password changed successfully'}), 200
+        principal_cache.invalidate(f'user:{user.id}')
+        return jsonify({
+            'message': 'Password changed successfully',
+            'token': generate_token(user)
+        }), 200
 
     @app.route('/api/user/products', methods=['GET'])
     @token_required
+    @cached_response(per_user=True)
     def get_user_products(current_user):
-        products = Product.query.filter_by(seller_id=current_user.id).all()
-        result = []
-        for product in products:
-            result.append({
-                'id': product.id,
-                'title': product.title,
-                'description': product.description,
-                'files': product.files,
-                'file_url': product.file_url,
-                'external_url': product.external_url,
-                'image_url': product.image_url,
-                'version': product.version,
-                'oncodash_version': product.oncodash_version,
-                'category': product.category,
-                'created_at': product.created_at.isoformat()
-            })
-        return jsonify(result), 200
+        cache_tags(f'seller:{current_user.id}')
+        products = product_rows().filter(Product.seller_id == current_user.id).order_by(Product.id)
+        return jsonify(SELLER_PRODUCT_SCHEMA.dump_many(products)), 200
 
     @app.route('/api/auth/register', methods=['POST'])
+    @write_transaction
     def register(*args):
         data = request.get_json()
         
         if User.query.filter_by(email=data['email']).first():
             return jsonify({'message': 'User already exists'}), 409
         
-        hashed_password = generate_password_hash(data['password'])
+        hashed_password = password_hasher.hash(data['password'])
         new_user = User(
             name=data['name'],
             email=data['email'],
@@ -218,7 +1873,7 @@ class FileStorage(Resource):
         db.session.add(new_user)
         db.session.commit()
         
-        token = generate_token(new_user.id)
+        token = generate_token(new_user)
         
         return jsonify({
             'message': 'User created successfully',
@@ -231,15 +1886,20 @@ class FileStorage(Resource):
         }), 201
 
     @app.route('/api/auth/login', methods=['POST'])
+    @write_transaction
     def login(*args):
         data = request.get_json()
         
         user = User.query.filter_by(email=data['email']).first()
         
-        if not user or not check_password_hash(user.password, data['password']):
+        if not user or not password_hasher.check(user.password, data['password']):
             return jsonify({'message': 'Invalid credentials'}), 401
-        
-        token = generate_token(user.id)
+
+        if password_hasher.needs_rehash(user.password):
+            user.password = password_hasher.hash(data['password'])
+            db.session.commit()
+
+        token = generate_token(user)
         
         return jsonify({
             'message': 'Login successful',
@@ -265,52 +1925,218 @@ class FileStorage(Resource):
         return jsonify({'message': 'Password reset instructions sent if email exists'}), 200
 
     @app.route('/api/products', methods=['GET'])
+    @serve_catalog_snapshot
+    @cached_response()
     def get_products():
-        products = Product.query.order_by(Product.title, Product.version.desc()).all()
-        latest_products = {}
-        for product in products:
-            if product.title not in latest_products:
-                latest_products[product.title] = product
-        return jsonify([product.to_dict() for product in latest_products.values()])
+        cache_tags('catalog')
+        query = latest_products_query()
+        for name in PRODUCT_FILTERS:
+            value = request.args.get(name)
+            if value is None:
+                continue
+            if name == 'seller_id':
+                try:
+                    value = int(value)
+                except ValueError:
+                    return jsonify({'message': 'Invalid seller_id'}), 400
+            query = query.filter(getattr(Product, name) == value)
+
+        sort = request.args.get('sort', 'title')
+        if sort not in PRODUCT_SORTS:
+            return jsonify({'message': f'Invalid sort, expected one of {", ".join(PRODUCT_SORTS)}'}), 400
+
+        paginated = 'limit' in request.args or 'cursor' in request.args
+        limit = None
+        if paginated:
+            limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+            if limit < 1:
+                return jsonify({'message': 'Invalid limit'}), 400
+            limit = min(limit, MAX_PAGE_SIZE)
+
+        try:
+            products, next_cursor = paginate_products(query, sort, request.args.get('cursor'), limit)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+
+        if not paginated:
+            return jsonify(PRODUCT_SCHEMA.dump_many(products))
+        return jsonify({
+            'products': PRODUCT_SCHEMA.dump_many(products),
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/api/products/search', methods=['GET'])
+    @cached_response()
+    def search_products():
+        cache_tags('catalog')
+        query = request.args.get('q', '')
+        if not fts_match_expression(query):
+            return jsonify({'message': 'Missing search query'}), 400
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        products = search_products_query(query).limit(limit).all()
+        return jsonify(PRODUCT_SCHEMA.dump_many(products))
 
     @app.route('/api/products/<int:id>', methods=['GET'])
+    @cached_response()
     def get_product(id):
-        product = Product.query.get_or_404(id)
-        versions = Product.query.filter_by(title=product.title).order_by(Product.version.desc()).all()
-        product_dict = product.to_dict()
-        product_dict['versions'] = [{'id': v.id, 'version': v.version} for v in versions]
+        product = product_rows().filter(Product.id == id).first_or_404()
+        cache_tags(f'product:{id}', f'title:{product.title}')
+        versions = (db.session.query(Product.id, Product.version)
+                    .filter_by(title=product.title).order_by(*version_order()))
+        reviews = review_rows().filter(Review.product_id == id).order_by(Review.id)
+        product_dict = PRODUCT_SCHEMA.dump(product)
+        product_dict['reviews'] = REVIEW_SCHEMA.dump_many(reviews)
+        product_dict['versions'] = VERSION_SCHEMA.dump_many(versions)
         return jsonify(product_dict)
 
+    @app.route('/api/products/<int:id>/reviews', methods=['GET'])
+    @cached_response()
+    def get_product_reviews(id):
+        cache_tags(f'product:{id}')
+        db.get_or_404(Product, id)
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        query = review_rows().filter(Review.product_id == id)
+
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                created_at, last_id = decode_cursor(cursor, 'newest')
+            except ValueError as e:
+                return jsonify({'message': str(e)}), 400
+            query = query.filter(or_(Review.created_at < created_at,
+                                     and_(Review.created_at == created_at, Review.id < last_id)))
+
+        reviews = query.order_by(Review.created_at.desc(), Review.id.desc()).limit(limit + 1).all()
+        next_cursor = None
+        if len(reviews) > limit:
+            reviews = reviews[:limit]
+            next_cursor = encode_cursor(reviews[-1].created_at, reviews[-1].id)
+        return jsonify({
+            'reviews': REVIEW_SCHEMA.dump_many(reviews),
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/api/compat/<oncodash_version>', methods=['GET'])
+    @cached_response()
+    def get_compatible_products(oncodash_version):
+        cache_tags('catalog')
+        if not VERSION_RE.match(oncodash_version):
+            return jsonify({'message': 'Invalid Oncodash version'}), 400
+        products = compatible_products_query(version_key(oncodash_version)).all()
+        return jsonify({
+            'oncodash_version': oncodash_version,
+            'products': COMPAT_PRODUCT_SCHEMA.dump_many(products)
+        })
+
+    @app.route('/api/updates/check', methods=['POST'])
+    def check_updates():
+        data = request.get_json(silent=True)
+        installed = data.get('installed') if isinstance(data, dict) else None
+        if not isinstance(installed, list) or not all(
+                isinstance(entry, dict) and isinstance(entry.get('title'), str)
+                and isinstance(entry.get('version'), str) for entry in installed):
+            return jsonify({'message': 'Expected installed as a list of {"title", "version"} objects'}), 400
+        if len(installed) > MAX_UPDATE_CHECK_SIZE:
+            return jsonify({'message': f'At most {MAX_UPDATE_CHECK_SIZE} installed products per check'}), 400
+        oncodash_version = data.get('oncodash_version')
+        if oncodash_version is not None and \
+                not (isinstance(oncodash_version, str) and VERSION_RE.match(oncodash_version)):
+            return jsonify({'message': 'Invalid Oncodash version'}), 400
+        installed = {(entry['title'], entry['version']) for entry in installed}
+
+        # Clients resend the ETag of their last answer, which holds while
+        # neither the catalog nor their installed set changes
+        state = catalog_state()
+        etag = update_check_etag(state, installed, oncodash_version) if state is not None else None
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        titles = {title for title, version in installed}
+        newest = {}
+        if titles:
+            if oncodash_version is None:
+                query = product_rows().filter(Product.is_latest, Product.title.in_(titles))
+            else:
+                query = compatible_products_query(version_key(oncodash_version), titles)
+            query = query.add_columns(Product.version_key, Product.version_prerelease)
+            newest = {row.title: row for row in query}
+
+        updates = []
+        for title, version in sorted(installed):
+            row = newest.get(title)
+            if row is not None and (row.version_key, row.version_prerelease) > \
+                    (version_key(version), prerelease_key(version)):
+                updates.append({'title': title, 'installed_version': version, 'product': PRODUCT_SCHEMA.dump(row)})
+        response = jsonify({'updates': updates})
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
+
     @app.route('/api/products', methods=['POST'])
     @token_required
     def create_product(current_user):
         data = request.form
         external_url = request.form.get('external_url')
+        upload_id = request.form.get('upload_id')
     
-        if 'files' not in request.files and not external_url:
-            return {'error': 'Either a file or an external URL must be provided'}, 400
+        if 'files' not in request.files and not external_url and not upload_id:
+            return {'error': 'Either a file, an upload or an external URL must be provided'}, 400
+
+        missing = [field for field in ('title', 'description', 'version', 'license', 'oncodash_version')
+                   if not data.get(field)]
+        if missing:
+            return {'error': f'Missing required fields: {", ".join(missing)}'}, 400
+        try:
+            parse_compat_range(data['oncodash_version'])
+        except ValueError as e:
+            return {'error': f'Invalid oncodash_version: {e}'}, 400
 
         file = request.files.get('files')
         image = request.files.get('images')
     
         file_url = None
         filename = None
-    
+        file_size = None
+        file_sha256 = None
+        # Files to move into the blob store once the product is flushed
+        staged = []
+        incoming = os.path.join(app.config['UPLOAD_FOLDER'], INCOMING_DIR)
+        os.makedirs(incoming, exist_ok=True)
+
+        upload = None
+        archive = False
+        if upload_id and not file:
+            upload = Upload.query.filter_by(id=upload_id, user_id=current_user.id).first()
+            if upload is None or upload.stored_name is None:
+                return {'error': 'Upload not found or incomplete'}, 400
+            file_size, file_sha256 = upload.size, upload.sha256
+            archive = upload.filename.lower().endswith(ARCHIVE_EXTENSIONS)
+            filename = stage_blob(os.path.join(app.config['UPLOAD_FOLDER'], upload.stored_name),
+                                  file_sha256, file_size, os.path.splitext(upload.filename)[1], staged)
+            file_url = get_external_url('get_blob', name=filename)
+
         if file:
             original_filename, file_extension = os.path.splitext(file.filename)
-            filename = str(uuid.uuid4()) + file_extension
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            file_url = get_external_url('static', filename=f'uploads/{filename}')
+            archive = file.filename.lower().endswith(ARCHIVE_EXTENSIONS)
+            file_path = os.path.join(incoming, uuid.uuid4().hex)
+            request.track_incoming(file_path)
+            file_size, file_sha256 = store_upload(file, file_path, app.config['MAX_FILE_SIZE'],
+                                                  app.config['UPLOAD_CHUNK_SIZE'])
+            filename = stage_blob(file_path, file_sha256, file_size, file_extension, staged)
+            file_url = get_external_url('get_blob', name=filename)
 
         image_filename = None
         image_url = None
         if image and image.filename != '':
             original_filename, file_extension = os.path.splitext(image.filename)
-            image_filename = str(uuid.uuid4()) + file_extension
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-            image.save(image_path)
-            image_url = get_external_url('static', filename=f'uploads/{image_filename}')
+            image_path = os.path.join(incoming, uuid.uuid4().hex)
+            request.track_incoming(image_path)
+            image_size, image_sha256 = store_upload(image, image_path, app.config['MAX_FILE_SIZE'],
+                                                    app.config['UPLOAD_CHUNK_SIZE'])
+            image_filename = stage_blob(image_path, image_sha256, image_size, file_extension, staged)
+            image_url = get_external_url('get_blob', name=image_filename)
 
         new_product = Product(
             title=data['title'],
@@ -318,6 +2144,9 @@ class FileStorage(Resource):
             price=float(0.0),
             files=filename,
             file_url=file_url,
+            file_size=file_size,
+            file_sha256=file_sha256,
+            file_status='pending' if archive else None,
             external_url=external_url,
             image_name=image_filename or '',
             image_url=image_url or '',
@@ -329,40 +2158,222 @@ class FileStorage(Resource):
         )
     
         db.session.add(new_product)
+        if upload is not None:
+            db.session.delete(upload)
+        add_staged_blobs(staged)
+        # Enqueued in the same transaction, so jobs exist only for created products
+        jobs = []
+        if archive:
+            jobs.append(job_queue.enqueue('validate_archive', user_id=current_user.id, product_id=new_product.id))
+        if image_filename:
+            jobs.append(job_queue.enqueue('process_image', user_id=current_user.id, product_id=new_product.id))
         db.session.commit()
+        job_queue.dispatch()
     
         return {
             'message': 'Product created successfully',
-            'product': {
-                'id': new_product.id,
-                'title': new_product.title,
-                'description': new_product.description,
-                'files': new_product.files,
-                'file_url': new_product.file_url,
-                'external_url': new_product.external_url,
-                'image_name': new_product.image_name,
-                'image_url': new_product.image_url,
-                'category': new_product.category,
-                'version': new_product.version,
-                'oncodash_version': new_product.oncodash_version,
-                'license': new_product.license,
-                'seller': {
-                    'id': current_user.id,
-                    'name': current_user.name
-                },
-                'created_at': new_product.created_at.isoformat()
-            }
+            'product': SELLER_PRODUCT_SCHEMA.dump(product_rows().filter(Product.id == new_product.id).one()),
+            'jobs': [job.to_dict() for job in jobs]
         }, 201
 
+    @app.route('/api/files/<path:name>', methods=['GET'])
+    def get_blob(name):
+        if not is_blob_name(name):
+            return jsonify({'message': 'File not found'}), 404
+        response = send_stored_file(name, etag=name.split('/')[-1].split('.')[0], max_age=BLOB_MAX_AGE)
+        if isinstance(response, app.response_class) and response.status_code in (200, 206, 304):
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        return response
+
+    @app.route('/api/files/<path:name>', methods=['PUT'])
+    @admin_required
+    def put_blob(name):
+        if not is_blob_name(name):
+            return jsonify({'message': 'Invalid blob name'}), 400
+        store = get_blob_store()
+        if store.exists(name):
+            register_blob(name, name.split('/')[-1][:64], os.path.getsize(store.path(name)))
+            db.session.commit()
+            return jsonify({'message': 'Blob already stored'}), 200
+        path = os.path.join(app.config['UPLOAD_FOLDER'], INCOMING_DIR, uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        request.track_incoming(path)
+        hasher = hashlib.sha256()
+        with open(path, 'wb') as f:
+            size = copy_stream(request.stream, f, app.config['MAX_FILE_SIZE'] + 1, app.config['UPLOAD_CHUNK_SIZE'], hasher)
+        if size > app.config['MAX_FILE_SIZE']:
+            return jsonify({'message': f'Files are limited to {app.config["MAX_FILE_SIZE"]} bytes'}), 413
+        # Blob names start with the hash of their content
+        if hasher.hexdigest() != name.split('/')[-1][:64]:
+            return jsonify({'message': 'Content does not match the blob name'}), 400
+        store.add(path, name)
+        register_blob(name, hasher.hexdigest(), size)
+        db.session.commit()
+        return jsonify({'message': 'Blob stored'}), 201
+
+    @app.route('/api/export', methods=['GET'])
+    @admin_required
+    def export():
+        engine = db.engine
+
+        def generate():
+            with engine.connect() as connection:
+                lines = []
+                for record in export_catalog(connection):
+                    lines.append(app.json.dumps(record) + '\n')
+                    if len(lines) == 1000:
+                        yield ''.join(lines)
+                        lines = []
+                yield ''.join(lines)
+
+        return app.response_class(generate(), mimetype='application/x-ndjson')
+
+    @app.route('/api/import', methods=['POST'])
+    @admin_required
+    def import_():
+        try:
+            counts, missing = import_catalog(read_records(request.stream, app.json.loads),
+                                             app.config['IMPORT_BATCH_SIZE'])
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        return jsonify({**counts, 'missing_blobs': missing}), 200
+
+    @app.route('/api/products/<int:id>/download', methods=['GET'])
+    def download_product(id):
+        product = db.get_or_404(Product, id)
+        if not product.files:
+            if product.external_url:
+                return redirect(product.external_url)
+            return jsonify({'message': 'Product has no file'}), 404
+        extension = os.path.splitext(product.files)[1]
+        download_name = f'{product.title}-{product.version}{extension}'
+        if is_blob_name(product.files):
+            return send_stored_file(product.files, download_name, etag=product.file_sha256 or True)
+        return send_stored_file(product.files, download_name)
+
+    @app.route('/api/uploads', methods=['POST'])
+    @token_required
+    def create_upload(current_user):
+        data = request.get_json()
+        if not data or 'filename' not in data or 'size' not in data:
+            return jsonify({'message': 'Missing required fields'}), 400
+        try:
+            size = int(data['size'])
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Size must be an integer'}), 400
+        if size < 0:
+            return jsonify({'message': 'Size must be positive'}), 400
+        if size > app.config['MAX_FILE_SIZE']:
+            return jsonify({'message': f'Files are limited to {app.config["MAX_FILE_SIZE"]} bytes'}), 413
+
+        upload = Upload(id=uuid.uuid4().hex, user_id=current_user.id, filename=data['filename'],
+                        size=size, offset=0)
+        os.makedirs(os.path.dirname(upload.partial_path), exist_ok=True)
+        open(upload.partial_path, 'wb').close()
+        db.session.add(upload)
+        db.session.commit()
+        return jsonify(upload.to_dict()), 201
+
+    @app.route('/api/uploads/<upload_id>', methods=['GET'])
+    @token_required
+    def get_upload(current_user, upload_id):
+        upload = Upload.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+        return jsonify(upload.to_dict()), 200, {'Upload-Offset': str(upload.offset)}
+
+    @app.route('/api/jobs/<int:id>', methods=['GET'])
+    @token_required
+    def get_job(current_user, id):
+        job = Job.query.filter_by(id=id, user_id=current_user.id).first_or_404()
+        return jsonify(job.to_dict())
+
+    @app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+    @token_required
+    def append_upload(current_user, upload_id):
+        upload = Upload.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+        offset = request.headers.get('Upload-Offset', type=int)
+        if upload.stored_name is not None or upload.processing or offset != upload.offset:
+            return jsonify({'message': 'Offset does not match the upload', **upload.to_dict()}), 409
+
+        # Take the upload unless another request did since it was read, or
+        # is still appending to it
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=app.config['UPLOAD_RECEIVE_TIMEOUT'])
+        claimed = db.session.execute(
+            db.update(Upload)
+            .where(Upload.id == upload.id, Upload.offset == offset, Upload.stored_name.is_(None),
+                   or_(Upload.receiving_since.is_(None), Upload.receiving_since < stale))
+            .values(receiving_since=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        db.session.commit()
+        if not claimed:
+            return jsonify({'message': 'Another request is appending to the upload', **upload.to_dict()}), 409
+
+        # Stream the body to the partial file, hashing it on the fly from
+        # the start of the file or from where this worker left it. Bytes
+        # received before a disconnection are kept so the client can resume
+        # from the recorded offset.
+        hasher = hashlib.sha256() if offset == 0 else upload_hashers.get((upload.id, offset))
+        if hasher is not None:
+            hasher = hasher.copy()
+        disconnected = False
+        try:
+            with open(upload.partial_path, 'r+b') as f:
+                f.seek(offset)
+                f.truncate()
+                try:
+                    copy_stream(request.stream, f, upload.size - offset, app.config['UPLOAD_CHUNK_SIZE'],
+                                hasher)
+                except ClientDisconnected:
+                    disconnected = True
+                upload.offset = f.tell()
+        except BaseException:
+            db.session.rollback()
+            db.session.execute(db.update(Upload).where(Upload.id == upload.id).values(receiving_since=None))
+            db.session.commit()
+            raise
+        upload.receiving_since = None
+        upload.updated_at = datetime.utcnow()
+
+        job = None
+        if upload.offset < upload.size and hasher is not None:
+            upload_hashers.set((upload.id, upload.offset), hasher)
+        elif upload.offset == upload.size:
+            if hasher is not None:
+                upload.sha256 = hasher.hexdigest()
+                stored_name = upload.id + os.path.splitext(upload.filename)[1]
+                os.replace(upload.partial_path, os.path.join(app.config['UPLOAD_FOLDER'], stored_name))
+                upload.stored_name = stored_name
+            else:
+                # Resumed on another worker, the upload has to be read again to
+                # be hashed, off the request
+                job = job_queue.enqueue('hash_upload', user_id=current_user.id, upload_id=upload.id)
+        db.session.commit()
+        job_queue.dispatch()
+
+        if disconnected:
+            return jsonify({'message': 'Upload interrupted', **upload.to_dict()}), 400
+        response = upload.to_dict()
+        if job is not None:
+            response['job'] = job.to_dict()
+        return jsonify(response), 200, {'Upload-Offset': str(upload.offset)}
+
     @app.route('/api/products/<int:id>', methods=['PUT'])
     @token_required
+    @write_transaction
     def update_product(current_user, id):
-        product = Product.query.get_or_404(id)
+        product = db.get_or_404(Product, id)
 
         if product.seller_id != current_user.id:
             return jsonify({'message': 'Unauthorized'}), 403
 
         data = request.get_json()
+        if 'oncodash_version' in data:
+            try:
+                parse_compat_range(data['oncodash_version'])
+            except ValueError as e:
+                return jsonify({'message': f'Invalid oncodash_version: {e}'}), 400
 
         product.title = data.get('title', product.title)
         product.description = data.get('description', product.description)
@@ -377,31 +2388,14 @@ class FileStorage(Resource):
 
         return jsonify({
             'message': 'Product updated successfully',
-            'product': {
-                'id': product.id,
-                'title': product.title,
-                'description': product.description,
-                #'price': product.price,
-                'files': product.files,
-                'file_url': product.file_url,
-                'image_name': product.image_name,
-                'image_url': product.image_url,
-                'category': product.category,
-                'version': product.version,
-                'license': product.license,
-                'seller': {
-                    'id': current_user.id,
-                    'name': current_user.name
-                },
-                'created_at': product.created_at.isoformat(),
-                'oncodash_version': product.oncodash_version
-            }
+            'product': SELLER_PRODUCT_SCHEMA.dump(product_rows().filter(Product.id == id).one())
         }), 200
 
     @app.route('/api/products/<int:id>', methods=['DELETE'])
     @token_required
+    @write_transaction
     def delete_product(current_user, id):
-        product = Product.query.get_or_404(id)
+        product = db.get_or_404(Product, id)
 
         if product.seller_id != current_user.id:
             return jsonify({'message': 'Unauthorized'}), 403
@@ -413,36 +2407,39 @@ class FileStorage(Resource):
 
     @app.route('/api/reviews/<int:product_id>', methods=['POST'])
     @token_required
+    @write_transaction
     def add_review(current_user, product_id):
         data = request.get_json()
 
         if not data or 'rating' not in data or 'comment' not in data:
             return jsonify({'message': 'Missing required fields'}), 400
 
-        product = Product.query.get(product_id)
+        try:
+            rating = int(data['rating'])
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Rating must be an integer'}), 400
+
+        product = db.session.get(Product, product_id)
         if not product:
             return jsonify({'message': 'Product not found'}), 404
 
         new_review = Review(
             product_id=product_id,
             user_id=current_user.id,
-            rating=data['rating'],
+            rating=rating,
             comment=data['comment']
         )
 
         db.session.add(new_review)
+        # Update the aggregates in SQL so concurrent reviews cannot lose counts
+        Product.query.filter_by(id=product_id).update({
+            Product.review_count: Product.review_count + 1,
+            Product.rating_sum: Product.rating_sum + rating,
+            Product.rating_avg: (Product.rating_sum + rating) * 1.0 / (Product.review_count + 1)
+        }, synchronize_session=False)
         db.session.commit()
 
-        return jsonify({
-            'id': new_review.id,
-            'productId': new_review.product_id,
-            'userId': new_review.user_id,
-            'userName': current_user.name,
-            #'userAvatar': current_user.avatar,
-            'rating': new_review.rating,
-            'comment': new_review.comment,
-            'createdAt': new_review.created_at.isoformat()
-        }), 201
+        return jsonify(REVIEW_SCHEMA.dump(review_rows().filter(Review.id == new_review.id).one())), 201
 
 
 # Add routes
@@ -456,4 +2453,6 @@ api.add_resource(FileStorage,
 )
 
 if __name__ == '__main__':
+    with app.app_context():
+        migrations.upgrade()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,359 @@
+"""Benchmark the app store API.
+
+    python benchmark.py [--url URL] [--users N] [--products N] [--versions N] [--reviews N]
+                        [--requests N] [--concurrency N] [--output FILE] [--compare FILE]
+
+Seeds a synthetic catalog in the database of the app (DATABASE_URL), unless
+it is already there, then drives the main endpoints and reports latency
+percentiles, requests per second and, when run in process, SQL queries per
+request. Without --url, requests go through the Flask test client; with it,
+they go to a running server, such as gunicorn started with the same
+DATABASE_URL, SECRET_KEY and UPLOAD_FOLDER, and AUTH_RATE_LIMIT_IP=0
+AUTH_RATE_LIMIT_EMAIL=0 so that logins are not throttled.
+
+Results are saved as JSON with --output. With --compare, the exit status is
+1 when the latency, throughput or queries per request of an endpoint got
+worse than in a previous result file by more than --tolerance.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from app import (app, db, Product, Review, User, bump_catalog_generation, compat_keys, generate_token,
+                 password_hasher, refresh_catalog_snapshot, refresh_latest_versions, update_rating_aggregates)
+from versioning import prerelease_key, version_key
+
+BENCH_PASSWORD = 'benchmark-password'
+SCENARIOS = ('list_products', 'product_detail', 'compat', 'update_check', 'user_products', 'login', 'upload')
+CATEGORIES = ('Analysis', 'Visualization', 'Import', 'Export', 'Genomics', 'Imaging')
+LICENSES = ('MIT', 'Apache-2.0', 'GPL-3.0', 'BSD-3-Clause')
+
+
+def bench_email(i):
+    return f'bench{i}@example.com'
+
+
+def seed_catalog(users=100, products=1000, versions=5, reviews=5, seed=0):
+    """Insert a synthetic catalog unless one is already there, return whether it seeded.
+
+    Every product title gets `versions` versions from 1.0.0 up, with up to
+    `reviews` reviews each by random users. Rows are bulk inserted, then the
+    latest flags, rating aggregates and catalog generation are refreshed.
+    """
+    if User.query.filter_by(email=bench_email(0)).first() is not None:
+        return False
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    password = password_hasher.hash(BENCH_PASSWORD)
+    db.session.execute(db.insert(User), [
+        {'name': f'Bench User {i}', 'email': bench_email(i), 'password': password, 'token_version': 0,
+         'created_at': now}
+        for i in range(users)
+    ])
+    user_ids = [id for id, in db.session.query(User.id).filter(User.email.like('bench%@example.com'))]
+
+    titles = [f'Bench Product {i}' for i in range(products)]
+    rows = []
+    for i, title in enumerate(titles):
+        seller_id = rng.choice(user_ids)
+        for v in range(versions):
+            version = f'1.{v}.0'
+            rows.append({
+                'title': title,
+                'description': f'Synthetic product {i} for benchmarks, version {version}',
+                'price': 0.0,
+                'image_name': '',
+                'image_url': '',
+                'category': rng.choice(CATEGORIES),
+                'seller_id': seller_id,
+                'created_at': now - timedelta(days=products - i, hours=versions - v),
+                'version': version,
+                'version_key': version_key(version),
+                'version_prerelease': prerelease_key(version),
+                'license': rng.choice(LICENSES),
+                'oncodash_version': f'{rng.randint(1, 3)}.0'
+            })
+            rows[-1]['compat_min_key'], rows[-1]['compat_max_key'] = compat_keys(rows[-1]['oncodash_version'])
+    db.session.execute(db.insert(Product), rows)
+    product_ids = [id for id, in db.session.query(Product.id).filter(Product.title.in_(titles))]
+
+    review_rows = [
+        {'product_id': product_id, 'user_id': rng.choice(user_ids), 'rating': rng.randint(1, 5),
+         'comment': 'Synthetic review', 'created_at': now}
+        for product_id in product_ids
+        for _ in range(rng.randint(0, reviews))
+    ]
+    if review_rows:
+        db.session.execute(db.insert(Review), review_rows)
+    connection = db.session.connection()
+    refresh_latest_versions(connection, titles)
+    update_rating_aggregates(product_ids)
+    bump_catalog_generation(connection)
+    refresh_catalog_snapshot(connection)
+    db.session.commit()
+    return True
+
+
+class QueryCounter(object):
+    """Count the SQL statements run by each thread, for in-process benchmarks."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._local = threading.local()
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+
+class TestClient(object):
+    """Send requests to the app in process."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, body=None):
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        return response.status_code, response.get_data()
+
+
+class HTTPClient(object):
+    """Send requests to a running server, over one keep-alive connection."""
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parsed.netloc, timeout=60)
+        self.prefix = parsed.path.rstrip('/')
+
+    def request(self, method, path, headers=None, body=None):
+        self.connection.request(method, self.prefix + path, body=body, headers=headers or {})
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def scenario_requests(name, context, rng):
+    """The requests of one iteration of a scenario, as (endpoint, method, path, headers, body)."""
+    json_headers = {'Content-Type': 'application/json'}
+    if name == 'list_products':
+        return [('GET /api/products', 'GET', f'/api/products?limit=20&sort={rng.choice(["title", "newest", "rating"])}',
+                 None, None)]
+    if name == 'product_detail':
+        return [('GET /api/products/<id>', 'GET', f'/api/products/{rng.choice(context["product_ids"])}', None, None)]
+    if name == 'compat':
+        return [('GET /api/compat/<oncodash_version>', 'GET', f'/api/compat/{rng.randint(1, 3)}.0.{rng.randint(0, 9)}',
+                 None, None)]
+    if name == 'update_check':
+        # An installation with 50 plugins, at random seeded versions
+        installed = [{'title': title, 'version': f'1.{rng.randint(0, 4)}.0'}
+                     for title in rng.sample(context['titles'], min(50, len(context['titles'])))]
+        return [('POST /api/updates/check', 'POST', '/api/updates/check', json_headers,
+                 json.dumps({'installed': installed}))]
+    user = rng.choice(context['users'])
+    auth = {'Authorization': f'Bearer {user["token"]}'}
+    if name == 'user_products':
+        return [('GET /api/user/products', 'GET', '/api/user/products', auth, None)]
+    if name == 'login':
+        body = json.dumps({'email': user['email'], 'password': BENCH_PASSWORD})
+        return [('POST /api/auth/login', 'POST', '/api/auth/login', json_headers, body)]
+    if name == 'upload':
+        size = context['upload_size']
+        body = json.dumps({'filename': 'bench.bin', 'size': size})
+        return [('POST /api/uploads', 'POST', '/api/uploads', {**auth, **json_headers}, body),
+                ('PATCH /api/uploads/<id>', 'PATCH', None, {**auth, 'Upload-Offset': '0'}, os.urandom(size))]
+    raise ValueError(f'Unknown scenario: {name}')
+
+
+def run_scenario(name, make_client, context, requests=200, concurrency=4, counter=None):
+    """Run `requests` iterations of a scenario over `concurrency` threads, return per-endpoint stats."""
+    samples = {}
+    lock = threading.Lock()
+
+    def work(iterations, seed):
+        rng = random.Random(seed)
+        client = make_client()
+        for _ in range(iterations):
+            upload_id = None
+            for endpoint, method, path, headers, body in scenario_requests(name, context, rng):
+                path = path or f'/api/uploads/{upload_id}'
+                queries = counter.count if counter else 0
+                start = time.perf_counter()
+                status, data = client.request(method, path, headers, body)
+                elapsed = time.perf_counter() - start
+                if endpoint == 'POST /api/uploads' and status == 201:
+                    upload_id = json.loads(data)['id']
+                with lock:
+                    sample = samples.setdefault(endpoint, {'latencies': [], 'errors': 0, 'queries': 0})
+                    sample['latencies'].append(elapsed)
+                    sample['errors'] += status >= 400
+                    sample['queries'] += counter.count - queries if counter else 0
+
+    threads = [threading.Thread(target=work, args=(requests // concurrency + (i < requests % concurrency), i))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    results = {}
+    for endpoint, sample in samples.items():
+        latencies = sorted(sample['latencies'])
+        count = len(latencies)
+        results[endpoint] = {
+            'requests': count,
+            'errors': sample['errors'],
+            'requests_per_second': count / duration,
+            'mean_ms': sum(latencies) / count * 1000,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_request': sample['queries'] / count if counter else None
+        }
+    return results
+
+
+def benchmark_context(upload_size):
+    latest = db.session.query(Product.id, Product.title).filter(Product.is_latest).order_by(Product.id).limit(10000).all()
+    product_ids = [id for id, title in latest]
+    users = [{'email': user.email, 'token': generate_token(user)}
+             for user in User.query.filter(User.email.like('bench%@example.com')).order_by(User.id).limit(1000)]
+    return {'product_ids': product_ids, 'titles': [title for id, title in latest], 'users': users,
+            'upload_size': upload_size}
+
+
+def run_benchmark(scenarios=SCENARIOS, url=None, requests=200, concurrency=4, upload_size=64 * 1024):
+    """Run the scenarios against the app in process, or against the server at `url`."""
+    context = benchmark_context(upload_size)
+    results = {}
+    if url:
+        for name in scenarios:
+            results.update(run_scenario(name, lambda: HTTPClient(url), context, requests, concurrency))
+        return results
+
+    limits = {key: app.config[key] for key in ('AUTH_RATE_LIMIT_IP', 'AUTH_RATE_LIMIT_EMAIL')}
+    app.config.update(AUTH_RATE_LIMIT_IP=0, AUTH_RATE_LIMIT_EMAIL=0)
+    try:
+        with QueryCounter(db.engine) as counter:
+            for name in scenarios:
+                results.update(run_scenario(name, TestClient, context, requests, concurrency, counter))
+    finally:
+        app.config.update(limits)
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Return the regressions of `results` against `baseline`, as messages."""
+    regressions = []
+    for endpoint, stats in results.items():
+        previous = baseline.get(endpoint)
+        if previous is None:
+            continue
+        if stats['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{endpoint}: p95 {previous["p95_ms"]:.1f}ms -> {stats["p95_ms"]:.1f}ms')
+        if stats['requests_per_second'] < previous['requests_per_second'] * (1 - tolerance):
+            regressions.append(f'{endpoint}: {previous["requests_per_second"]:.1f} -> '
+                               f'{stats["requests_per_second"]:.1f} requests/s')
+        if stats['queries_per_request'] and previous['queries_per_request'] and \
+                stats['queries_per_request'] > previous['queries_per_request'] * (1 + tolerance):
+            regressions.append(f'{endpoint}: {previous["queries_per_request"]:.1f} -> '
+                               f'{stats["queries_per_request"]:.1f} queries per request')
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the app store API')
+    parser.add_argument('--url', help='base URL of a running server, the app runs in process otherwise')
+    parser.add_argument('--users', type=int, default=100, help='users of the seeded catalog')
+    parser.add_argument('--products', type=int, default=1000, help='product titles of the seeded catalog')
+    parser.add_argument('--versions', type=int, default=5, help='versions of each product')
+    parser.add_argument('--reviews', type=int, default=5, help='maximum reviews of each version')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated scenarios among {", ".join(SCENARIOS)}')
+    parser.add_argument('--requests', type=int, default=200, help='iterations of each scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--upload-size', type=int, default=64 * 1024, help='bytes sent by each upload')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown tolerated by --compare (default 0.2)')
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    with app.test_request_context():
+        if seed_catalog(args.users, args.products, args.versions, args.reviews):
+            print(f'Seeded {args.users} users, {args.products} products with {args.versions} versions')
+        results = run_benchmark(scenarios, args.url, args.requests, args.concurrency, args.upload_size)
+        database = db.engine.dialect.name
+
+    print(f'{"endpoint":<28} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"errors":>7}')
+    for endpoint, stats in results.items():
+        queries = stats['queries_per_request']
+        print(f'{endpoint:<28} {stats["requests_per_second"]:>9.1f} {stats["p50_ms"]:>9.2f} '
+              f'{stats["p95_ms"]:>9.2f} {stats["p99_ms"]:>9.2f} '
+              f'{"-" if queries is None else f"{queries:.1f}":>8} {stats["errors"]:>7}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat(),
+                'revision': git_revision(),
+                'target': args.url or 'in-process',
+                'database': database,
+                'settings': {key: getattr(args, key) for key in
+                             ('users', 'products', 'versions', 'reviews', 'requests', 'concurrency', 'upload_size')},
+                'results': results
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+import re
+import uuid
+
+# <2 hex>/<2 hex>/<sha256><extension>
+BLOB_NAME_RE = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(\.[a-z0-9]{1,10})?$')
+EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,10}$')
+
+
+def is_blob_name(name):
+    return bool(name) and BLOB_NAME_RE.match(name) is not None
+
+
+class BlobStore(object):
+    """Content-addressed files stored under `root`.
+
+    A blob is named after the SHA-256 of its content, with a two-level
+    fan-out so that no directory grows too large, and keeps the extension
+    of the uploaded file so it can be served with the right content type:
+    ab/cd/abcd...ef.zip. Identical files share one blob.
+
+    :param root: the folder holding the blobs
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def blob_name(sha256, extension=''):
+        extension = extension.lower()
+        if not EXTENSION_RE.match(extension):
+            extension = ''
+        return f'{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+    def path(self, name):
+        if not is_blob_name(name):
+            raise ValueError(f'Invalid blob name: {name}')
+        return os.path.join(self.root, *name.split('/'))
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def add(self, source, name):
+        """Move the file at `source` into the store as blob `name`.
+
+        When the blob is already stored, `source` is removed instead.
+        """
+        path = self.path(name)
+        if os.path.isfile(path):
+            os.remove(source)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source, path)
+
+    def trash(self, name):
+        """Move blob `name` aside and return where to, or None if it is not stored.
+
+        Trashed blobs can be put back with restore() until purge() removes them.
+        """
+        path = self.path(name)
+        trashed = f'{path}.deleted-{uuid.uuid4().hex}'
+        try:
+            os.replace(path, trashed)
+        except FileNotFoundError:
+            return None
+        return trashed
+
+    def restore(self, name, trashed):
+        path = self.path(name)
+        if os.path.isfile(path):
+            os.remove(trashed)
+        else:
+            os.replace(trashed, path)
+
+    def purge(self, trashed):
+        os.remove(trashed)
+        # Drop fan-out folders left empty
+        folder = os.path.dirname(trashed)
+        for _ in range(2):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    def names(self):
+        """Iterate over the names of every stored blob."""
+        for folder, _, files in os.walk(self.root):
+            for filename in files:
+                name = os.path.relpath(os.path.join(folder, filename), self.root).replace(os.sep, '/')
+                if is_blob_name(name):
+                    yield name
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import urllib.parse
+import urllib.request
+import uuid
+
+from uploads import copy_stream
+
+# Version of the export format, written in the header record
+EXPORT_FORMAT = 1
+# Record types of an export, in the order they are written
+RECORD_TYPES = ('header', 'blob', 'user', 'product', 'review')
+
+
+def read_records(lines, loads=json.loads):
+    """Parse NDJSON `lines` into records, skipping blank lines.
+
+    Raises ValueError naming the line of a malformed record.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = loads(line)
+        except ValueError as e:
+            raise ValueError(f'Line {number}: invalid JSON ({e})')
+        if not isinstance(record, dict) or record.get('type') not in RECORD_TYPES:
+            raise ValueError(f'Line {number}: expected an object with a type among {", ".join(RECORD_TYPES)}')
+        if record['type'] == 'header' and record.get('format') != EXPORT_FORMAT:
+            raise ValueError(f'Line {number}: unsupported export format {record.get("format")}')
+        yield record
+
+
+def batches(records, size):
+    """Group consecutive records of the same type into lists of at most `size`, yielding (type, list)."""
+    batch = []
+    for record in records:
+        if batch and (record['type'] != batch[0]['type'] or len(batch) >= size):
+            yield batch[0]['type'], batch
+            batch = []
+        batch.append(record)
+    if batch:
+        yield batch[0]['type'], batch
+
+
+class DirectoryBlobSource(object):
+    """Blobs read from the blob store folder of another instance, such as a backup."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, name):
+        return open(os.path.join(self.root, *name.split('/')), 'rb')
+
+
+class HTTPBlobSource(object):
+    """Blobs downloaded from GET /api/files/<name> of another instance.
+
+    :param base_url: the root URL of the instance, such as https://appstore.example.org
+    """
+
+    def __init__(self, base_url, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def open(self, name):
+        return urllib.request.urlopen(f'{self.base_url}/api/files/{urllib.parse.quote(name)}',
+                                      timeout=self.timeout)
+
+
+def is_url(location):
+    return urllib.parse.urlparse(location).scheme in ('http', 'https')
+
+
+def blob_source(location):
+    """A blob source for a folder, or for the URL of an instance."""
+    if is_url(location):
+        return HTTPBlobSource(location)
+    return DirectoryBlobSource(location)
+
+
+def fetch_blob(source, name, sha256, size, store, incoming):
+    """Copy blob `name` from `source` into `store`, checking its size and hash.
+
+    Raises ValueError when the content does not match, in which case
+    nothing is stored.
+    """
+    os.makedirs(incoming, exist_ok=True)
+    path = os.path.join(incoming, uuid.uuid4().hex)
+    hasher = hashlib.sha256()
+    try:
+        with source.open(name) as f, open(path, 'wb') as target:
+            copied = copy_stream(f, target, limit=size + 1, hasher=hasher)
+        if copied != size or hasher.hexdigest() != sha256:
+            raise ValueError(f'Blob {name} does not match its manifest entry')
+        store.add(path, name)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
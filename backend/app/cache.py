@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by the total weight of its values.
+
+    Every entry expires `ttl` seconds after it was stored (never when ttl is
+    None) and may carry tags, so that a group of entries can be dropped at
+    once with invalidate(). `weigh` computes the weight of a value, 1 by
+    default so that `max_weight` is a number of entries; pass `len` to bound
+    a cache of bytes by its size.
+
+    :param max_weight: total weight above which least recently used entries are evicted
+    :param ttl: lifetime of an entry in seconds
+    :param weigh: function returning the weight of a value
+    """
+
+    def __init__(self, max_weight, ttl=None, weigh=None):
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, weight, expires, tags = entry
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, tags=()):
+        weight = self.weigh(value)
+        if weight > self.max_weight:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, weight, expires, tuple(tags))
+            self.weight += weight
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.weight > self.max_weight:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """Drop every entry carrying one of `tags`."""
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+            self.weight = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'weight': self.weight,
+            'max_weight': self.max_weight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def _remove(self, key):
+        value, weight, expires, tags = self._entries.pop(key)
+        self.weight -= weight
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
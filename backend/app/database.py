@@ -0,0 +1,100 @@
+import logging
+import random
+import time
+from functools import wraps
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+
+def database_url(url):
+    """Return `url` with the postgres:// scheme some hosts use renamed to postgresql://."""
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(url, pool_size=5, max_overflow=10, pool_recycle=1800, pool_pre_ping=True, pool_timeout=30):
+    """Return the create_engine() options of the database at `url`.
+
+    Client-server databases get a connection pool of `pool_size` connections,
+    up to `max_overflow` more under load, waiting `pool_timeout` seconds for
+    one when all are busy. Connections are replaced after `pool_recycle`
+    seconds, before the server or a proxy drops them, and checked when taken
+    from the pool with `pool_pre_ping`. SQLite keeps the pool SQLAlchemy
+    picks for it, since its connections are cheap local file handles.
+    """
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': pool_pre_ping,
+        'pool_timeout': pool_timeout,
+    }
+
+
+def configure_sqlite(engine, pragmas):
+    """Run `PRAGMA name = value` for every item of `pragmas` on each new connection of `engine`.
+
+    Pragmas set to None are left to their SQLite default.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                if value is not None:
+                    cursor.execute(f'PRAGMA {name} = {value}')
+        finally:
+            cursor.close()
+
+
+# SQLSTATE of PostgreSQL serialization failures and deadlocks, which abort
+# the transaction but succeed when it is run again
+POSTGRESQL_RETRY_CODES = ('40001', '40P01')
+
+
+def is_lock_error(error):
+    """Whether `error` is a transaction losing a lock conflict, as opposed to a real failure."""
+    if not isinstance(error, OperationalError):
+        return False
+    orig = getattr(error, 'orig', error)
+    if getattr(orig, 'pgcode', None) in POSTGRESQL_RETRY_CODES:
+        return True
+    message = str(orig).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def retry_on_lock(session, retries=5, delay=0.05):
+    """Decorator running a write transaction again when the database reports lock contention.
+
+    busy_timeout makes SQLite wait for the write lock, but a transaction can
+    still fail once it expires, or at once when it read a snapshot that
+    another writer changed before it could write. The session is rolled back
+    and the function called again up to `retries` times, after a random delay
+    doubling at each attempt. PostgreSQL serialization failures and deadlocks
+    are retried the same way. The function must not have side effects outside
+    the transaction before its commit.
+
+    :param session: the session to roll back between attempts
+    :param delay: delay before the first retry, in seconds
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            for attempt in range(retries + 1):
+                try:
+                    return f(*args, **kwargs)
+                except OperationalError as e:
+                    if attempt == retries or not is_lock_error(e):
+                        raise
+                    session.rollback()
+                    wait = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+                    logger.warning('Database locked in %s, retrying in %.3fs', f.__name__, wait)
+                    time.sleep(wait)
+        return decorated
+    return decorator
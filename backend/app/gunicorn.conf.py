@@ -0,0 +1,59 @@
+"""Gunicorn settings, selected through environment variables at startup.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+SERVER_MODE picks the worker class:
+- gthread (default): each worker process serves GUNICORN_THREADS requests
+  at once, so slow uploads and downloads only hold a thread
+- gevent: each worker serves up to GEVENT_CONNECTIONS requests as greenlets,
+  for many long transfers; needs the gevent package
+- sync: one request at a time per worker, as gunicorn does by default
+"""
+import multiprocessing
+import os
+import glob
+import tempfile
+
+SERVER_MODES = ('sync', 'gthread', 'gevent')
+
+mode = os.environ.get('SERVER_MODE', 'gthread').lower()
+if mode not in SERVER_MODES:
+    raise ValueError(f'Invalid SERVER_MODE {mode!r}, expected one of {", ".join(SERVER_MODES)}')
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2, 8)))
+worker_class = mode
+threads = int(os.environ.get('GUNICORN_THREADS', 16)) if mode == 'gthread' else 1
+worker_connections = int(os.environ.get('GEVENT_CONNECTIONS', 1000))
+# Seconds a worker may stay silent before being restarted. Threaded and
+# gevent workers keep notifying the arbiter during long transfers.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30 if mode == 'sync' else 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Workers share their request metrics through this folder, see metrics.py.
+# Servers sharing a host need their own folder.
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'appstore-metrics'))
+
+
+def on_starting(server):
+    # Counters start from zero with the server
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    # Keep the counters of the worker in a single file for all exited workers
+    from metrics import merge_process
+    merge_process(os.environ['METRICS_DIR'], worker.pid)
+
+
+def post_worker_init(worker):
+    if mode != 'gevent':
+        return
+    # Make psycopg2 yield to other greenlets while waiting for PostgreSQL
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    patch_psycopg()
@@ -0,0 +1,53 @@
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional, images are then only served as uploaded
+    Image = None
+
+# Widths of the generated variants, in pixels
+VARIANT_WIDTHS = (160, 320, 640)
+# Variant width used as the thumbnail of catalog cards
+THUMBNAIL_WIDTH = 320
+
+
+def available():
+    return Image is not None
+
+
+def make_variants(path, widths=VARIANT_WIDTHS, quality=80):
+    """Return resized copies of the image at `path`, without its metadata.
+
+    Every width gets a WebP copy and a copy in a widely supported format:
+    PNG for images with transparency, JPEG otherwise. Images are never
+    upscaled, widths above the image width are replaced by the image width.
+    Each variant is a dict with width, height, format, extension and the
+    encoded data. Raises OSError when the file is not a readable image.
+    """
+    try:
+        with Image.open(path) as image:
+            # Apply the EXIF orientation, since EXIF data is not copied over
+            image = ImageOps.exif_transpose(image)
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+            fallback = ('PNG', '.png') if has_alpha else ('JPEG', '.jpg')
+
+            variants = []
+            for width in sorted({min(width, image.width) for width in widths}):
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+                for format, extension in (('WEBP', '.webp'), fallback):
+                    data = io.BytesIO()
+                    options = {'optimize': True} if format == 'PNG' else {'quality': quality}
+                    resized.save(data, format, **options)
+                    variants.append({
+                        'width': width,
+                        'height': height,
+                        'format': format.lower(),
+                        'extension': extension,
+                        'data': data.getvalue()
+                    })
+            return variants
+    except (SyntaxError, Image.DecompressionBombError) as e:
+        # Malformed headers and images over Image.MAX_IMAGE_PIXELS
+        raise OSError(f'Cannot read the image {path}: {e}') from e
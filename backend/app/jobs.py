@@ -0,0 +1,142 @@
+import json
+import logging
+import time
+import traceback
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(object):
+    """Background jobs persisted in a database table and run by worker processes.
+
+    Jobs are rows of `model`, added to the session of `db` by enqueue() so
+    that they are committed, or rolled back, with the write that needs them.
+    Workers claim queued jobs one at a time, run the handler registered for
+    their kind, and retry failed jobs with an exponential backoff until
+    they run out of attempts.
+
+    In eager mode dispatch() runs the jobs enqueued by the current session
+    right away instead, which is convenient for tests and development.
+
+    :param db: the Flask-SQLAlchemy extension
+    :param model: the job model, see Job in app.py
+    :param retry_delay: delay before the first retry, in seconds, doubled for each retry
+    :param timeout: seconds after which a running job is considered abandoned by its worker
+    """
+
+    def __init__(self, db, model, retry_delay=10, timeout=3600, eager=False):
+        self.db = db
+        self.model = model
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.eager = eager
+        self.handlers = {}
+
+    def task(self, kind, max_attempts=3):
+        """Register the decorated function as the handler of `kind` jobs."""
+        def decorator(f):
+            self.handlers[kind] = (f, max_attempts)
+            return f
+        return decorator
+
+    def enqueue(self, kind, user_id=None, **payload):
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job kind: {kind}')
+        job = self.model(kind=kind, user_id=user_id, payload=json.dumps(payload),
+                         status='queued', attempts=0, max_attempts=self.handlers[kind][1],
+                         run_after=datetime.utcnow())
+        session = self.db.session
+        session.add(job)
+        session.info.setdefault('enqueued_jobs', []).append(job)
+        return job
+
+    def dispatch(self):
+        """Run the jobs enqueued by the session, after its commit, in eager mode."""
+        jobs = self.db.session.info.pop('enqueued_jobs', [])
+        if self.eager:
+            for job in jobs:
+                job_id = job.id
+                if self.claim(job_id):
+                    self.run(self.db.session.get(self.model, job_id))
+
+    def claim(self, job_id, worker=None):
+        """Mark a queued job as running, return False if another worker took it first."""
+        model = self.model
+        claimed = self.db.session.execute(
+            self.db.update(model)
+            .where(model.id == job_id, model.status == 'queued')
+            .values(status='running', attempts=model.attempts + 1, worker=worker,
+                    started_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        self.db.session.commit()
+        return claimed
+
+    def claim_next(self, worker=None):
+        """Claim the next job due, and return it or None."""
+        model = self.model
+        while True:
+            job_id = self.db.session.execute(
+                self.db.select(model.id)
+                .where(model.status == 'queued', model.run_after <= datetime.utcnow())
+                .order_by(model.run_after, model.id)
+                .limit(1)
+            ).scalar()
+            if job_id is None:
+                self.db.session.commit()
+                return None
+            if self.claim(job_id, worker):
+                return self.db.session.get(self.model, job_id)
+
+    def run(self, job):
+        handler, _ = self.handlers[job.kind]
+        job_id = job.id
+        try:
+            result = handler(**json.loads(job.payload))
+        except Exception:
+            logger.exception('Job %s (%s) failed', job_id, job.kind)
+            self.db.session.rollback()
+            job = self.db.session.get(self.model, job_id)
+            job.error = traceback.format_exc()
+            if job.attempts < job.max_attempts:
+                job.status = 'queued'
+                job.run_after = datetime.utcnow() + timedelta(
+                    seconds=self.retry_delay * 2 ** (job.attempts - 1))
+            else:
+                job.status = 'failed'
+                job.finished_at = datetime.utcnow()
+        else:
+            job = self.db.session.get(self.model, job_id)
+            job.status = 'done'
+            job.result = json.dumps(result)
+            job.error = None
+            job.finished_at = datetime.utcnow()
+        self.db.session.commit()
+
+    def requeue_abandoned(self):
+        """Put back the jobs whose worker died while running them."""
+        model = self.model
+        expired = datetime.utcnow() - timedelta(seconds=self.timeout)
+        self.db.session.execute(
+            self.db.update(model)
+            .where(model.status == 'running', model.started_at < expired)
+            .values(status='queued', run_after=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        self.db.session.commit()
+
+    def work(self, worker=None, poll_interval=1.0, burst=False):
+        """Run jobs until interrupted, or until the queue is empty when `burst` is set."""
+        self.requeue_abandoned()
+        while True:
+            job = self.claim_next(worker)
+            if job is None:
+                if burst:
+                    return
+                time.sleep(poll_interval)
+                self.requeue_abandoned()
+                continue
+            logger.info('Running job %s (%s)', job.id, job.kind)
+            self.run(job)
+            self.db.session.remove()
@@ -0,0 +1,362 @@
+import contextvars
+import fcntl
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+
+# Upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Environ key where the Flask app records the URL rule of the request
+ROUTE_KEY = 'appstore.route'
+
+COUNTERS = {
+    'appstore_requests_total': 'Requests served, by route, method and status',
+    'appstore_request_sql_statements_total': 'SQL statements run by requests',
+    'appstore_request_sql_seconds_total': 'Time spent in SQL statements by requests',
+    'appstore_request_json_seconds_total': 'Time spent encoding JSON responses',
+    'appstore_response_bytes_total': 'Bytes of response bodies',
+}
+HISTOGRAMS = {
+    'appstore_request_duration_seconds': 'Time to serve requests, from the start of the request to the last byte',
+}
+
+# File of the metrics directory holding the values of exited processes
+DEAD_FILE = 'dead.json'
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class RequestStats(object):
+    """What one request spent, filled in by the SQL and JSON hooks while it runs."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.json_seconds = 0.0
+        self.samples = None
+
+
+class MetricsRegistry(object):
+    """Counters and histograms of one process, merged with other processes through files.
+
+    Each process writes its values to `directory` every `flush_interval`
+    seconds while they change, in a file named after its pid, and render()
+    sums the files of every process, so any gunicorn worker reports the
+    totals of all of them. The files of exited workers are added to
+    DEAD_FILE by merge_process(), so counters never go backwards while the
+    directory keeps one file per live worker. Without a directory, only
+    this process is reported.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.values = Counter()
+        self._dirty = False
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._changed()
+            self.values[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._changed()
+            for bound in DURATION_BUCKETS + (float('inf'),):
+                if value <= bound:
+                    self.values[(name + '_bucket', tuple(sorted({**labels, 'le': bound}.items())))] += 1
+            key = tuple(sorted(labels.items()))
+            self.values[(name + '_sum', key)] += value
+            self.values[(name + '_count', key)] += 1
+
+    def _changed(self):
+        self._dirty = True
+        # Started in each worker, threads do not survive the fork
+        if self.directory and self._flusher_pid != os.getpid():
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._flush_periodically, name='metrics-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            self._dirty = False
+            values = Counter(self.values)
+        write_values(os.path.join(self.directory, f'{os.getpid()}.json'), values)
+
+    def collect(self):
+        """Return the values of every process, summed."""
+        if not self.directory:
+            with self._lock:
+                return Counter(self.values)
+        self.flush()
+        values = Counter()
+        # Not while the file of an exited process moves into DEAD_FILE
+        with locked(self.directory, fcntl.LOCK_SH):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    read_values(os.path.join(self.directory, name), values)
+        return values
+
+    def render(self):
+        """The collected values in the Prometheus text exposition format."""
+        values = self.collect()
+        lines = []
+        for kind, metrics in (('counter', COUNTERS), ('histogram', HISTOGRAMS)):
+            for metric, help in metrics.items():
+                lines.append(f'# HELP {metric} {help}')
+                lines.append(f'# TYPE {metric} {kind}')
+                samples = [(name, labels, value) for (name, labels), value in values.items()
+                           if name == metric or name.rsplit('_', 1)[0] == metric]
+                for name, labels, value in sorted(samples, key=sample_order):
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def read_values(path, values):
+    """Add the values saved at `path` to the `values` Counter, if the file exists."""
+    try:
+        with open(path) as f:
+            for metric, labels, value in json.load(f):
+                values[(metric, tuple(tuple(label) for label in labels))] += value
+    except FileNotFoundError:
+        pass
+
+
+def write_values(path, values):
+    with open(path + '.tmp', 'w') as f:
+        json.dump([[name, list(labels), value] for (name, labels), value in values.items()], f)
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def locked(directory, operation):
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def merge_process(directory, pid):
+    """Add the values of the exited process `pid` to DEAD_FILE and remove its file."""
+    path = os.path.join(directory, f'{pid}.json')
+    if not os.path.exists(path):
+        return
+    with locked(directory, fcntl.LOCK_EX):
+        values = Counter()
+        read_values(path, values)
+        read_values(os.path.join(directory, DEAD_FILE), values)
+        write_values(os.path.join(directory, DEAD_FILE), values)
+        os.remove(path)
+
+
+def sample_order(sample):
+    name, labels, value = sample
+    labels = dict(labels)
+    return name, sorted((k, v) for k, v in labels.items() if k != 'le'), float(labels.get('le', 0))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = format_value(value) if name == 'le' else str(value)
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def track_sql(engine):
+    """Add the statements run on `engine`, and their time, to the current request."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        stats = current_request.get()
+        if stats is not None:
+            stats.sql_statements += 1
+            stats.sql_seconds += time.perf_counter() - start
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider adding the time spent encoding responses to the current request."""
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            stats = current_request.get()
+            if stats is not None:
+                stats.json_seconds += time.perf_counter() - start
+
+
+class SamplingProfiler(object):
+    """Sample the stacks of the threads serving requests, every `interval` seconds.
+
+    Stacks of requests slower than `threshold` seconds are appended to
+    `directory` in the collapsed format of flamegraph.pl and speedscope, one
+    file per route and day. Greenlets share their thread, so only threaded
+    and sync workers are profiled.
+    """
+
+    def __init__(self, directory, threshold, interval=0.005):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self._requests = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._run, name='sampling-profiler', daemon=True).start()
+
+    def start(self, stats):
+        stats.samples = Counter()
+        with self._lock:
+            self._requests[threading.get_ident()] = stats
+
+    def stop(self, stats, route, duration):
+        with self._lock:
+            self._requests.pop(threading.get_ident(), None)
+        if duration < self.threshold or not stats.samples:
+            return
+        name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        with open(os.path.join(self.directory, f'{time.strftime("%Y%m%d")}-{name}.folded'), 'a') as f:
+            for stack, count in stats.samples.items():
+                f.write(f'{stack} {count}\n')
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            # Held while sampling, so stop() never sees samples being added
+            with self._lock:
+                if not self._requests:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stats in self._requests.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                        frame = frame.f_back
+                    if stack:
+                        stats.samples[';'.join(reversed(stack))] += 1
+
+
+class MetricsMiddleware(object):
+    """WSGI middleware recording the latency, SQL work and response size of each request.
+
+    The wrapped Flask app stores the URL rule of the request in
+    environ['appstore.route'], so that requests are labelled by route
+    rather than by URL; requests matching no route are labelled 'unmatched'.
+
+    :param app: the WSGI application
+    :param registry: the MetricsRegistry to record to
+    :param profiler: an optional SamplingProfiler
+    """
+
+    def __init__(self, app, registry, profiler=None):
+        self.app = app
+        self.registry = registry
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats()
+        token = current_request.set(stats)
+        if self.profiler is not None:
+            self.profiler.start(stats)
+        response = {}
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            response['status'] = status_line.split(' ', 1)[0]
+            response['length'] = next((int(value) for name, value in headers
+                                       if name.lower() == 'content-length' and value.isdigit()), 0)
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.app(environ, recording_start_response)
+        except Exception:
+            self.record(environ, stats, '500', 0)
+            raise
+        finally:
+            current_request.reset(token)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Wrapping the file would prevent the server from using sendfile,
+            # so the time to send it is not included
+            self.record(environ, stats, response.get('status', '500'), response.get('length', 0))
+            return body
+        return ResponseIterator(body, lambda size: self.record(environ, stats, response.get('status', '500'), size))
+
+    def record(self, environ, stats, status, size):
+        duration = time.perf_counter() - stats.start
+        route = environ.get(ROUTE_KEY, 'unmatched')
+        labels = {'route': route, 'method': environ.get('REQUEST_METHOD', '')}
+        registry = self.registry
+        registry.inc('appstore_requests_total', {**labels, 'status': status})
+        registry.observe('appstore_request_duration_seconds', labels, duration)
+        registry.inc('appstore_request_sql_statements_total', labels, stats.sql_statements)
+        registry.inc('appstore_request_sql_seconds_total', labels, stats.sql_seconds)
+        registry.inc('appstore_request_json_seconds_total', labels, stats.json_seconds)
+        registry.inc('appstore_response_bytes_total', labels, size)
+        if self.profiler is not None:
+            self.profiler.stop(stats, route, duration)
+
+
+class ResponseIterator(object):
+    """Pass a response body through, calling `on_close` with its size once it is sent."""
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+        self.finish()
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish()
+
+    def finish(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close(self.size)
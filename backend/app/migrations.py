@@ -0,0 +1,61 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class Migrations(object):
+    """Versioned schema changes, applied in order once per database.
+
+    Migrations are functions of a connection registered with migration()
+    under increasing version numbers. upgrade() runs the ones not recorded
+    in the table of `model` yet, each in its own transaction along with its
+    record, so a failed migration is rolled back and retried by the next
+    upgrade. It is meant to run once at deploy time, not when the app starts.
+
+    :param db: the Flask-SQLAlchemy extension
+    :param model: the model recording applied migrations, see SchemaMigration in app.py
+    """
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+        self.steps = {}
+
+    def migration(self, version, description):
+        """Register the decorated function as the migration to `version`."""
+        def decorator(f):
+            if version in self.steps:
+                raise ValueError(f'Duplicate migration version: {version}')
+            self.steps[version] = (description, f)
+            return f
+        return decorator
+
+    @property
+    def head(self):
+        return max(self.steps, default=0)
+
+    def applied(self, connection):
+        table = self.model.__table__
+        table.create(connection, checkfirst=True)
+        return set(connection.execute(self.db.select(table.c.version)).scalars())
+
+    def pending(self):
+        with self.db.engine.begin() as connection:
+            applied = self.applied(connection)
+        return [version for version in sorted(self.steps) if version not in applied]
+
+    def upgrade(self, target=None):
+        """Apply the pending migrations up to `target` (all when None), return their versions."""
+        done = []
+        for version in self.pending():
+            if target is not None and version > target:
+                break
+            description, f = self.steps[version]
+            logger.info('Applying migration %s: %s', version, description)
+            with self.db.engine.begin() as connection:
+                f(connection)
+                connection.execute(self.model.__table__.insert().values(
+                    version=version, description=description, applied_at=datetime.utcnow()))
+            done.append(version)
+        return done
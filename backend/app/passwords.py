@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+def gevent_threadpool():
+    """The pool of native threads of gevent when threads are monkey-patched, else None."""
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return None
+    return get_hub().threadpool if monkey.is_module_patched('threading') else None
+
+
+class PasswordHasher(object):
+    """Password hashing on a bounded pool of threads.
+
+    scrypt and PBKDF2 are deliberately slow, so a burst of logins could keep
+    every web worker busy hashing. At most `workers` hashes run at once per
+    process, the hash functions releasing the GIL meanwhile, and up to
+    `max_pending` more wait for a thread. Beyond that, or after waiting
+    `timeout` seconds, ServiceUnavailable is raised so the request fails fast.
+    Under gevent, hashes run on its native threads so they do not block the
+    event loop.
+
+    :param method: Werkzeug hash method with its cost parameters, such as
+        scrypt:32768:8:1 or pbkdf2:sha256:600000
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_pending=16, timeout=10):
+        # Werkzeug expands defaults into the prefix of the hash, as in
+        # scrypt -> scrypt:32768:8:1, which is what needs_rehash() compares
+        self.method = generate_password_hash('', method).split('$', 1)[0]
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def _run(self, f, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise ServiceUnavailable('Too many password checks in progress, please retry')
+        try:
+            threadpool = gevent_threadpool()
+            if threadpool is not None:
+                return threadpool.spawn(f, *args).get()
+            return self._executor.submit(f, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether `pwhash` was made with another method or cost than the configured one."""
+        return pwhash.split('$', 1)[0] != self.method
@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+import time
+
+from cache import LRUCache
+
+
+class MemoryBucketStore(object):
+    """Token buckets of one process, the least recently used dropped beyond `max_keys`.
+
+    A dropped bucket is simply full again the next time it is used.
+    """
+
+    def __init__(self, max_keys=100000):
+        self._buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets.set(key, (tokens - 1 if allowed else tokens, now))
+            return 0.0 if allowed else (1 - tokens) / rate
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class SQLiteBucketStore(object):
+    """Token buckets in an SQLite file, shared by the processes of one host.
+
+    Each bucket is read and updated in an immediate transaction, so
+    concurrent requests of several gunicorn workers cannot both take the
+    last token.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, rate, now):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens - 1 if allowed else tokens, now))
+            # Buckets idle long enough to be full again carry no information
+            connection.execute('DELETE FROM bucket WHERE updated < ? - ? / ?', (now, capacity, rate))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return 0.0 if allowed else (1 - tokens) / rate
+
+    def clear(self):
+        self._connection().execute('DELETE FROM bucket')
+
+
+class TokenBucketLimiter(object):
+    """Allow `per_minute` requests per minute and key, in bursts of up to `burst`.
+
+    :param store: a MemoryBucketStore or SQLiteBucketStore
+    :param prefix: namespace of the keys of this limiter in the store
+    """
+
+    def __init__(self, store, per_minute, burst=None, prefix=''):
+        self.store = store
+        self.rate = per_minute / 60.0
+        self.capacity = burst or per_minute
+        self.prefix = prefix
+
+    def hit(self, key):
+        """Take a token for `key`, return 0 when allowed, else the seconds to wait for one."""
+        return self.store.take(self.prefix + key, self.capacity, self.rate, time.time())
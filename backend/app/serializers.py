@@ -0,0 +1,99 @@
+import json
+from datetime import datetime
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, responses are then encoded by the json module
+    orjson = None
+
+
+class Schema(object):
+    """JSON representation of a model, compiled into a function building the dict.
+
+    Each field maps a key to an attribute path of the serialized object,
+    which may be an ORM instance or a row of a query selecting only the
+    needed columns, optionally followed by a conversion function. A field
+    may also be a nested Schema, serialized from the same object.
+
+        Schema(id='id', seller=Schema(id='seller_id', name='seller.name'),
+               tags=('tags', json.loads))
+
+    The generated function is a single dict display, which is about as fast
+    as building a dict by hand. dump_many() reads rows by position rather
+    than by name, several times faster for SQLAlchemy rows. Datetimes are
+    left for the JSON provider to format.
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.dump = self._build(lambda path: 'obj.' + path)
+        # Functions reading rows by position, per tuple of column names
+        self._row_dumps = {}
+
+    def _build(self, access):
+        namespace = {}
+        exec(f'def dump(obj):\n    return {self._compile(access, namespace)}', namespace)
+        return namespace['dump']
+
+    def _compile(self, access, namespace):
+        items = []
+        for key, field in self.fields.items():
+            if isinstance(field, Schema):
+                value = field._compile(access, namespace)
+            else:
+                path, convert = (field, None) if isinstance(field, str) else field
+                value = access(path)
+                if convert is not None:
+                    name = f'convert_{len(namespace)}'
+                    namespace[name] = convert
+                    value = f'{name}({value})'
+            items.append(f'{key!r}: {value}')
+        return '{' + ', '.join(items) + '}'
+
+    def dump_many(self, objs):
+        objs = list(objs)
+        if not objs:
+            return []
+        fields = getattr(objs[0], '_fields', None)
+        if fields is None:
+            dump = self.dump
+        else:
+            dump = self._row_dumps.get(fields)
+            if dump is None:
+                dump = self._row_dumps[fields] = self._build(lambda path: f'obj[{fields.index(path)}]')
+        return [dump(obj) for obj in objs]
+
+
+def default(o):
+    """Encode what the json module cannot, datetimes as ISO 8601 like orjson does."""
+    if isinstance(o, datetime):
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider encoding with orjson when it is installed.
+
+    orjson formats datetimes itself and is several times faster than the
+    json module on large lists of dicts. Keys are not sorted. Calls with
+    other json.dumps() options than those of Flask, and environments without
+    orjson, fall back to the json module.
+    """
+
+    default = staticmethod(default)
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        # Flask asks for compact output, or for an indent of 2 in debug mode
+        if orjson is None or not set(kwargs) <= {'separators', 'indent'} or \
+                kwargs.get('separators', (',', ':')) != (',', ':') or kwargs.get('indent', 2) != 2:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if 'indent' in kwargs else 0)
+        return orjson.dumps(obj, default=default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
@@ -0,0 +1,74 @@
+import gzip
+import threading
+from functools import cached_property
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, snapshots are then only gzipped
+    brotli = None
+
+
+def assemble_listing(fragments):
+    """The JSON array of the pre-rendered `fragments`, as jsonify() would render the list."""
+    return ('[' + ','.join(fragments) + ']\n').encode()
+
+
+def compress_listing(body, gzip_level=9, brotli_quality=9):
+    """Return the gzip and brotli encodings of `body`, brotli being None when it is not installed."""
+    return (gzip.compress(body, gzip_level, mtime=0),
+            brotli.compress(body, quality=brotli_quality) if brotli is not None else None)
+
+
+class Snapshot(object):
+    """Pre-compressed body of a catalog generation."""
+
+    def __init__(self, epoch, generation, gzip_body, brotli_body=None):
+        self.key = (epoch, generation)
+        self.gzip_body = gzip_body
+        self.brotli_body = brotli_body
+
+    @cached_property
+    def identity_body(self):
+        # For the few clients accepting neither encoding, decompressed once per worker
+        return gzip.decompress(self.gzip_body)
+
+    def encode(self, accept_encodings):
+        """Return the body to send to a client with these Accept-Encoding values, and its encoding."""
+        if self.brotli_body is not None and accept_encodings['br'] > 0:
+            return self.brotli_body, 'br'
+        if accept_encodings['gzip'] > 0:
+            return self.gzip_body, 'gzip'
+        return self.identity_body, None
+
+
+class SnapshotCache(object):
+    """The last snapshot built by this worker, rebuilt when the catalog generation moves.
+
+    Threads asking for a new generation at once wait for a single build.
+
+    :param load: function of an (epoch, generation) key returning its Snapshot, or None
+        when the stored entries are at another generation
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.current = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the snapshot of the (epoch, generation) `key`, or None when the entries are at another one."""
+        current = self.current
+        if current is not None and current.key == key:
+            return current
+        with self.lock:
+            current = self.current
+            if current is not None and current.key == key:
+                return current
+            snapshot = self.load(key)
+            if snapshot is None:
+                return None
+            self.current = snapshot
+            return snapshot
+
+    def clear(self):
+        self.current = None
@@ -1,21 +1,70 @@
 import unittest
+import gzip
 import json
 import io
+import os
+import hashlib
+import shutil
 import logging
-from app import app, db, User, Product
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import OperationalError
+import images
+
+# Run against SQLite in a temporary folder, against a throwaway PostgreSQL
+# server started by testing.postgresql from the local PostgreSQL binaries
+# when TEST_DATABASE=postgresql, or against the database at
+# TEST_DATABASE_URL. The app reads DATABASE_URL when it is imported.
+test_server = None
+if os.environ.get('TEST_DATABASE_URL'):
+    os.environ['DATABASE_URL'] = os.environ['TEST_DATABASE_URL']
+elif os.environ.get('TEST_DATABASE') == 'postgresql':
+    import testing.postgresql
+    test_server = testing.postgresql.Postgresql()
+    os.environ['DATABASE_URL'] = test_server.url()
+else:
+    os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/appstore.db'
+
+from database import database_url, engine_options
+from ratelimit import SQLiteBucketStore, TokenBucketLimiter
+from werkzeug.security import generate_password_hash
+from app import app, auth_rate_store, bump_catalog_generation, db, password_hasher, User, Product, Review, Blob, job_queue, migrations, principal_cache, PRODUCT_SCHEMA, product_rows, response_cache, update_rating_aggregates, Upload, upload_hashers, write_transaction
+import benchmark
+from metrics import MetricsMiddleware, MetricsRegistry, SamplingProfiler, merge_process
+from serializers import Schema
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+with app.app_context():
+    DIALECT = db.engine.dialect.name
+
+def tearDownModule():
+    if test_server is not None:
+        test_server.stop()
+
+def requires_dialect(*names):
+    """Skip the decorated test unless the suite runs against one of these database dialects."""
+    return unittest.skipUnless(DIALECT in names, f'needs {" or ".join(names)}, running on {DIALECT}')
+
 class FlaskTestCase(unittest.TestCase):
 
     def setUp(self):
         logger.debug("Setting up test environment")
         app.config['TESTING'] = True
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
-        app.config['UPLOAD_FOLDER'] = 'uploads'
+        app.config['UPLOAD_FOLDER'] = self.temporary_folder()
         self.app = app.test_client()
+        principal_cache.clear()
+        auth_rate_store.clear()
         with app.app_context():
             db.create_all()
         logger.info("Test database and client set up")
@@ -27,6 +76,58 @@ class FlaskTestCase(unittest.TestCase):
             db.drop_all()
         logger.info("Test database torn down")
 
+    def temporary_folder(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        return folder
+
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    def auth_headers(self, email='test@example.com'):
+        response = self.app.post('/api/auth/register',
+                                 data=json.dumps({'name': 'Test User', 'email': email,
+                                                  'password': 'testpassword'}),
+                                 content_type='application/json')
+        return {'Authorization': f'Bearer {json.loads(response.data)["token"]}'}
+
+    def seed_catalog(self, titles, versions=('1.0.0', '1.1.0'), reviews=2):
+        with app.app_context():
+            seller = User.query.filter_by(email='seller@example.com').first()
+            if seller is None:
+                seller = User(name='Seller', email='seller@example.com', password='x')
+                db.session.add(seller)
+                db.session.flush()
+            for title in titles:
+                for version in versions:
+                    product = Product(title=title, description='desc', price=0.0,
+                                      image_name='', version=version, license='MIT',
+                                      seller_id=seller.id, oncodash_version='1.0')
+                    db.session.add(product)
+                    db.session.flush()
+                    for i in range(reviews):
+                        reviewer = User(name=f'Reviewer {title} {version} {i}',
+                                        email=f'{title}-{version}-{i}@example.com', password='x')
+                        db.session.add(reviewer)
+                        db.session.flush()
+                        db.session.add(Review(product_id=product.id, user_id=reviewer.id,
+                                              rating=4, comment='ok'))
+            db.session.flush()
+            update_rating_aggregates()
+            db.session.commit()
+
     def test_register(self):
         logger.debug("Starting test_register")
         response = self.app.post('/api/auth/register',
@@ -78,6 +179,696 @@ class FlaskTestCase(unittest.TestCase):
         self.assertIsInstance(data, list)
         logger.debug("test_get_products completed")
 
+    def test_get_products_returns_latest_versions(self):
+        self.seed_catalog(['Alpha', 'Beta'])
+        response = self.app.get('/api/products')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([p['title'] for p in data], ['Alpha', 'Beta'])
+        self.assertEqual({p['version'] for p in data}, {'1.1.0'})
+        self.assertEqual(data[0]['reviewCount'], 2)
+        self.assertEqual(data[0]['rating'], 4.0)
+        self.assertNotIn('reviews', data[0])
+
+    def test_product_reviews_are_paginated(self):
+        self.seed_catalog(['Alpha'], versions=('1.0.0',), reviews=3)
+        with app.app_context():
+            product_id = Product.query.filter_by(title='Alpha').one().id
+
+        response = self.app.get(f'/api/products/{product_id}/reviews?limit=2')
+        self.assertEqual(response.status_code, 200)
+        page = json.loads(response.data)
+        self.assertEqual(len(page['reviews']), 2)
+        response = self.app.get(f'/api/products/{product_id}/reviews?limit=2&cursor={page["next_cursor"]}')
+        last_page = json.loads(response.data)
+        self.assertEqual(len(last_page['reviews']), 1)
+        self.assertIsNone(last_page['next_cursor'])
+        self.assertEqual(len({r['id'] for r in page['reviews'] + last_page['reviews']}), 3)
+        self.assertTrue(last_page['reviews'][0]['userName'].startswith('Reviewer Alpha'))
+
+    def test_add_review_updates_rating_aggregates(self):
+        self.seed_catalog(['Alpha'], versions=('1.0.0',), reviews=1)
+        with app.app_context():
+            product_id = Product.query.filter_by(title='Alpha').one().id
+        response = self.app.post('/api/auth/register',
+                                 data=json.dumps({'name': 'Critic', 'email': 'critic@example.com',
+                                                  'password': 'testpassword'}),
+                                 content_type='application/json')
+        token = json.loads(response.data)['token']
+
+        response = self.app.post(f'/api/reviews/{product_id}',
+                                 data=json.dumps({'rating': 1, 'comment': 'meh'}),
+                                 headers={'Authorization': f'Bearer {token}'},
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(self.app.get(f'/api/products/{product_id}').data)
+        self.assertEqual(data['reviewCount'], 2)
+        self.assertEqual(data['rating'], 2.5)
+        self.assertEqual(len(data['reviews']), 2)
+
+    def test_get_products_query_count_is_constant(self):
+        # Call the listing view beneath the catalog snapshot and the response
+        # cache, so that the listing query itself is measured
+        view = app.view_functions['get_products']
+        while hasattr(view, '__wrapped__'):
+            view = view.__wrapped__
+
+        def list_products():
+            with app.test_request_context('/api/products'), self.count_queries() as statements:
+                products = view().get_json()
+            return len(products), len(statements)
+
+        self.seed_catalog(['Alpha', 'Beta'], reviews=0)
+        small, small_queries = list_products()
+        self.seed_catalog([f'Plugin {i}' for i in range(20)], versions=('1.0.0', '1.1.0', '1.2.0'), reviews=3)
+        large, large_queries = list_products()
+        self.assertEqual((small, large), (2, 22))
+        self.assertEqual(large_queries, small_queries)
+        self.assertEqual(large_queries, 1)
+
+    def test_get_products_paginates_with_cursor(self):
+        self.seed_catalog([f'Plugin {i:02d}' for i in range(5)], versions=('1.0.0',), reviews=0)
+        titles = []
+        cursor = None
+        while True:
+            url = '/api/products?limit=2' + (f'&cursor={cursor}' if cursor else '')
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            self.assertLessEqual(len(page['products']), 2)
+            titles.extend(p['title'] for p in page['products'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(titles, [f'Plugin {i:02d}' for i in range(5)])
+
+    def test_get_products_filters_and_sorts(self):
+        self.seed_catalog(['Alpha', 'Beta'], versions=('1.0.0',), reviews=0)
+        with app.app_context():
+            Product.query.filter_by(title='Beta').update({'category': 'viz'})
+            db.session.commit()
+        response = self.app.get('/api/products?category=viz')
+        self.assertEqual([p['title'] for p in json.loads(response.data)], ['Beta'])
+
+        response = self.app.get('/api/products?sort=newest&limit=10')
+        self.assertEqual([p['title'] for p in json.loads(response.data)['products']], ['Beta', 'Alpha'])
+
+        self.assertEqual(self.app.get('/api/products?sort=price').status_code, 400)
+        self.assertEqual(self.app.get('/api/products?seller_id=me').status_code, 400)
+        self.assertEqual(self.app.get('/api/products?limit=2&cursor=garbage').status_code, 400)
+
+    def test_latest_version_uses_semantic_ordering(self):
+        self.seed_catalog(['Alpha'], versions=('1.9.0', '1.10.0-rc.1', '1.10.0'), reviews=0)
+        with app.app_context():
+            latest = Product.query.filter_by(title='Alpha', is_latest=True).one()
+            self.assertEqual(latest.version, '1.10.0')
+            self.assertTrue(latest.is_latest_version)
+
+            db.session.delete(latest)
+            db.session.commit()
+            product = Product.query.filter_by(title='Alpha', is_latest=True).one()
+            self.assertEqual(product.version, '1.10.0-rc.1')
+
+            product.version = '1.10.1'
+            db.session.commit()
+            self.assertTrue(product.is_latest)
+            product_id = product.id
+
+        data = json.loads(self.app.get(f'/api/products/{product_id}').data)
+        self.assertEqual([v['version'] for v in data['versions']], ['1.10.1', '1.9.0'])
+
+    def test_latest_version_uses_prerelease_precedence(self):
+        self.seed_catalog(['Alpha'], versions=('2.0.0-rc.9', '2.0.0-rc.10', '2.0.0-beta.11'), reviews=0)
+        self.seed_catalog(['Beta'], versions=('1.0.0.10', '1.0.0', '1.0.0.9'), reviews=0)
+        with app.app_context():
+            latest = {product.title: product.version for product in Product.query.filter_by(is_latest=True)}
+        self.assertEqual(latest, {'Alpha': '2.0.0-rc.10', 'Beta': '1.0.0.10'})
+
+        body = {'installed': [{'title': 'Alpha', 'version': '2.0.0-rc.9'}, {'title': 'Beta', 'version': '1.0.0.10'}]}
+        response = self.app.post('/api/updates/check', data=json.dumps(body), content_type='application/json')
+        self.assertEqual([(u['title'], u['product']['version']) for u in json.loads(response.data)['updates']],
+                         [('Alpha', '2.0.0-rc.10')])
+
+    def test_compat_resolves_newest_compatible_versions(self):
+        headers = self.auth_headers()
+        with app.app_context():
+            seller = User.query.filter_by(email='test@example.com').one()
+            for title, version, oncodash_version in [
+                    ('Alpha', '1.0.0', '>=1.0, <2'), ('Alpha', '1.1.0', '^1.2'), ('Alpha', '2.0.0', '2.x'),
+                    ('Beta', '0.9.0', '1.1'), ('Gamma', '1.0.0', '*')]:
+                db.session.add(Product(title=title, description='desc', price=0.0, image_name='',
+                                       version=version, license='MIT', seller_id=seller.id,
+                                       oncodash_version=oncodash_version))
+            db.session.commit()
+            gamma_id = Product.query.filter_by(title='Gamma').one().id
+
+        def resolve(oncodash_version):
+            return {p['title']: (p['version'], p['is_latest']) for p in
+                    json.loads(self.app.get(f'/api/compat/{oncodash_version}').data)['products']}
+
+        with self.count_queries() as statements:
+            self.assertEqual(resolve('1.1.5'), {'Alpha': ('1.0.0', False), 'Beta': ('0.9.0', True),
+                                                'Gamma': ('1.0.0', True)})
+        self.assertEqual(len([s for s in statements if 'product' in s.lower()]), 1)
+        self.assertEqual(resolve('1.4.0'), {'Alpha': ('1.1.0', False), 'Gamma': ('1.0.0', True)})
+        self.assertEqual(resolve('v2.0.1'), {'Alpha': ('2.0.0', True), 'Gamma': ('1.0.0', True)})
+        # <2 excludes the 2.0.0 prereleases, and 2.x starts at the release
+        self.assertEqual(resolve('2.0.0-rc.1'), {'Gamma': ('1.0.0', True)})
+        self.assertEqual(self.app.get('/api/compat/latest').status_code, 400)
+
+        response = self.app.put(f'/api/products/{gamma_id}', headers=headers,
+                                data=json.dumps({'oncodash_version': '1.x || 2.x'}),
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_check(self):
+        self.seed_catalog(['Alpha', 'Beta', 'Gamma'], reviews=0)
+
+        def check(installed, oncodash_version=None, headers=None):
+            body = {'installed': [{'title': title, 'version': version} for title, version in installed]}
+            if oncodash_version is not None:
+                body['oncodash_version'] = oncodash_version
+            return self.app.post('/api/updates/check', data=json.dumps(body), content_type='application/json',
+                                 headers=headers)
+
+        installed = [('Alpha', '1.0.0'), ('Beta', '1.1.0'), ('Gamma', '1.1.0-rc.1'), ('Unknown', '1.0')]
+        with self.count_queries() as statements:
+            response = check(installed)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 2)
+        updates = json.loads(response.data)['updates']
+        self.assertEqual([(u['title'], u['installed_version'], u['product']['version']) for u in updates],
+                         [('Alpha', '1.0.0', '1.1.0'), ('Gamma', '1.1.0-rc.1', '1.1.0')])
+        etag = response.headers['ETag']
+
+        # Same set in another order, unchanged catalog
+        with self.count_queries() as statements:
+            response = check(installed[::-1], headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(check(installed[:1], headers={'If-None-Match': etag}).status_code, 200)
+
+        # Only the ranges of the seeded versions, 1.0.x, count for another Oncodash
+        self.assertEqual(json.loads(check(installed, oncodash_version='1.0.2').data)['updates'], updates)
+        self.assertEqual(json.loads(check(installed, oncodash_version='2.0.0').data)['updates'], [])
+
+        with app.app_context():
+            product = Product.query.filter_by(title='Beta', version='1.1.0').one()
+            product.version = '1.2.0'
+            db.session.commit()
+        response = check(installed, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(('Beta', '1.2.0'), [(u['title'], u['product']['version'])
+                                          for u in json.loads(response.data)['updates']])
+
+        self.assertEqual(self.app.post('/api/updates/check', data='[]', content_type='application/json').status_code, 400)
+        self.assertEqual(check(installed, oncodash_version='latest').status_code, 400)
+
+    def test_catalog_conditional_get(self):
+        self.seed_catalog(['Alpha'], versions=('1.0.0',), reviews=0)
+        response = self.app.get('/api/products')
+        etag = response.headers['ETag']
+        self.assertIn('must-revalidate', response.headers['Cache-Control'])
+
+        with self.count_queries() as statements:
+            response = self.app.get('/api/products', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+
+        with app.app_context():
+            product = Product.query.filter_by(title='Alpha').one()
+            product.description = 'changed'
+            db.session.commit()
+            product_id = product.id
+        response = self.app.get('/api/products', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        detail = self.app.get(f'/api/products/{product_id}')
+        response = self.app.get(f'/api/products/{product_id}',
+                                headers={'If-None-Match': detail.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_schemas_serialize_rows_like_instances(self):
+        self.seed_catalog(['Alpha', 'Beta'], versions=('1.0.0',), reviews=1)
+        with app.app_context():
+            rows = product_rows().order_by(Product.id).all()
+            products = Product.query.order_by(Product.id).all()
+            schema = Schema(id='id', title='title', created_at='created_at',
+                            seller=Schema(id='seller_id', name=('seller.name', str.upper)))
+            by_name = [schema.dump(product) for product in products]
+            self.assertEqual(by_name[0]['seller']['name'], 'SELLER')
+            self.assertEqual(schema.dump_many(products), by_name)
+            self.assertEqual(PRODUCT_SCHEMA.dump_many(rows), [PRODUCT_SCHEMA.dump(row) for row in rows])
+
+            encoded = json.loads(app.json.dumps(by_name))
+            self.assertEqual(encoded[0]['created_at'], products[0].created_at.isoformat())
+            # Same output from the json module
+            with patch('serializers.orjson', None):
+                self.assertEqual(json.loads(app.json.dumps(by_name)), encoded)
+
+        listed = json.loads(self.app.get('/api/products').data)
+        self.assertEqual(listed[0]['seller']['name'], 'Seller')
+        self.assertEqual(listed[0]['reviewCount'], 1)
+        self.assertEqual(listed[0]['image_variants'], [])
+        self.assertEqual(json.loads(self.app.get(f'/api/products/{listed[0]["id"]}').data)['reviews'][0]['userName'],
+                         'Reviewer Alpha 1.0.0 0')
+
+    def test_catalog_responses_are_compressed(self):
+        self.seed_catalog([f'Product {i}' for i in range(20)], versions=('1.0.0',), reviews=0)
+        plain = self.app.get('/api/products')
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        response = self.app.get('/api/products', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(response.headers['ETag'], plain.headers['ETag'])
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+        response = self.app.get('/api/products', headers={'Accept-Encoding': 'gzip',
+                                                          'If-None-Match': plain.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get('/api/products', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        # Cached responses are stored compressed, once per encoding
+        sorted_plain = self.app.get('/api/products?sort=newest')
+        compressed = self.app.get('/api/products?sort=newest', headers={'Accept-Encoding': 'gzip'})
+        with patch('app.gzip.compress') as compress:
+            hit = self.app.get('/api/products?sort=newest', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(self.app.get('/api/products?sort=newest').data, sorted_plain.data)
+        compress.assert_not_called()
+        self.assertEqual((hit.headers['Content-Encoding'], hit.data), ('gzip', compressed.data))
+        self.assertEqual(gzip.decompress(hit.data), sorted_plain.data)
+        self.assertIn('Accept-Encoding', hit.headers['Vary'])
+        # Below COMPRESS_MIN_SIZE
+        response = self.app.get('/api/products?limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+
+    def test_catalog_snapshot(self):
+        self.seed_catalog(['Alpha', 'Beta'], versions=('1.0.0',), reviews=1)
+        headers = {'Accept-Encoding': 'gzip'}
+        self.app.get('/api/products', headers=headers)
+        with self.count_queries() as statements:
+            response = self.app.get('/api/products', headers=headers)
+        # Only the catalog state is queried
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), self.app.get('/api/products?sort=title').data)
+        self.assertEqual(self.app.get('/api/products').data, self.app.get('/api/products?sort=title').data)
+
+        # Writes re-render the entries of the titles they touch
+        with app.app_context():
+            alpha = Product.query.filter_by(title='Alpha').one()
+            alpha_id = alpha.id
+            db.session.add(Product(title='Alpha', description='newer', price=0.0, image_name='',
+                                   version='2.0.0', license='MIT', seller_id=alpha.seller_id))
+            db.session.commit()
+        self.app.post(f'/api/reviews/{alpha_id}', headers=self.auth_headers(),
+                      data=json.dumps({'rating': 2, 'comment': 'ok'}), content_type='application/json')
+        listed = json.loads(self.app.get('/api/products').data)
+        self.assertEqual([p['version'] for p in listed], ['2.0.0', '1.0.0'])
+        self.assertEqual(self.app.get('/api/products').data, self.app.get('/api/products?sort=title').data)
+
+        runner = app.test_cli_runner()
+        self.assertEqual(runner.invoke(args=['catalog-check']).exit_code, 0)
+        # Writes bypassing the session leave the snapshot behind, and the
+        # listing is rendered from the live tables meanwhile
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(text("UPDATE product SET description = 'bulk'"))
+                bump_catalog_generation(connection)
+        self.assertEqual(json.loads(self.app.get('/api/products').data)[0]['description'], 'bulk')
+        result = runner.invoke(args=['catalog-check'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Alpha: stale', result.output)
+        self.assertIn('The snapshot is at generation', result.output)
+        runner.invoke(args=['catalog-rebuild'])
+        self.assertEqual(runner.invoke(args=['catalog-check']).exit_code, 0)
+
+        # The next write after such a bulk update rebuilds the whole snapshot
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(text("UPDATE product SET description = 'again'"))
+                bump_catalog_generation(connection)
+            product = db.session.get(Product, alpha_id)
+            product.category = 'tools'
+            db.session.commit()
+        self.assertEqual(runner.invoke(args=['catalog-check']).exit_code, 0)
+        self.assertEqual({p['description'] for p in json.loads(self.app.get('/api/products').data)}, {'again'})
+
+    def test_response_cache_invalidates_touched_products(self):
+        self.seed_catalog(['Alpha', 'Beta'], versions=('1.0.0',), reviews=0)
+        with app.app_context():
+            alpha_id = Product.query.filter_by(title='Alpha').one().id
+            beta_id = Product.query.filter_by(title='Beta').one().id
+        self.app.get(f'/api/products/{alpha_id}')
+        self.app.get(f'/api/products/{beta_id}')
+
+        with self.count_queries() as statements:
+            response = self.app.get(f'/api/products/{alpha_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+
+        with app.app_context():
+            db.session.get(Product, beta_id).description = 'changed'
+            db.session.commit()
+
+        hits = response_cache.hits
+        self.app.get(f'/api/products/{alpha_id}')
+        self.assertEqual(response_cache.hits, hits + 1)
+        data = json.loads(self.app.get(f'/api/products/{beta_id}').data)
+        self.assertEqual(data['description'], 'changed')
+        self.assertEqual(response_cache.hits, hits + 1)
+
+        self.assertEqual(self.app.get('/api/cache/stats').status_code, 401)
+        app.config['ADMIN_TOKEN'] = 'admin-secret'
+        self.addCleanup(app.config.update, ADMIN_TOKEN='')
+        response = self.app.get('/api/cache/stats', headers={'Authorization': 'Bearer admin-secret'})
+        self.assertEqual(json.loads(response.data)['hits'], response_cache.hits)
+
+    def test_search_products_ranks_and_tracks_writes(self):
+        self.seed_catalog(['Genome Viewer', 'Variant Caller'], versions=('1.0.0',), reviews=0)
+        with app.app_context():
+            Product.query.filter_by(title='Variant Caller').update(
+                {'description': 'Calls variants from a genome alignment'})
+            db.session.commit()
+
+        response = self.app.get('/api/products/search?q=geno')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['title'] for p in json.loads(response.data)],
+                         ['Genome Viewer', 'Variant Caller'])
+
+        with app.app_context():
+            db.session.delete(Product.query.filter_by(title='Genome Viewer').one())
+            db.session.commit()
+        response = self.app.get('/api/products/search?q=genome')
+        self.assertEqual([p['title'] for p in json.loads(response.data)], ['Variant Caller'])
+        self.assertEqual(self.app.get('/api/products/search?q=').status_code, 400)
+
+    def product_form(self, **fields):
+        form = {'title': 'Test Product', 'description': 'This is a test product',
+                'category': 'test', 'version': '1.0.0', 'license': 'MIT', 'oncodash_version': '1.0'}
+        form.update(fields)
+        return form
+
+    def test_create_product_streams_and_hashes_files(self):
+        headers = self.auth_headers()
+        content = b'plugin bundle' * 1000
+        response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                 data=self.product_form(files=(io.BytesIO(content), 'bundle.zip')))
+        self.assertEqual(response.status_code, 201)
+        product = json.loads(response.data)['product']
+        self.assertEqual(product['file_size'], len(content))
+        self.assertEqual(product['file_sha256'], hashlib.sha256(content).hexdigest())
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], product['files']), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')), [])
+
+        max_file_size = app.config['MAX_FILE_SIZE']
+        app.config['MAX_FILE_SIZE'] = 100
+        try:
+            response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                     data=self.product_form(version='1.0.1',
+                                                            files=(io.BytesIO(content), 'bundle.zip')))
+        finally:
+            app.config['MAX_FILE_SIZE'] = max_file_size
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(os.listdir(os.path.join(app.config['UPLOAD_FOLDER'], '.incoming')), [])
+
+    def test_resumable_upload(self):
+        headers = self.auth_headers()
+        content = b'0123456789'
+        response = self.app.post('/api/uploads', headers=headers, content_type='application/json',
+                                 data=json.dumps({'filename': 'bundle.zip', 'size': len(content)}))
+        self.assertEqual(response.status_code, 201)
+        upload_id = json.loads(response.data)['id']
+
+        response = self.app.patch(f'/api/uploads/{upload_id}', data=content[:4],
+                                  headers={**headers, 'Upload-Offset': '0'})
+        self.assertEqual(json.loads(response.data)['offset'], 4)
+        response = self.app.patch(f'/api/uploads/{upload_id}', data=content[2:],
+                                  headers={**headers, 'Upload-Offset': '2'})
+        self.assertEqual(response.status_code, 409)
+        response = self.app.get(f'/api/uploads/{upload_id}', headers=headers)
+        self.assertEqual(response.headers['Upload-Offset'], '4')
+        # Another request is appending, then gave up long ago
+        with app.app_context():
+            db.session.get(Upload, upload_id).receiving_since = datetime.utcnow()
+            db.session.commit()
+        response = self.app.patch(f'/api/uploads/{upload_id}', data=content[4:],
+                                  headers={**headers, 'Upload-Offset': '4'})
+        self.assertEqual(response.status_code, 409)
+        with app.app_context():
+            db.session.get(Upload, upload_id).receiving_since = datetime.utcnow() - timedelta(hours=2)
+            db.session.commit()
+
+        # Resumed on this worker, hashed as it arrives
+        response = self.app.patch(f'/api/uploads/{upload_id}', data=content[4:7],
+                                  headers={**headers, 'Upload-Offset': '4'})
+        self.assertEqual(json.loads(response.data)['offset'], 7)
+        response = self.app.patch(f'/api/uploads/{upload_id}', data=content[7:],
+                                  headers={**headers, 'Upload-Offset': '7'})
+        upload = json.loads(response.data)
+        self.assertTrue(upload['complete'])
+        self.assertEqual(upload['sha256'], hashlib.sha256(content).hexdigest())
+        self.assertNotIn('job', upload)
+
+        # Resumed on another worker, hashed by a job, run here by a worker
+        response = self.app.post('/api/uploads', headers=headers, content_type='application/json',
+                                 data=json.dumps({'filename': 'bundle.zip', 'size': len(content)}))
+        upload_id = json.loads(response.data)['id']
+        self.app.patch(f'/api/uploads/{upload_id}', data=content[:4], headers={**headers, 'Upload-Offset': '0'})
+        upload_hashers.clear()
+        response = self.app.patch(f'/api/uploads/{upload_id}', data=content[4:],
+                                  headers={**headers, 'Upload-Offset': '4'})
+        upload = json.loads(response.data)
+        self.assertTrue(upload['processing'])
+        self.assertFalse(upload['complete'])
+        job_id = upload['job']['id']
+        with app.test_request_context():
+            job_queue.work(burst=True)
+        self.assertEqual(json.loads(self.app.get(f'/api/jobs/{job_id}', headers=headers).data)['status'], 'done')
+        upload = json.loads(self.app.get(f'/api/uploads/{upload_id}', headers=headers).data)
+        self.assertTrue(upload['complete'])
+        self.assertEqual(upload['sha256'], hashlib.sha256(content).hexdigest())
+
+        response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                 data=self.product_form(upload_id=upload_id))
+        self.assertEqual(response.status_code, 201)
+        product = json.loads(response.data)['product']
+        self.assertEqual(product['file_sha256'], upload['sha256'])
+        self.assertEqual(self.app.get(f'/api/uploads/{upload_id}', headers=headers).status_code, 404)
+
+    def test_uploads_expire(self):
+        headers = self.auth_headers()
+        ids = []
+        for size in (10, 4):
+            response = self.app.post('/api/uploads', headers=headers, content_type='application/json',
+                                     data=json.dumps({'filename': 'bundle.zip', 'size': size}))
+            ids.append(json.loads(response.data)['id'])
+            self.app.patch(f'/api/uploads/{ids[-1]}', data=b'0123', headers={**headers, 'Upload-Offset': '0'})
+        with app.app_context():
+            partial, complete = (db.session.get(Upload, upload_id) for upload_id in ids)
+            paths = [partial.partial_path, os.path.join(app.config['UPLOAD_FOLDER'], complete.stored_name)]
+            partial.updated_at = complete.updated_at = datetime.utcnow() - timedelta(days=2)
+            db.session.commit()
+        response = self.app.post('/api/uploads', headers=headers, content_type='application/json',
+                                 data=json.dumps({'filename': 'bundle.zip', 'size': 10}))
+        recent_id = json.loads(response.data)['id']
+
+        result = app.test_cli_runner().invoke(args=['uploads-expire'])
+        self.assertIn('Removed 2 expired uploads', result.output)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        self.assertEqual([self.app.get(f'/api/uploads/{upload_id}', headers=headers).status_code
+                          for upload_id in ids + [recent_id]], [404, 404, 200])
+
+    def test_identical_files_share_one_blob(self):
+        headers = self.auth_headers()
+        content = b'same bundle'
+        ids = []
+        for version in ('1.0.0', '1.0.1'):
+            response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                     data=self.product_form(version=version,
+                                                            files=(io.BytesIO(content), 'bundle.ZIP'),
+                                                            images=(io.BytesIO(b'icon'), 'icon.png')))
+            product = json.loads(response.data)['product']
+            ids.append(product['id'])
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual(product['files'], f'{digest[:2]}/{digest[2:4]}/{digest}.zip')
+        path = os.path.join(app.config['UPLOAD_FOLDER'], product['files'])
+        icon_path = os.path.join(app.config['UPLOAD_FOLDER'], product['image_name'])
+        with app.app_context():
+            self.assertEqual(db.session.get(Blob, product['files']).refcount, 2)
+
+        self.app.delete(f'/api/products/{ids[0]}', headers=headers)
+        self.assertTrue(os.path.isfile(path))
+        self.app.delete(f'/api/products/{ids[1]}', headers=headers)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(icon_path))
+        with app.app_context():
+            self.assertEqual(Blob.query.count(), 0)
+
+    def test_catalog_export_and_import(self):
+        headers = self.auth_headers()
+        content = b'mirrored bundle'
+        response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                 data=self.product_form(files=(io.BytesIO(content), 'bundle.zip')))
+        product = json.loads(response.data)['product']
+        self.app.post(f'/api/reviews/{product["id"]}', headers=headers,
+                      data=json.dumps({'rating': 5, 'comment': 'great'}), content_type='application/json')
+        self.seed_catalog(['Alpha'], reviews=1)
+        listing = json.loads(self.app.get('/api/products').data)
+
+        self.assertEqual(self.app.get('/api/export').status_code, 401)
+        app.config['ADMIN_TOKEN'] = 'admin-secret'
+        self.addCleanup(app.config.update, ADMIN_TOKEN='')
+        admin = {'Authorization': 'Bearer admin-secret'}
+        self.assertEqual(self.app.get('/api/export', headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+        export = self.app.get('/api/export', headers=admin).data
+        records = [json.loads(line) for line in export.splitlines()]
+        self.assertEqual([r['type'] for r in records[:2]], ['header', 'blob'])
+        self.assertEqual(sum(r['type'] == 'product' for r in records), 3)
+        self.assertTrue(all('password' not in r for r in records if r['type'] == 'user'))
+
+        # Into an empty instance, with another blob store
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+        app.config['UPLOAD_FOLDER'] = self.temporary_folder()
+        # Interrupted before the reviews, then run again
+        partial = b'\n'.join(line for line in export.splitlines() if json.loads(line)['type'] != 'review')
+        response = self.app.post('/api/import', headers=admin, data=partial, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertEqual((result['users'], result['products']), (4, 3))
+        self.assertNotIn('reviews', result)
+        self.assertEqual([blob['name'] for blob in result['missing_blobs']], [product['files']])
+        result = json.loads(self.app.post('/api/import', headers=admin, data=export).data)
+        self.assertEqual((result['products_skipped'], result['reviews']), (3, 3))
+
+        self.assertEqual(self.app.put(f'/api/files/{product["files"]}', headers=admin, data=b'other').status_code, 400)
+        # As for a blob missing from the manifest, the upload creates the row
+        with app.app_context():
+            Blob.query.filter_by(name=product['files']).delete()
+            db.session.commit()
+        self.assertEqual(self.app.put(f'/api/files/{product["files"]}', headers=admin, data=content).status_code, 201)
+        self.assertEqual(self.app.get(f'/api/files/{product["files"]}').data, content)
+        with app.app_context():
+            self.assertEqual(db.session.get(Blob, product['files']).refcount, 1)
+
+        imported = json.loads(self.app.get('/api/products').data)
+        self.assertEqual([(p['title'], p['version'], p['reviewCount'], p['file_url'], p['seller']['name'])
+                          for p in imported],
+                         [(p['title'], p['version'], p['reviewCount'], p['file_url'], p['seller']['name'])
+                          for p in listing])
+        self.assertEqual(self.app.get('/api/products?sort=title').data, self.app.get('/api/products').data)
+        # Imported users must reset their password
+        response = self.app.post('/api/auth/login', content_type='application/json',
+                                 data=json.dumps({'email': 'test@example.com', 'password': 'testpassword'}))
+        self.assertEqual(response.status_code, 401)
+
+        result = json.loads(self.app.post('/api/import', headers=admin, data=export).data)
+        self.assertEqual((result['products_skipped'], result['reviews_skipped'], result['missing_blobs']), (3, 3, []))
+        self.assertNotIn('products', result)
+        response = self.app.post('/api/import', headers=admin, data=b'{"type": "product"}\nnot json\n')
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_files_with_ranges(self):
+        headers = self.auth_headers()
+        content = b'0123456789' * 100
+        response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                 data=self.product_form(files=(io.BytesIO(content), 'bundle.zip')))
+        product = json.loads(response.data)['product']
+        self.assertTrue(product['file_url'].endswith(f'/api/files/{product["files"]}'))
+
+        response = self.app.get(f'/api/files/{product["files"]}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+        response = self.app.get(f'/api/files/{product["files"]}', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, content[10:20])
+        response.close()
+
+        response = self.app.get(f'/api/products/{product["id"]}/download')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Test Product-1.0.0.zip', response.headers['Content-Disposition'])
+        response.close()
+
+        self.assertEqual(self.app.get('/api/files/../app.py').status_code, 404)
+
+        app.config['X_ACCEL_REDIRECT_PREFIX'] = '/internal-uploads'
+        try:
+            response = self.app.get(f'/api/files/{product["files"]}')
+        finally:
+            app.config['X_ACCEL_REDIRECT_PREFIX'] = ''
+        self.assertEqual(response.headers['X-Accel-Redirect'], f'/internal-uploads/{product["files"]}')
+        self.assertEqual(response.data, b'')
+
+    @unittest.skipUnless(images.available(), 'Pillow is not installed')
+    def test_product_image_variants(self):
+        from PIL import Image
+        source = io.BytesIO()
+        Image.new('RGB', (1000, 500), 'red').save(source, 'JPEG')
+        source.seek(0)
+
+        job_queue.eager = True
+        try:
+            response = self.app.post('/api/products', headers=self.auth_headers(),
+                                     content_type='multipart/form-data',
+                                     data=self.product_form(external_url='https://example.com',
+                                                            images=(source, 'screenshot.jpg')))
+        finally:
+            job_queue.eager = False
+        product_id = json.loads(response.data)['product']['id']
+        self.assertEqual([job['status'] for job in json.loads(response.data)['jobs']], ['done'])
+
+        product = json.loads(self.app.get('/api/products').data)[0]
+        self.assertEqual(product['id'], product_id)
+        variants = product['image_variants']
+        self.assertEqual(sorted({v['width'] for v in variants}), [160, 320, 640])
+        self.assertEqual({v['format'] for v in variants}, {'webp', 'jpeg'})
+        thumbnail = next(v for v in variants if v['width'] == 320 and v['format'] == 'webp')
+        self.assertEqual(product['thumbnail_url'], thumbnail['url'])
+
+        name = thumbnail['url'].split('/api/files/')[1]
+        response = self.app.get(f'/api/files/{name}')
+        with Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.size, (320, 160))
+        response.close()
+        with app.app_context():
+            self.assertEqual(Blob.query.count(), 7)
+
+        with app.app_context():
+            db.session.delete(db.session.get(Product, product_id))
+            db.session.commit()
+            self.assertEqual(Blob.query.count(), 0)
+
+    @unittest.skipUnless(images.available(), 'Pillow is not installed')
+    def test_product_image_too_large(self):
+        from PIL import Image
+        source = io.BytesIO()
+        Image.new('RGB', (1000, 500), 'red').save(source, 'JPEG')
+        source.seek(0)
+
+        job_queue.eager = True
+        try:
+            with patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+                response = self.app.post('/api/products', headers=self.auth_headers(),
+                                         content_type='multipart/form-data',
+                                         data=self.product_form(external_url='https://example.com',
+                                                                images=(source, 'screenshot.jpg')))
+        finally:
+            job_queue.eager = False
+        self.assertEqual([job['status'] for job in json.loads(response.data)['jobs']], ['done'])
+        product = json.loads(self.app.get('/api/products').data)[0]
+        self.assertEqual(product['image_variants'], [])
+
     def test_create_product_with_files(self):
         logger.debug("Starting test_create_product_with_files")
         # First register and login to get a token
@@ -153,5 +944,363 @@ class FlaskTestCase(unittest.TestCase):
 
         logger.info("Product creation test completed successfully")
 
+    def test_job_retries_and_status(self):
+        headers = self.auth_headers()
+        calls = []
+
+        @job_queue.task('flaky', max_attempts=2)
+        def flaky(n):
+            calls.append(n)
+            if len(calls) == 1:
+                raise RuntimeError('first attempt fails')
+            return {'n': n}
+
+        @job_queue.task('broken', max_attempts=1)
+        def broken():
+            raise RuntimeError('always fails')
+
+        retry_delay = job_queue.retry_delay
+        job_queue.retry_delay = 0
+        try:
+            with app.test_request_context():
+                user = User.query.filter_by(email='test@example.com').first()
+                jobs = [job_queue.enqueue('flaky', user_id=user.id, n=3), job_queue.enqueue('broken', user_id=user.id)]
+                db.session.commit()
+                flaky_id, broken_id = [job.id for job in jobs]
+                job_queue.work(burst=True)
+        finally:
+            job_queue.retry_delay = retry_delay
+            del job_queue.handlers['flaky'], job_queue.handlers['broken']
+
+        self.assertEqual(calls, [3, 3])
+        job = json.loads(self.app.get(f'/api/jobs/{flaky_id}', headers=headers).data)
+        self.assertEqual((job['status'], job['attempts'], job['result']), ('done', 2, {'n': 3}))
+        job = json.loads(self.app.get(f'/api/jobs/{broken_id}', headers=headers).data)
+        self.assertEqual((job['status'], job['attempts']), ('failed', 1))
+        self.assertEqual(job['error'], 'RuntimeError: always fails')
+        other = self.auth_headers('other@example.com')
+        self.assertEqual(self.app.get(f'/api/jobs/{flaky_id}', headers=other).status_code, 404)
+
+    def test_archive_validation_job(self):
+        headers = self.auth_headers()
+        valid = io.BytesIO()
+        with zipfile.ZipFile(valid, 'w') as archive:
+            archive.writestr('plugin/__init__.py', 'VERSION = 1')
+        escaping = io.BytesIO()
+        with tarfile.open(fileobj=escaping, mode='w:gz') as archive:
+            member = tarfile.TarInfo('../outside.py')
+            archive.addfile(member, io.BytesIO(b''))
+        files = {
+            '1.0.0': (io.BytesIO(valid.getvalue()), 'bundle.zip'),
+            '1.0.1': (io.BytesIO(b'not a zip'), 'bundle.zip'),
+            '1.0.2': (io.BytesIO(escaping.getvalue()), 'bundle.tar.gz'),
+            '1.0.3': (io.BytesIO(b'notes'), 'notes.txt'),
+        }
+        statuses = {}
+        job_queue.eager = True
+        try:
+            for version, file in files.items():
+                response = self.app.post('/api/products', headers=headers, content_type='multipart/form-data',
+                                         data=self.product_form(version=version, files=file))
+                statuses[version] = json.loads(response.data)['product']['id']
+        finally:
+            job_queue.eager = False
+        for version, product_id in statuses.items():
+            statuses[version] = json.loads(self.app.get(f'/api/products/{product_id}').data)['file_status']
+        self.assertEqual(statuses, {'1.0.0': 'valid', '1.0.1': 'invalid', '1.0.2': 'invalid', '1.0.3': None})
+
+    @requires_dialect('sqlite')
+    def test_sqlite_pragmas(self):
+        with app.app_context():
+            self.assertEqual(db.session.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+            self.assertEqual(db.session.execute(text('PRAGMA synchronous')).scalar(), 1)  # NORMAL
+            self.assertEqual(db.session.execute(text('PRAGMA busy_timeout')).scalar(),
+                             app.config['SQLITE_PRAGMAS']['busy_timeout'])
+
+    def test_write_retries(self):
+        with app.app_context():
+            calls = []
+
+            @write_transaction
+            def contended():
+                calls.append(1)
+                if len(calls) < 3:
+                    raise OperationalError('INSERT', {}, Exception('database is locked'))
+                return 'written'
+
+            self.assertEqual(contended(), 'written')
+            self.assertEqual(len(calls), 3)
+
+            @write_transaction
+            def failing():
+                calls.append(1)
+                raise OperationalError('INSERT', {}, Exception('no such table: missing'))
+
+            calls.clear()
+            self.assertRaises(OperationalError, failing)
+            self.assertEqual(len(calls), 1)
+
+    def test_database_configuration(self):
+        self.assertEqual(database_url('postgres://u:p@db/appstore'), 'postgresql://u:p@db/appstore')
+        self.assertEqual(database_url('sqlite:////app/db/appstore.db'), 'sqlite:////app/db/appstore.db')
+        self.assertEqual(engine_options('sqlite:///appstore.db', pool_size=20), {})
+        options = engine_options('postgresql://db/appstore', pool_size=20, pool_recycle=600)
+        self.assertEqual((options['pool_size'], options['pool_recycle'], options['pool_pre_ping']),
+                         (20, 600, True))
+
+        class SerializationFailure(Exception):
+            pgcode = '40001'
+
+        calls = []
+
+        @write_transaction
+        def serialized():
+            calls.append(1)
+            if len(calls) < 2:
+                raise OperationalError('UPDATE', {}, SerializationFailure())
+            return 'written'
+
+        with app.app_context():
+            self.assertEqual(serialized(), 'written')
+        self.assertEqual(len(calls), 2)
+
+    def test_cached_authentication_and_token_revocation(self):
+        headers = self.auth_headers()
+        self.assertEqual(self.app.get('/api/user', headers=headers).status_code, 200)
+        with self.count_queries() as statements:
+            response = self.app.get('/api/user', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['email'], 'test@example.com')
+        self.assertEqual(statements, [])
+
+        response = self.app.post('/api/user/change-password', headers=headers,
+                                 data=json.dumps({'current_password': 'testpassword',
+                                                  'new_password': 'newpassword'}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        new_headers = {'Authorization': f'Bearer {json.loads(response.data)["token"]}'}
+        self.assertEqual(self.app.get('/api/user', headers=headers).status_code, 401)
+        self.assertEqual(self.app.get('/api/user', headers=new_headers).status_code, 200)
+
+        with app.app_context():
+            db.session.delete(User.query.filter_by(email='test@example.com').one())
+            db.session.commit()
+        principal_cache.clear()
+        auth_rate_store.clear()
+        self.assertEqual(self.app.get('/api/user', headers=new_headers).status_code, 401)
+
+    def test_login_upgrades_password_hashes(self):
+        self.auth_headers()
+        with app.app_context():
+            user = User.query.filter_by(email='test@example.com').one()
+            self.assertFalse(password_hasher.needs_rehash(user.password))
+            user.password = generate_password_hash('testpassword', 'pbkdf2:sha256:1000')
+            db.session.commit()
+
+        response = self.app.post('/api/auth/login', content_type='application/json',
+                                 data=json.dumps({'email': 'test@example.com', 'password': 'testpassword'}))
+        self.assertEqual(response.status_code, 200)
+        with app.app_context():
+            pwhash = User.query.filter_by(email='test@example.com').one().password
+        self.assertTrue(pwhash.startswith(password_hasher.method + '$'))
+
+    def test_auth_rate_limits(self):
+        limit = app.config['AUTH_RATE_LIMIT_EMAIL']
+        statuses = []
+        for i in range(limit + 1):
+            response = self.app.post('/api/auth/login', content_type='application/json',
+                                      data=json.dumps({'email': 'Victim@example.com', 'password': f'guess{i}'}),
+                                      environ_base={'REMOTE_ADDR': f'10.0.0.{i}'})
+            statuses.append(response.status_code)
+        self.assertEqual(statuses, [401] * limit + [429])
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        # Other emails and clients are not affected
+        response = self.app.post('/api/auth/login', content_type='application/json',
+                                 data=json.dumps({'email': 'other@example.com', 'password': 'guess'}))
+        self.assertEqual(response.status_code, 401)
+
+        limiter = TokenBucketLimiter(SQLiteBucketStore(os.path.join(tempfile.mkdtemp(), 'buckets.db')),
+                                     per_minute=60, burst=2)
+        self.assertEqual([limiter.hit('1.2.3.4') > 0 for _ in range(3)], [False, False, True])
+        self.assertFalse(limiter.hit('5.6.7.8'))
+
+    def test_benchmark_suite(self):
+        with app.test_request_context():
+            self.assertTrue(benchmark.seed_catalog(users=3, products=4, versions=3, reviews=2))
+            self.assertFalse(benchmark.seed_catalog(users=3, products=4, versions=3, reviews=2))
+            self.assertEqual(Product.query.filter(Product.is_latest).count(), 4)
+            results = benchmark.run_benchmark(requests=4, concurrency=2, upload_size=1024)
+
+        self.assertEqual(set(results), {'GET /api/products', 'GET /api/products/<id>',
+                                        'GET /api/compat/<oncodash_version>', 'POST /api/updates/check',
+                                        'GET /api/user/products',
+                                        'POST /api/auth/login', 'POST /api/uploads', 'PATCH /api/uploads/<id>'})
+        for endpoint, stats in results.items():
+            self.assertEqual((stats['requests'], stats['errors']), (4, 0), endpoint)
+            self.assertLessEqual(stats['p50_ms'], stats['p95_ms'])
+            self.assertGreater(stats['queries_per_request'], 0)
+        slower = {endpoint: dict(stats, p95_ms=stats['p95_ms'] * 2) for endpoint, stats in results.items()}
+        self.assertEqual(benchmark.compare_results(results, results), [])
+        self.assertEqual(len(benchmark.compare_results(slower, results)), len(results))
+
+    def test_metrics_endpoint(self):
+        self.seed_catalog(['Metered'], versions=('1.0.0',), reviews=1)
+        # Requests are recorded once their body is read
+        for _ in range(3):
+            self.assertIn(b'Metered', self.app.get('/api/products?sort=newest').data)
+        self.app.get('/api/products/999999').close()
+
+        self.assertEqual(self.app.get('/metrics').status_code, 401)
+        app.config['ADMIN_TOKEN'] = 'admin-secret'
+        self.addCleanup(app.config.update, ADMIN_TOKEN='')
+        response = self.app.get('/metrics', headers={'Authorization': 'Bearer admin-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = dict(line.rsplit(' ', 1) for line in response.get_data(as_text=True).splitlines()
+                     if not line.startswith('#'))
+        labels = 'method="GET",route="/api/products"'
+        self.assertGreaterEqual(float(lines[f'appstore_requests_total{{{labels},status="200"}}']), 3)
+        self.assertGreaterEqual(float(lines['appstore_requests_total{method="GET",route="/api/products/<int:id>",'
+                                            'status="404"}']), 1)
+        self.assertGreaterEqual(float(lines[f'appstore_request_duration_seconds_bucket{{le="+Inf",{labels}}}']), 3)
+        self.assertGreater(float(lines[f'appstore_request_sql_statements_total{{{labels}}}']), 0)
+        self.assertGreater(float(lines[f'appstore_request_json_seconds_total{{{labels}}}']), 0)
+        self.assertGreater(float(lines[f'appstore_response_bytes_total{{{labels}}}']), 0)
+
+    def test_metrics_aggregate_processes_and_profile_slow_requests(self):
+        folder = tempfile.mkdtemp()
+        worker = MetricsRegistry(folder)
+        worker.inc('appstore_requests_total', {'route': '/x', 'method': 'GET', 'status': '200'}, 2)
+        worker.flush()
+        # As if written by another worker
+        os.rename(os.path.join(folder, f'{os.getpid()}.json'), os.path.join(folder, '1.json'))
+        registry = MetricsRegistry(folder)
+        registry.inc('appstore_requests_total', {'route': '/x', 'method': 'GET', 'status': '200'}, 3)
+        self.assertIn('appstore_requests_total{method="GET",route="/x",status="200"} 5', registry.render())
+        # Exited workers add up in a single file
+        merge_process(folder, 1)
+        os.rename(os.path.join(folder, f'{os.getpid()}.json'), os.path.join(folder, '2.json'))
+        merge_process(folder, 2)
+        self.assertEqual(sorted(name for name in os.listdir(folder) if name.endswith('.json')), ['dead.json'])
+        self.assertIn('appstore_requests_total{method="GET",route="/x",status="200"} 8', registry.render())
+
+        def slow_app(environ, start_response):
+            environ['appstore.route'] = '/slow/<int:id>'
+            time.sleep(0.1)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'done']
+
+        profiles = tempfile.mkdtemp()
+        middleware = MetricsMiddleware(slow_app, MetricsRegistry(), SamplingProfiler(profiles, threshold=0.05))
+        body = middleware({'REQUEST_METHOD': 'GET'}, lambda status, headers, exc_info=None: None)
+        self.assertEqual(b''.join(body), b'done')
+        body.close()
+        [name] = os.listdir(profiles)
+        self.assertTrue(name.endswith('-slow_int_id.folded'))
+        with open(os.path.join(profiles, name)) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(any('slow_app (test_app.py:' in line for line in stacks))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+    def test_migrations_add_missing_indexes(self):
+        with app.app_context():
+            # A database created before the lookup indexes existed
+            with db.engine.begin() as connection:
+                connection.execute(text('DROP INDEX ix_product_seller_id'))
+                connection.execute(text('DROP INDEX ix_review_user_id'))
+            self.assertEqual(migrations.pending(), list(range(1, migrations.head + 1)))
+            self.assertEqual(migrations.upgrade(), list(range(1, migrations.head + 1)))
+            self.assertEqual(migrations.pending(), [])
+            self.assertEqual(migrations.upgrade(), [])
+
+            inspector = inspect(db.engine)
+            self.assertIn('ix_product_seller_id', [i['name'] for i in inspector.get_indexes('product')])
+            self.assertIn('ix_review_user_id', [i['name'] for i in inspector.get_indexes('review')])
+
+    def test_migrations_upgrade_baseline_database(self):
+        # The tables as the first release created them, with some data
+        baseline = [
+            """CREATE TABLE "user" (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL,
+                email VARCHAR(100) NOT NULL UNIQUE, password VARCHAR(200) NOT NULL, created_at TIMESTAMP)""",
+            """CREATE TABLE product (id INTEGER PRIMARY KEY, title VARCHAR(100) NOT NULL, files VARCHAR(255),
+                file_url VARCHAR(255), external_url VARCHAR(255), image_name VARCHAR(255) NOT NULL,
+                description TEXT NOT NULL, price FLOAT NOT NULL, image_url VARCHAR(255), category VARCHAR(50),
+                seller_id INTEGER NOT NULL REFERENCES "user" (id), created_at TIMESTAMP,
+                version VARCHAR(50) NOT NULL, license VARCHAR(100) NOT NULL, oncodash_version VARCHAR(20),
+                CONSTRAINT uq_title_version UNIQUE (title, version))""",
+            """CREATE TABLE review (id INTEGER PRIMARY KEY, product_id INTEGER NOT NULL REFERENCES product (id),
+                user_id INTEGER NOT NULL REFERENCES "user" (id), rating INTEGER NOT NULL, comment TEXT NOT NULL,
+                created_at TIMESTAMP)""",
+            """INSERT INTO "user" (id, name, email, password, created_at)
+                VALUES (1, 'Seller', 'seller@example.com', 'x', '2024-01-01 00:00:00')""",
+            """INSERT INTO product (id, title, image_name, description, price, category, seller_id, created_at,
+                version, license, oncodash_version)
+                VALUES (1, 'Legacy', '', 'old tool', 0, 'Analysis', 1, '2024-01-01 00:00:00', '1.9.0', 'MIT', '1.0'),
+                       (2, 'Legacy', '', 'old tool', 0, 'Analysis', 1, '2024-01-02 00:00:00', '1.10.0', 'MIT', '1.0')""",
+            """INSERT INTO review (id, product_id, user_id, rating, comment, created_at)
+                VALUES (1, 2, 1, 4, 'ok', '2024-01-03 00:00:00'), (2, 2, 1, 2, 'meh', '2024-01-04 00:00:00')""",
+        ]
+        with app.app_context():
+            db.drop_all()
+            with db.engine.begin() as connection:
+                for statement in baseline:
+                    connection.execute(text(statement))
+            self.assertEqual(migrations.upgrade(), list(range(1, migrations.head + 1)))
+
+            inspector = inspect(db.engine)
+            indexes = [i['name'] for i in inspector.get_indexes('product')]
+            for name in ('ix_product_latest_title', 'ix_product_latest_category', 'ix_product_title_version_key',
+                         'ix_product_compat'):
+                self.assertIn(name, indexes)
+            self.assertIn('ix_review_product_created_at', [i['name'] for i in inspector.get_indexes('review')])
+
+        [product] = json.loads(self.app.get('/api/products').data)
+        self.assertEqual((product['version'], product['reviewCount'], product['rating']), ('1.10.0', 2, 3.0))
+        self.assertEqual([p['id'] for p in json.loads(self.app.get('/api/products/search?q=legacy').data)], [2])
+        self.assertEqual([p['version'] for p in json.loads(self.app.get('/api/compat/1.0.3').data)['products']],
+                         ['1.10.0'])
+
+    def test_concurrent_reads_and_writes(self):
+        self.seed_catalog(['Stress'], versions=('1.0.0',), reviews=0)
+        with app.app_context():
+            product_id = Product.query.filter_by(title='Stress').one().id
+        writers, readers, requests = 4, 4, 15
+        headers = [self.auth_headers(f'writer{i}@example.com') for i in range(writers)]
+        statuses = []
+        errors = []
+
+        def write(headers):
+            client = app.test_client()
+            for i in range(requests):
+                response = client.post(f'/api/reviews/{product_id}', headers=headers,
+                                       data=json.dumps({'rating': 4, 'comment': f'review {i}'}),
+                                       content_type='application/json')
+                statuses.append(response.status_code)
+
+        def read():
+            client = app.test_client()
+            for i in range(requests):
+                for url in (f'/api/products/{product_id}', f'/api/products?sort=newest&limit={i + 1}'):
+                    statuses.append(client.get(url).status_code)
+
+        def run(target, *args):
+            try:
+                target(*args)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(write, h)) for h in headers]
+        threads += [threading.Thread(target=run, args=(read,)) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(set(statuses)), [200, 201])
+        self.assertEqual(statuses.count(201), writers * requests)
+        product = json.loads(self.app.get(f'/api/products/{product_id}').data)
+        self.assertEqual((product['reviewCount'], product['rating']), (writers * requests, 4.0))
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BLOB_NAME = 'ab/cd/abcd' + '0' * 60 + '.zip'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServingModeTestCase(unittest.TestCase):
+    """Run gunicorn with gunicorn.conf.py and check that slow transfers do not stall the API."""
+
+    transfers = 8
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+        self.env = dict(os.environ,
+                        DATABASE_URL=f'sqlite:///{self.folder}/appstore.db',
+                        UPLOAD_FOLDER=os.path.join(self.folder, 'uploads'),
+                        SECRET_KEY='test',
+                        WEB_CONCURRENCY='1')
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db-upgrade'],
+                       cwd=APP_DIR, env=self.env, check=True, capture_output=True)
+        path = os.path.join(self.folder, 'uploads', *BLOB_NAME.split('/'))
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.truncate(256 * 1024 * 1024)
+
+    @staticmethod
+    def slow_download(port):
+        """Start downloading the blob and never read it, holding the request open."""
+        client = socket.create_connection(('127.0.0.1', port))
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.sendall(f'GET /api/files/{BLOB_NAME} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+        return client
+
+    def serve(self, mode):
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+            cwd=APP_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(self.env, SERVER_MODE=mode, GUNICORN_BIND=f'127.0.0.1:{port}'))
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/api/products', timeout=5).read()
+                return port
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise
+                time.sleep(0.2)
+
+    def latencies(self, port, count=20):
+        latencies = []
+        for _ in range(count):
+            start = time.monotonic()
+            response = urllib.request.urlopen(f'http://127.0.0.1:{port}/api/products', timeout=10)
+            response.read()
+            latencies.append(time.monotonic() - start)
+            self.assertEqual(response.status, 200)
+        return latencies
+
+    def check_mode(self, mode):
+        port = self.serve(mode)
+        idle = sorted(self.latencies(port))
+        downloads = [self.slow_download(port) for _ in range(self.transfers)]
+        try:
+            time.sleep(0.5)
+            busy = sorted(self.latencies(port))
+        finally:
+            for client in downloads:
+                client.close()
+        # The median stays within a few milliseconds of the idle one
+        self.assertLess(busy[len(busy) // 2], idle[len(idle) // 2] + 0.1)
+        self.assertLess(busy[-1], 1.0)
+
+    def test_gthread_mode(self):
+        self.check_mode('gthread')
+
+    def test_gevent_mode(self):
+        try:
+            import gevent  # noqa: F401
+        except ImportError:
+            self.skipTest('gevent is not installed')
+        self.check_mode('gevent')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Folders, inside the upload folder, for files still being received
+INCOMING_DIR = '.incoming'
+PARTIAL_DIR = '.partial'
+
+
+class HashingWriter(object):
+    """File proxy computing the size and SHA-256 of everything written to it.
+
+    Writing more than `max_size` bytes raises RequestEntityTooLarge.
+    """
+
+    def __init__(self, file, max_size=None):
+        self.file = file
+        self.max_size = max_size
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge(f'Files are limited to {self.max_size} bytes')
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class StreamingUploadRequest(Request):
+    """Request writing multipart files straight into the upload folder.
+
+    Werkzeug spools uploaded files to memory or to the system temporary
+    folder, and saving them copies every byte once more. Here each file is
+    received into a temporary file next to its final location and hashed
+    while it is parsed, so that store_upload() is a rename.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        folder = os.path.join(current_app.config['UPLOAD_FOLDER'], INCOMING_DIR)
+        os.makedirs(folder, exist_ok=True)
+        file = tempfile.NamedTemporaryFile(dir=folder, delete=False)
+        self.track_incoming(file.name)
+        return HashingWriter(file, current_app.config.get('MAX_FILE_SIZE'))
+
+    def track_incoming(self, path):
+        """Remove the file at `path` when the request closes, unless it was moved."""
+        self.__dict__.setdefault('incoming_files', []).append(path)
+
+    def close(self):
+        super().close()
+        # Remove the files the view did not store
+        for name in self.__dict__.pop('incoming_files', ()):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def copy_stream(source, target, limit=None, chunk_size=1024 * 1024, hasher=None):
+    """Copy `source` into `target` in chunks and return the number of bytes copied.
+
+    At most `limit` bytes are copied when it is given. `hasher` is updated
+    with the copied bytes.
+    """
+    copied = 0
+    while limit is None or copied < limit:
+        size = chunk_size if limit is None else min(chunk_size, limit - copied)
+        chunk = source.read(size)
+        if not chunk:
+            break
+        target.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def store_upload(file, path, max_size=None, chunk_size=1024 * 1024):
+    """Store an uploaded FileStorage at `path` and return its (size, sha256).
+
+    Files received by StreamingUploadRequest are moved in place, others
+    are copied in chunks while being hashed.
+    """
+    stream = file.stream
+    if isinstance(stream, HashingWriter):
+        stream.file.close()
+        os.replace(stream.file.name, path)
+        return stream.size, stream.sha256.hexdigest()
+
+    partial = path + '.part'
+    target = HashingWriter(open(partial, 'wb'), max_size)
+    try:
+        with target.file:
+            copy_stream(stream, target, chunk_size=chunk_size)
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
+    return target.size, target.sha256.hexdigest()
@@ -0,0 +1,182 @@
+import re
+
+# major.minor.patch with optional leading "v", missing minor/patch, further
+# numeric parts ("1.0.0.1"), a prerelease tag ("-rc.1", "b2", ".dev0") and
+# build metadata ("+abc")
+VERSION_RE = re.compile(
+    r'^\s*v?(\d+)(?:\.(\d+))?(?:\.(\d+))?((?:\.\d+)*)'
+    r'(?:[-.]?([0-9A-Za-z][0-9A-Za-z.-]*?))?'
+    r'(?:\+[0-9A-Za-z.-]*)?\s*$'
+)
+# Each numeric part is packed in base PART_LIMIT, larger values are clamped
+PART_LIMIT = 100000
+# Length of prerelease_key(), that of Product.version_prerelease
+PRERELEASE_KEY_LENGTH = 50
+
+
+def parse_version(version):
+    """Parse a version string into (major, minor, patch, prerelease).
+
+    Missing parts default to 0 and prerelease is '' for releases. Parts
+    after the patch are left out, see prerelease_key(). Strings that are not
+    versions at all parse as 0.0.0 with the whole string as prerelease, so
+    they sort below every real release.
+    """
+    match = VERSION_RE.match(version or '')
+    if not match:
+        return 0, 0, 0, (version or '').strip()
+    major, minor, patch, extra, prerelease = match.groups()
+    return int(major), int(minor or 0), int(patch or 0), prerelease or ''
+
+
+def version_key(version):
+    """Pack a version string into an integer that orders like semantic versions.
+
+    A release sorts above the prereleases of the same major.minor.patch.
+    Versions sharing a key are told apart by their prerelease_key().
+    """
+    major, minor, patch, prerelease = parse_version(version)
+    major, minor, patch = (min(part, PART_LIMIT - 1) for part in (major, minor, patch))
+    return ((major * PART_LIMIT + minor) * PART_LIMIT + patch) * 2 + (0 if prerelease else 1)
+
+
+# A version in a compatibility range, where missing or wildcard ("x", "*")
+# minor and patch parts match any value
+RANGE_VERSION_RE = re.compile(
+    r'^v?(\d+)(?:\.(\d+|[xX*]))?(?:\.(\d+|[xX*]))?'
+    r'(?:[-.]?([0-9A-Za-z][0-9A-Za-z.-]*?))?(?:\+[0-9A-Za-z.-]*)?$'
+)
+RANGE_OPERATORS = ('>=', '<=', '==', '~=', '>', '<', '=', '^', '~')
+# Exclusive upper bound of every key, that of an open-ended range
+MAX_VERSION_KEY = PART_LIMIT ** 3 * 2
+
+
+def _parse_range_version(text):
+    """Return the numeric parts given in `text`, up to the first wildcard, and its prerelease."""
+    match = RANGE_VERSION_RE.match(text)
+    if not match:
+        raise ValueError(f'Invalid version in range: {text!r}')
+    parts = []
+    for part in match.groups()[:3]:
+        if part is None or not part.isdigit():
+            break
+        parts.append(min(int(part), PART_LIMIT - 1))
+    prerelease = match.group(4) or ''
+    if prerelease and len(parts) < 3:
+        raise ValueError(f'Prerelease of a partial version in range: {text!r}')
+    return parts, prerelease
+
+
+def _base_key(parts):
+    major, minor, patch = parts + [0] * (3 - len(parts))
+    return ((major * PART_LIMIT + minor) * PART_LIMIT + patch) * 2
+
+
+def _lowest(parts, prerelease):
+    # Lowest key matching `parts`: their release, or their prereleases when given one
+    return _base_key(parts) + (0 if prerelease else 1)
+
+
+def _above(parts, prerelease):
+    # Lowest key above every version matching `parts`
+    if len(parts) == 3:
+        return _lowest(parts, prerelease) + 1
+    return _before(parts[:-1] + [parts[-1] + 1])
+
+
+def _before(parts):
+    # Highest exclusive bound below `parts` and its prereleases
+    return _base_key(parts)
+
+
+def _clause_bounds(operator, parts, prerelease):
+    if operator in ('', '=', '=='):
+        return _lowest(parts, prerelease), _above(parts, prerelease)
+    if operator == '>=':
+        return _lowest(parts, prerelease), MAX_VERSION_KEY
+    if operator == '>':
+        return _above(parts, prerelease) | 1, MAX_VERSION_KEY
+    if operator == '<':
+        return 0, _before(parts)
+    if operator == '<=':
+        return 0, _above(parts, prerelease)
+    if operator == '^':
+        # Up to the next change of the leftmost non-zero part
+        significant = next((i for i, part in enumerate(parts) if part), len(parts) - 1)
+        return _lowest(parts, prerelease), _above(parts[:significant + 1], '')
+    if operator == '~':
+        return _lowest(parts, prerelease), _above(parts[:2], '')
+    # ~=, compatible release: the last given part may grow
+    if len(parts) < 2:
+        raise ValueError('~= needs a major.minor version')
+    return _lowest(parts, prerelease), _above(parts[:-1], '')
+
+
+def parse_compat_range(spec):
+    """Parse a compatibility range into (min_key, max_key), version_key() bounds.
+
+    Versions in the range are those whose key k satisfies
+    min_key <= k < max_key. The range is a comma or space separated list of
+    clauses that all apply, each an operator among >=, >, <=, <, ==, =, ^, ~
+    and ~= followed by a version, or a bare version. Bare partial versions
+    and wildcards match every version starting with the given parts, so
+    "1.2" and "1.2.x" both mean >=1.2.0 <1.3.0, while "1.2.3" is that
+    version alone. "A - B" is the inclusive range from A to B, and empty
+    strings and "*" match every version. Ranges start at releases, so
+    prereleases only match when a bound names one.
+
+    Raises ValueError on anything else, such as alternatives ("||"), and on
+    ranges matching no version.
+    """
+    spec = (spec or '').strip()
+    if spec in ('', '*', 'x', 'X'):
+        return 0, MAX_VERSION_KEY
+    if '||' in spec:
+        raise ValueError('Alternative ranges are not supported')
+    hyphen = re.match(r'^(\S+)\s+-\s+(\S+)$', spec)
+    if hyphen:
+        clauses = [('>=', hyphen.group(1)), ('<=', hyphen.group(2))]
+    else:
+        clauses = []
+        for clause in re.split(r'[\s,]+', re.sub(r'(>=|<=|==|~=|[<>=^~])\s+', r'\1', spec)):
+            if not clause:
+                continue
+            operator = next((op for op in RANGE_OPERATORS if clause.startswith(op)), '')
+            clauses.append((operator, clause[len(operator):]))
+    min_key, max_key = 0, MAX_VERSION_KEY
+    for operator, version in clauses:
+        low, high = _clause_bounds(operator, *_parse_range_version(version))
+        min_key, max_key = max(min_key, low), min(max_key, high)
+    if min_key >= max_key:
+        raise ValueError(f'Range matches no version: {spec!r}')
+    return min_key, max_key
+
+
+def _identifier_key(identifier):
+    # Numeric identifiers sort below alphanumeric ones and by value, their
+    # digit count coming first
+    if identifier.isascii() and identifier.isdigit():
+        digits = str(min(int(identifier), 10 ** 9 - 1))
+        return f'0{len(digits)}{digits}'
+    return '1' + identifier
+
+
+def prerelease_key(version):
+    """String ordering the versions that share a version_key(), as semantic versions do.
+
+    The dot-separated identifiers of the prerelease compare one by one,
+    numbers numerically and below other identifiers, and a prerelease
+    that is a prefix of another sorts first: rc.9 < rc.10 < rc.10.x.
+    Numeric parts after the patch follow the prerelease, so that
+    1.0.0 < 1.0.0.1 < 1.0.0.10 among releases. Keys compare as plain
+    strings, in SQL as in Python, and are truncated to
+    PRERELEASE_KEY_LENGTH.
+    """
+    match = VERSION_RE.match(version or '')
+    if match:
+        extra, prerelease = match.group(4), match.group(5) or ''
+    else:
+        extra, prerelease = '', (version or '').strip()
+    identifiers = [part for part in prerelease.split('.') + extra.split('.') if part]
+    # "!" sorts below every character of an identifier
+    return '!'.join(_identifier_key(identifier) for identifier in identifiers)[:PRERELEASE_KEY_LENGTH]
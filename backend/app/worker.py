@@ -0,0 +1,30 @@
+"""Run the background jobs of the app store.
+
+    python worker.py [--burst] [--poll-interval SECONDS]
+
+Several workers may run at once, each job is claimed by only one of them.
+"""
+import argparse
+import logging
+import os
+import socket
+
+from app import app, job_queue
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the background jobs of the app store')
+    parser.add_argument('--burst', action='store_true', help='exit once the queue is empty')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds to wait before looking for new jobs when the queue is empty')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Tasks build external URLs with url_for(), which needs a request context
+    with app.test_request_context():
+        job_queue.work(worker=f'{socket.gethostname()}:{os.getpid()}',
+                       poll_interval=args.poll_interval, burst=args.burst)
+
+
+if __name__ == '__main__':
+    main()
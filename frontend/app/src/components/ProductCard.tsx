@@ -17,7 +17,12 @@ export function ProductCard({ product }: ProductCardProps) {
     <Card className="overflow-hidden">
       <CardHeader className="p-0">
         <img
-          src={product.image_url}
+          src={product.thumbnail_url || product.image_url}
+          srcSet={product.image_variants
+            ?.filter((variant) => variant.format === 'webp')
+            .map((variant) => `${variant.url} ${variant.width}w`)
+            .join(', ')}
+          sizes="(min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw"
           alt={product.title}
           className="w-full h-48 object-cover"
         />
@@ -14,6 +14,8 @@ export interface Product {
   description: string;
   price: number;
   image_url: string;
+  thumbnail_url?: string;
+  image_variants?: { width: number; format: string; url: string }[];
   file_url: string;
   external_url?: string; // Add this line
   category: string;